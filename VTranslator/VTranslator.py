@@ -1,5 +1,5 @@
 import time, uuid, json
-import os, threading, re, winreg, copy
+import os, threading, re, winreg
 from qtsymbols import *
 from traceback import print_exc
 from sometypes import TranslateResult, TranslateError, WordSegResult
@@ -23,7 +23,6 @@ from myutils.keycode import mod_map_r
 from gobject import sys_le_xp
 from myutils.mecab import mecab, latin, jiebapinyin
 from myutils.utils import (
-    parsemayberegexreplace,
     find_or_create_uid,
     parsekeystringtomodvkcode,
     checkpostusing,
@@ -31,7 +30,6 @@ from myutils.utils import (
     stringfyerror,
     targetmod,
     translate_exits,
-    safe_escape,
     getlangsrc,
 )
 from language import Languages
@@ -60,6 +58,8 @@ from myutils.post import POSTSOLVE
 from myutils.utils import nowisdark
 from myutils.somedatabase import somedatabase
 from myutils.audioplayer import series_audioplayer
+from myutils.ttsprefetch import ttsprefetcher, completedprefix
+from myutils.ttsrules import ttsrules, getttsrules
 from gui.dynalang import LAction, LDialog
 from gui.setting.setting import Setting
 from gui.usefulwidget import PopupWidget, pixmapviewer
@@ -183,6 +183,7 @@ class BASEOBJECT(QObject):
         self.edittextui_cached = None
         self.notifyonce = set()
         self.audioplayer = series_audioplayer(playovercallback=self.ttsautoforward)
+        self.ttsprefetcher = ttsprefetcher(self.ttsresolve)
         self._internal_reader = None
         self.reader_uid = None
         self.__hwnd = None
@@ -502,6 +503,7 @@ class BASEOBJECT(QObject):
             self.currenttranslate = ""
             self.currenttranslate_1 = ""
             self.latest_is_origin = True
+            self.ttsprefetcher.cancel("trans")
             if globalconfig["read_raw"]:
                 self.readcurrent()
             self.dispatchoutputer(text, True)
@@ -617,6 +619,54 @@ class BASEOBJECT(QObject):
             )
         return True
 
+    def batchtranslateengine(self):
+        # 批量翻译只使用一个翻译器：首选翻译器，否则按翻译器顺序的第一个
+        for engine in [globalconfig["toppest_translator"]] + globalconfig[
+            "fix_translate_rank_rank"
+        ]:
+            translator = self.translators.get(engine)
+            if translator and not translator.never_use_trans_cache:
+                return engine
+        return None
+
+    def translatebatch(self, texts: "list[str]", engine: str) -> "list[str]":
+        # 文件翻译使用。不经过显示、朗读、历史记录等流程，只做文本处理、翻译优化和（批量）翻译。
+        translator = self.translators.get(engine)
+        results = [None] * len(texts)
+        if not translator:
+            return results
+        indexes = []
+        tasks = []
+        for i, origin in enumerate(texts):
+            with self.solvegottextlock:
+                try:
+                    text = POSTSOLVE(origin, isEx=True)
+                except:
+                    print_exc()
+                    continue
+                if not (text and text.strip()):
+                    continue
+                try:
+                    self.textsource.sqlqueueput((text, origin))
+                except:
+                    pass
+                text_solved, optimization_params = self.solvebeforetrans(text)
+            if not text_solved:
+                continue
+            indexes.append((i, text, optimization_params))
+            tasks.append((text_solved, optimization_params))
+        ress = translator.translate_lines(tasks)
+        for (i, text, optimization_params), res in zip(indexes, ress):
+            res = self.solveaftertrans(res, optimization_params)
+            if not res:
+                continue
+            try:
+                self.textsource.sqlqueueput((text, engine, res))
+            except:
+                pass
+            results[i] = res
+        return results
+
     def analyzecontent(self, text_solved, optimization_params):
         for _ in optimization_params:
             if isinstance(_, dict):
@@ -765,6 +815,8 @@ class BASEOBJECT(QObject):
                     klass=classname,
                 )
                 self.translation_ui.displayres.emit(displayreskwargs)
+                if iter_res_status == 1:
+                    self.ttsprefetch_trans(classname, res)
             if iter_res_status in (0, 2):  # 0为普通，1为iter，2为iter终止
 
                 if statusok:
@@ -796,99 +848,26 @@ class BASEOBJECT(QObject):
 
                     self.dispatchoutputer(res, False)
 
-    def __usewhich(self):
-
-        try:
-            for _ in (0,):
-                gameuid = self.gameuid
-                if not gameuid:
-                    break
-                if savehook_new_data[gameuid].get("tts_follow_default", True):
-                    break
-                tts_repair_merge = savehook_new_data[gameuid].get(
-                    "tts_repair_merge", False
-                )
-                tts_skip_merge = savehook_new_data[gameuid].get("tts_skip_merge", False)
-                if tts_skip_merge or tts_repair_merge:
-                    _this = {"tts_repair_regex": [], "tts_skip_regex": []}
-                    _this.update(copy.deepcopy(savehook_new_data[gameuid]))
-                    if tts_repair_merge:
-                        _ = copy.deepcopy(globalconfig["ttscommon"]["tts_repair_regex"])
-                        _this["tts_repair_regex"] += _
-                    if tts_skip_merge:
-                        _ = copy.deepcopy(globalconfig["ttscommon"]["tts_skip_regex"])
-                        _this["tts_skip_regex"] += _
-                    return _this
-                return savehook_new_data[gameuid]
-        except:
-            pass
-        return globalconfig["ttscommon"]
-
     def ttsprocess(self, path, text):
         path1 = gobject.getconfig("posts/{}.py".format(path))
         if not os.path.exists(path1):
             return text
         return checkmd5reloadmodule(path1, "posts." + path).POSTSOLVE(text)
 
-    def ttsrepair(self, text, usedict: dict):
-        if usedict.get("tts_repair", False):
-            if usedict.get("ttsprocess_use", False):
+    def ttsrepair(self, text, rules: ttsrules):
+        if rules.repair:
+            if rules.process:
                 try:
-                    text = self.ttsprocess(usedict.get("ttsprocess_path"), text)
+                    text = self.ttsprocess(rules.processpath, text)
                 except:
                     print_exc()
-            text = parsemayberegexreplace(usedict.get("tts_repair_regex", []), text)
+            text = rules.replace(text)
         return text
 
-    def matchwhich(self, dic: "dict[str, dict[str, str]]", res: str, isorigin: bool):
-
-        for item in dic:
-            range_ = item.get("range", 0)
-            if range_ and ((range_ == 1) ^ isorigin):
-                continue
-            if item["regex"]:
-                retext = safe_escape(item["key"])
-                if item["condition"] == 1:
-                    if re.search(retext, res):
-                        return item
-                elif item["condition"] == 0:
-                    if re.match(retext, res) or re.search(retext + "[\n\r]*$", res):
-                        # 用^xxx|xxx$有可能有点危险
-                        return item
-            else:
-                if item["condition"] == 1:
-                    if (
-                        res.isascii()
-                        and item["key"].isascii()
-                        and (" " not in item["key"])
-                    ):  # 目标可能有空格
-                        resx = res.split(" ")
-                        for i in range(len(resx)):
-                            if resx[i] == item["key"]:
-                                return item
-                    else:
-                        if item["key"] in res:
-                            return item
-                elif item["condition"] == 0:
-                    if res.startswith(item["key"]) or res.rstrip("\n\r").endswith(
-                        item["key"]
-                    ):
-                        return item
-        return None
-
-    def ttsskip(self, text, usedict, isorigin) -> dict:
-        if usedict.get("tts_skip", False):
-            return self.matchwhich(usedict.get("tts_skip_regex", []), text, isorigin)
-        return None
-
-    @threader
-    def readcurrent(self, force=False):
-        if (not force) and (not globalconfig["autoread"]):
-            return
-        text1 = self.currentread
-        if not text1:
-            return
-        matchitme = self.ttsskip(text1, self.__usewhich(), self.latest_is_origin)
+    def ttsresolve(self, text1, isorigin, force=False):
+        # -> (reader, 修正后的文本)，跳过时为None
+        rules = getttsrules(self.gameuid)
+        matchitme = rules.match(text1, isorigin)
         reader = None
         if matchitme is None:
             reader = self.reader
@@ -898,7 +877,7 @@ class BASEOBJECT(QObject):
                 reader = self.reader
             elif target == "skip":
                 if not force:
-                    return
+                    return None
                 reader = self.reader
             else:
                 engine, voice, _ = target
@@ -914,8 +893,32 @@ class BASEOBJECT(QObject):
                         reader = self.reader
                         self.specialreaders[key] = -1
         if reader is None:
+            return None
+        return reader, self.ttsrepair(text1, rules)
+
+    def ttsprefetch_trans(self, classname, res: str):
+        # 首选翻译器的流式输出每完成一句，就预先合成到这一句为止的译文。
+        # 输出结束时通常以句末标点结尾，最终要朗读的文本往往已经在合成中了
+        if not (
+            globalconfig["ttsprefetch"]
+            and globalconfig["autoread"]
+            and globalconfig["read_trans"]
+            and globalconfig["toppest_translator"] == classname
+        ):
+            return
+        self.ttsprefetcher.put("trans", completedprefix(res), False)
+
+    @threader
+    def readcurrent(self, force=False):
+        if (not force) and (not globalconfig["autoread"]):
+            return
+        text1 = self.currentread
+        if not text1:
+            return
+        _ = self.ttsresolve(text1, self.latest_is_origin, force)
+        if not _:
             return
-        text2 = self.ttsrepair(text1, self.__usewhich())
+        reader, text2 = _
         self.audioplayer.timestamp = uuid.uuid4()
         reader.read(text2, force, self.audioplayer.timestamp)
 
@@ -5,6 +5,7 @@ from traceback import print_exc
 from myutils.commonbase import commonbase
 import uuid
 import inspect
+import types
 from tinycss2 import parse_stylesheet, serialize
 from tinycss2.ast import (
     WhitespaceToken,
@@ -34,6 +35,14 @@ class DictionaryRoot(DictTree):
     def tips(self) -> str: ...
 
 
+class dictsection:
+    # 流式查询中新完成的一部分结果。html的顶层元素带有排序键，
+    # 由已经显示的结果页面中的insertdictsection(root, html)插入到对应的位置
+    def __init__(self, sortkey, html: str):
+        self.sortkey = sortkey
+        self.html = html
+
+
 class cishubase(commonbase):
     backgroundparser = ""
     use_github_md_css = False
@@ -75,7 +84,9 @@ class cishubase(commonbase):
     _setting_dict = globalconfig["cishu"]
 
     @threader
-    def safesearch(self, callback, word, sentence=None):
+    def safesearch(self, callback, word, sentence=None, partial=None):
+        # search可以是生成器：第一次yield只含第一部分的完整结果，之后每次yield一个dictsection，
+        # 生成器的返回值为完整的最终结果。中间结果交给partial（不传则忽略），callback总是只调用一次。
         if self.needinit:
             self.init()
             self.needinit = False
@@ -87,6 +98,8 @@ class cishubase(commonbase):
                 return
         try:
             res = self.multiapikeywrapper(self.search_XX)(word, sentence)
+            if isinstance(res, types.GeneratorType):
+                res = self.__consumestream(res, partial)
         except:
             print_exc()
             self.needinit = True
@@ -98,6 +111,15 @@ class cishubase(commonbase):
         else:
             callback(None)
 
+    def __consumestream(self, stream, partial):
+        while True:
+            try:
+                _ = next(stream)
+            except StopIteration as e:
+                return e.value
+            if _ and partial:
+                partial(_)
+
     def __parseaqr(self, rule: QualifiedRule, divclass):
         start = True
         idx = 0
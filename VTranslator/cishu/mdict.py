@@ -1,13 +1,150 @@
-import base64, uuid, gobject
+import uuid, gobject
 from cishu.cishubase import DictTree, DictionaryRoot
 from traceback import print_exc
 from myutils.audioplayer import bass_code_cast
 import json, os, re
 from cishu.mdict_.readmdict import MDX, MDD, MDict
-import hashlib, sqlite3, functools
+from cishu.mdict_ import indexer
+import hashlib, sqlite3, functools, threading, sys, multiprocessing
+from array import array
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    ProcessPoolExecutor,
+    wait as waitfutures,
+    as_completed,
+)
 import NativeUtils
 from myutils.mimehelper import query_mime
 from myutils.config import _TR
+from myutils.utils import LRUCache
+from urllib.parse import urlencode, urlsplit, parse_qsl
+from network.server.tcpservice import (
+    HTTPHandler,
+    TCPService,
+    RequestInfo,
+    ResponseWithHeader,
+)
+
+
+class sqlitereadpool:
+    # 每个索引库一个只读连接池，连接在查询间复用（sqlite3会按连接缓存预编译的语句），
+    # 取出的连接只被一个线程使用，用完放回。
+    __pools = {}  # type: dict[str, sqlitereadpool]
+    __lock = threading.Lock()
+
+    @staticmethod
+    def get(db: str) -> "sqlitereadpool":
+        with sqlitereadpool.__lock:
+            pool = sqlitereadpool.__pools.get(db)
+            if pool is None:
+                pool = sqlitereadpool.__pools[db] = sqlitereadpool(db)
+            return pool
+
+    def __init__(self, db: str):
+        self.db = db
+        self.lock = threading.Lock()
+        self.idle = []  # type: list[sqlite3.Connection]
+
+    def __acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        conn = sqlite3.connect(self.db, check_same_thread=False)
+        conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    def __release(self, conn: sqlite3.Connection):
+        with self.lock:
+            self.idle.append(conn)
+
+    def query(self, sql: str, params=()) -> list:
+        conn = self.__acquire()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            self.__release(conn)
+
+    def close(self):
+        # 重建索引前必须关闭，否则无法删除被占用的文件
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            conn.close()
+
+
+class indexbuildpool:
+    # 一次加载中需要重建的索引并行建立。解码键块是纯Python的CPU开销，所以优先用进程池；
+    # 运行环境不是普通的python解释器（无法spawn子进程）或创建失败时退回线程池。
+    def __init__(self):
+        self.executor = None
+        self.isprocess = False
+        self.queue = None
+        self.futures = []  # type: list[Future]
+        self.progress = {}  # type: dict[str, tuple[int, int]]
+
+    def __create(self):
+        workers = max(1, min(4, os.cpu_count() or 1))
+        if os.path.basename(sys.executable).lower().startswith("python"):
+            try:
+                ctx = multiprocessing.get_context("spawn")
+                self.queue = ctx.Queue()
+                self.executor = ProcessPoolExecutor(
+                    workers,
+                    mp_context=ctx,
+                    initializer=indexer.initworker,
+                    initargs=(self.queue,),
+                )
+                self.isprocess = True
+                threading.Thread(target=self.__readprogress, daemon=True).start()
+                return
+            except:
+                print_exc()
+        self.executor = ThreadPoolExecutor(workers)
+
+    def __readprogress(self):
+        while True:
+            _ = self.queue.get()
+            if _ is None:
+                break
+            db_name, done, total = _
+            self.setprogress(db_name, done, total)
+
+    def setprogress(self, db_name, done, total):
+        self.progress[db_name] = done, total
+
+    def submit(self, fname, db_name, ismdx) -> Future:
+        if not self.executor:
+            self.__create()
+        self.progress[db_name] = 0, 0
+        if self.isprocess:
+            future = self.executor.submit(
+                indexer.build_index_worker, fname, db_name, ismdx
+            )
+        else:
+            future = self.executor.submit(
+                indexer.build_index,
+                fname,
+                db_name,
+                ismdx,
+                functools.partial(self.setprogress, db_name),
+            )
+        future.add_done_callback(lambda _: self.progress.pop(db_name, None))
+        self.futures.append(future)
+        return future
+
+    def finish(self):
+        # 不再提交新任务，已提交的完成后工作进程自动退出
+        if not self.executor:
+            return
+        self.executor.shutdown(wait=False)
+        if self.queue:
+            threading.Thread(target=self.__closequeue, daemon=True).start()
+
+    def __closequeue(self):
+        waitfutures(self.futures)
+        self.queue.put(None)
 
 
 class IndexBuilder(object):
@@ -35,9 +172,13 @@ class IndexBuilder(object):
         fname,
         passcode=None,
         enable_history=False,
+        pool: indexbuildpool = None,
     ):
 
         self._mdx_file = fname
+        self._pool = pool
+        self._hasfuzzy = None
+        self._lookupcache = LRUCache(256)
         self._mdict_mdds = []
         self._mdd_dbs = []
         _filename, _file_extension = os.path.splitext(fname)
@@ -50,11 +191,38 @@ class IndexBuilder(object):
             + hashlib.md5(_filename.encode("utf8")).hexdigest()
         )
         _targetfilenamebase = gobject.getcachedir("mdict/index/" + _mdxmd5)
-        self._mdx_db = _targetfilenamebase + ".mdx.v3.db"
+        self._mdx_db = _targetfilenamebase + ".mdx.v4.db"
         # make index anyway
-
-        self._make_mdx_index_checked(self._mdx_db)
-        self.makemdds(_filename, _targetfilenamebase)
+        # 有pool时索引在后台建立：MDX的索引由调用者等待完成，MDD的索引各自完成后才参与查询
+        self._mdx_ready = self._make_mdx_index_checked(self._mdx_db)
+        self._mdd_ready = []  # type: list[Future]
+        self._mddsargs = _filename, _targetfilenamebase
+        if not pool:
+            self.startmdds()
+
+    def startmdds(self):
+        # 使用pool时由调用者在所有MDX都提交之后再调用，让MDX的索引排在前面
+        self.makemdds(*self._mddsargs)
+
+    def wait_mdx_index(self):
+        self._mdx_ready.result()
+
+    def mdd_usable(self, i):
+        _ = self._mdd_ready[i]
+        return _.done() and (_.exception() is None)
+
+    def indexprogress(self):
+        # -> [(文件名, 已完成条目, 总条目)]
+        if not self._pool:
+            return []
+        result = []
+        for fname, db in [(self._mdx_file, self._mdx_db)] + list(
+            zip((_._fname for _ in self._mdict_mdds), self._mdd_dbs)
+        ):
+            _ = self._pool.progress.get(db)
+            if _:
+                result.append((fname,) + _)
+        return result
 
     def makemdds(self, _filename, _targetfilenamebase):
         i = 0
@@ -65,65 +233,44 @@ class IndexBuilder(object):
             if os.path.isfile(_filename + end):
                 mdd = MDD(_filename + end)
                 self._mdict_mdds.append(mdd)
-                self._mdd_dbs.append(_targetfilenamebase + end + ".v3.db")
-                self._make_mdd_index_checked(mdd, self._mdd_dbs[-1])
+                self._mdd_dbs.append(_targetfilenamebase + end + ".v4.db")
+                self._mdd_ready.append(
+                    self._make_mdd_index_checked(mdd, self._mdd_dbs[-1])
+                )
             else:
                 break
 
     def _make_mdd_index_checked(self, mdd: MDD, db_name):
-        if self.checkneedupdate(mdd._fname, db_name):
-            self._make_mdict_index(mdd, db_name, False)
-            self.checkneedupdateafter(mdd._fname, db_name)
+        return self._make_index_checked(mdd._fname, db_name, False)
 
     def _make_mdx_index_checked(self, db_name):
-        if self.checkneedupdate(self._mdx_file, db_name):
-            self._make_mdict_index(self._mdict, db_name, True)
-            self.checkneedupdateafter(self._mdx_file, db_name)
-
-    def _make_mdict_index(self, mdd: MDict, db_name, ismdx):
-        if os.path.exists(db_name):
-            os.remove(db_name)
-        mdd._key_list = mdd._read_keys()
-        index_list = list(mdd.items())
-        conn = sqlite3.connect(db_name)
-        c = conn.cursor()
-        c.execute(
-            """ CREATE TABLE MDX_INDEX
-               (key_text text not null{},
-                file_pos integer,
-                compressed_size integer,
-                decompressed_size integer,
-                record_start integer,
-                record_end integer,
-                offset integer
-                )""".format(
-                " unique" if (not ismdx) else ""
-            )
-        )
-        tuple_list = [
-            (
-                item["key_text"],
-                item["file_pos"],
-                item["compressed_size"],
-                item["decompressed_size"],
-                item["record_start"],
-                item["record_end"],
-                item["offset"],
-            )
-            for item in index_list
-        ]
-        c.executemany("INSERT INTO MDX_INDEX VALUES (?,?,?,?,?,?,?)", tuple_list)
-
-        c.execute(
-            """
-                CREATE{} INDEX key_index ON MDX_INDEX (key_text)
-                """.format(
-                " UNIQUE" if (not ismdx) else ""
-            )
-        )
+        return self._make_index_checked(self._mdx_file, db_name, True)
+
+    def _make_index_checked(self, fname, db_name, ismdx) -> Future:
+        if not self.checkneedupdate(fname, db_name):
+            future = Future()
+            future.set_result(None)
+            return future
+        # 替换索引文件前先关闭已打开的连接
+        sqlitereadpool.get(db_name).close()
+        if self._pool:
+            future = self._pool.submit(fname, db_name, ismdx)
+        else:
+            future = Future()
+            try:
+                future.set_result(indexer.build_index(fname, db_name, ismdx))
+            except Exception as e:
+                future.set_exception(e)
 
-        conn.commit()
-        conn.close()
+        def __after(future: Future):
+            if future.exception() is None:
+                self.checkneedupdateafter(fname, db_name)
+            else:
+                print(fname)
+                print(future.exception())
+
+        future.add_done_callback(__after)
+        return future
 
     def get_mdx_by_index(self, index):
         data = self._mdict.read_records(index)
@@ -131,24 +278,26 @@ class IndexBuilder(object):
         return record
 
     def lookup_indexes(self, db, keyword, ignorecase=None):
-        indexes = []
+        # 弹窗查词时同一个词/资源会被反复查询，大部分MDD也查不到结果，结果（包括空结果）都缓存下来
+        key = db, keyword, bool(ignorecase)
+        indexes = self._lookupcache.get(key)
+        if indexes is not None:
+            return indexes
         if ignorecase:
-            sql = 'SELECT * FROM MDX_INDEX WHERE lower(key_text) = lower("{}")'.format(
-                keyword
-            )
+            sql = "SELECT * FROM MDX_INDEX WHERE lower(key_text) = lower(?)"
         else:
-            sql = 'SELECT * FROM MDX_INDEX WHERE key_text = "{}"'.format(keyword)
-        with sqlite3.connect(db) as conn:
-            cursor = conn.execute(sql)
-            for result in cursor:
-                index = {}
-                index["file_pos"] = result[1]
-                index["compressed_size"] = result[2]
-                index["decompressed_size"] = result[3]
-                index["record_start"] = result[4]
-                index["record_end"] = result[5]
-                index["offset"] = result[6]
-                indexes.append(index)
+            sql = "SELECT * FROM MDX_INDEX WHERE key_text = ?"
+        indexes = []
+        for result in sqlitereadpool.get(db).query(sql, (keyword,)):
+            index = {}
+            index["file_pos"] = result[1]
+            index["compressed_size"] = result[2]
+            index["decompressed_size"] = result[3]
+            index["record_start"] = result[4]
+            index["record_end"] = result[5]
+            index["offset"] = result[6]
+            indexes.append(index)
+        self._lookupcache.put(key, indexes)
         return indexes
 
     def mdx_lookup(self, keyword, ignorecase=None):
@@ -161,11 +310,22 @@ class IndexBuilder(object):
     def mdd_lookup(self, keyword, ignorecase=None):
         lookup_result_list = []
         for i in range(len(self._mdict_mdds)):
+            if not self.mdd_usable(i):
+                continue
             indexes = self.lookup_indexes(self._mdd_dbs[i], keyword, ignorecase)
             for index in indexes:
                 lookup_result_list.append(self._mdict_mdds[i].read_records(index))
         return lookup_result_list
 
+    def mdd_has(self, keyword):
+        # 只查索引，不读取记录
+        for i in range(len(self._mdict_mdds)):
+            if not self.mdd_usable(i):
+                continue
+            if self.lookup_indexes(self._mdd_dbs[i], keyword):
+                return True
+        return False
+
     @staticmethod
     def get_keys(db, query=""):
         if not db:
@@ -175,17 +335,74 @@ class IndexBuilder(object):
                 query = query.replace("*", "%")
             else:
                 query = query + "%"
-            sql = 'SELECT key_text FROM MDX_INDEX WHERE key_text LIKE "' + query + '"'
+            result = sqlitereadpool.get(db).query(
+                "SELECT key_text FROM MDX_INDEX WHERE key_text LIKE ?", (query,)
+            )
+        else:
+            result = sqlitereadpool.get(db).query("SELECT key_text FROM MDX_INDEX")
+        return [item[0] for item in result]
+
+    def hasfuzzyindex(self):
+        if self._hasfuzzy is None:
+            self._hasfuzzy = bool(
+                sqlitereadpool.get(self._mdx_db).query(
+                    "SELECT name FROM sqlite_master WHERE type='table' AND name='FUZZY_GRAM'"
+                )
+            )
+        return self._hasfuzzy
+
+    def fuzzy_keys(self, word: str, maxdist: int):
+        # 编辑距离不超过maxdist的词头 -> [(distance, key_text)]，按距离升序
+        # 两端补\0后长度为n的词有n+1个二元组，每次编辑最多破坏2个，所以只要取查询词中最稀有的2*maxdist+1个不同二元组，
+        # 其倒排表的并集就包含了全部结果；再按长度过滤并计算真实距离。
+        word = word.lower()
+        n = len(word)
+        minlen, maxlen = max(1, n - maxdist), n + maxdist
+        pool = sqlitereadpool.get(self._mdx_db)
+        grams = set(indexer.grams(word))
+        need = 2 * maxdist + 1
+        if need > len(grams):
+            rows = pool.query(
+                "SELECT key_text FROM FUZZY_KEY WHERE len BETWEEN ? AND ?",
+                (minlen, maxlen),
+            )
         else:
-            sql = "SELECT key_text FROM MDX_INDEX"
-        with sqlite3.connect(db) as conn:
-            cursor = conn.execute(sql)
-            keys = [item[0] for item in cursor]
-            return keys
+            grams = list(grams)
+            postings = dict(
+                pool.query(
+                    "SELECT gram, ids FROM FUZZY_GRAM WHERE gram IN ({})".format(
+                        ",".join("?" * len(grams))
+                    ),
+                    grams,
+                )
+            )
+            ids = set()
+            for gram in sorted(grams, key=lambda g: len(postings.get(g, b"")))[:need]:
+                if gram in postings:
+                    ids.update(array("i", postings[gram]))
+            ids = list(ids)
+            rows = []
+            for i in range(0, len(ids), 900):
+                chunk = ids[i : i + 900]
+                rows += pool.query(
+                    "SELECT key_text FROM FUZZY_KEY WHERE id IN ({}) AND len BETWEEN ? AND ?".format(
+                        ",".join("?" * len(chunk))
+                    ),
+                    chunk + [minlen, maxlen],
+                )
+        result = []
+        for (key,) in rows:
+            dis = NativeUtils.distance(key.lower(), word)
+            if dis <= maxdist:
+                result.append((dis, key))
+        result.sort()
+        return result
 
     def get_mdd_keys(self, query=""):
         _ = []
-        for f in self._mdd_dbs:
+        for i, f in enumerate(self._mdd_dbs):
+            if not self.mdd_usable(i):
+                continue
             _.extend(self.get_keys(f, query))
         return _
 
@@ -193,10 +410,90 @@ class IndexBuilder(object):
         return self.get_keys(self._mdx_db, query)
 
 
-from cishu.cishubase import cishubase
+from cishu.cishubase import cishubase, dictsection
 import re
 
 
+class mddresource(HTTPHandler):
+    # 词典html中的图片、字体、音频等不再内联为base64，而是换成本地服务的地址，由webview按需请求。
+    # token由词典文件的路径和修改时间决定，同一个地址的内容不会变，可以让浏览器长期缓存。
+    path = "/api/mdict/resource"
+    method = "GET"
+    # token -> (mdict, 词典路径, IndexBuilder)。每次查询都会重新登记用到的词典
+    __dicts = LRUCache(256)
+    # 只提供渲染词典结果时生成过的地址，不接受任意拼出来的路径；只保留最近的一部分
+    __urls = LRUCache(0x10000)
+    __service = None  # type: TCPService
+    __lock = threading.Lock()
+
+    @staticmethod
+    def register(ref: "mdict", f: str, index: "IndexBuilder") -> str:
+        token = hashlib.md5(
+            "{}\0{}".format(os.path.abspath(f), os.path.getmtime(f)).encode("utf8")
+        ).hexdigest()[:16]
+        mddresource.__dicts.put(token, (ref, f, index))
+        return token
+
+    @staticmethod
+    def origin():
+        # 首次使用时在回环地址上单独启动一个服务，与用户是否开启网络服务无关
+        with mddresource.__lock:
+            if mddresource.__service is None:
+                service = TCPService()
+                service.register(mddresource)
+                service.init(0, "127.0.0.1")
+                mddresource.__service = service
+            return "http://127.0.0.1:{}".format(mddresource.__service.port)
+
+    @staticmethod
+    def relative(html: str) -> str:
+        # 网络服务返回的结果：把回环地址上的资源地址换成相对路径，由网络服务自己提供，局域网中的其他设备也能访问
+        with mddresource.__lock:
+            if mddresource.__service is None:
+                return html
+            origin = "http://127.0.0.1:{}".format(mddresource.__service.port)
+        return html.replace(origin + mddresource.path, mddresource.path)
+
+    @staticmethod
+    def url(token: str, url: str, issound=False):
+        mddresource.__urls.put((token, url, bool(issound)))
+        query = {"d": token, "u": url}
+        if issound:
+            query["s"] = 1
+        return mddresource.origin() + mddresource.path + "?" + urlencode(query)
+
+    @staticmethod
+    def load(url: str):
+        # 给webview的绑定函数直接读取，不经过http
+        # -> (bytes, mime) / None
+        return mddresource.__load(dict(parse_qsl(urlsplit(url).query)))
+
+    @staticmethod
+    def __load(query: dict):
+        token, url, issound = query.get("d"), query.get("u", ""), bool(query.get("s"))
+        if not mddresource.__urls.get((token, url, issound)):
+            return
+        _ = mddresource.__dicts.get(token)
+        if not _:
+            return
+        ref, f, index = _
+        return ref.loadresource(index, os.path.dirname(f), url, issound)
+
+    def parse(self, info: RequestInfo):
+        etag = '"{}"'.format(hashlib.md5(info.rawpath.encode("utf8")).hexdigest())
+        headers = {
+            "ETag": etag,
+            "Cache-Control": "public, max-age=31536000, immutable",
+        }
+        if info.headers.get("If-None-Match") == etag:
+            return ResponseWithHeader(b"", headers, 304)
+        res = self.__load(info.query)
+        if not res:
+            raise Exception()
+        data, headers["Content-Type"] = res
+        return ResponseWithHeader(data, headers)
+
+
 class mdict(cishubase):
     def getdistance(self, f):
         _ = self.extraconf[f]
@@ -244,7 +541,7 @@ class mdict(cishubase):
         )  # None是使用默认显示名，否则使用自定义显示名
         if os.path.exists(f):
             try:
-                index = IndexBuilder(f)
+                index = IndexBuilder(f, pool=self.indexpool)
 
                 self.builders.append((f, index))
 
@@ -256,6 +553,27 @@ class mdict(cishubase):
     def checkpath(self):
         self.builders = []
         self.dedump = set()
+        self.indexpool = indexbuildpool()
+        self.__checkpath()
+        for f, index in self.builders:
+            try:
+                index.startmdds()
+            except:
+                print(f)
+                print_exc()
+        self.indexpool.finish()
+        # 所有MDX的索引并行建立，全部完成后即可查询；MDD的索引在后台继续建立
+        builders = []
+        for f, index in self.builders:
+            try:
+                index.wait_mdx_index()
+                builders.append((f, index))
+            except:
+                print(f)
+                print_exc()
+        self.builders = builders
+
+    def __checkpath(self):
         for f in self.config["paths"]:
             if not f.strip():
                 continue
@@ -295,6 +613,10 @@ class mdict(cishubase):
 
         if not distance:
             return sorted(index.get_mdx_keys(word))[: self.config["max_num"]]
+        if index.hasfuzzyindex():
+            return [k for _, k in index.fuzzy_keys(word, distance)][
+                : self.config["max_num"]
+            ]
         results = []
         diss = {}
         dedump = set()
@@ -308,57 +630,80 @@ class mdict(cishubase):
                 diss[k] = dis
         return sorted(results, key=lambda x: diss[x])[: self.config["max_num"]]
 
-    def parse_url_in_mdd(self, index: IndexBuilder, url1: str):
+    @staticmethod
+    def mddkey(url1: str):
         url1 = url1.replace("/", "\\")
         if not url1.startswith("\\"):
             if url1.startswith("."):
                 url1 = url1[1:]
             else:
                 url1 = "\\" + url1
-        find = index.mdd_lookup(url1)
+        return url1
+
+    def parse_url_in_mdd(self, index: IndexBuilder, url1: str):
+        find = index.mdd_lookup(self.mddkey(url1))
         if not find:
             return None
         return find[0]
 
-    def tryloadurl(self, index: IndexBuilder, base, url: str, audiob64vals: dict):
-        _local = os.path.join(base, url)
-        iscss = url.lower().endswith(".css")
-        _type = 0
-        file_content = None
-        if iscss:
-            _type = 1
-        if os.path.exists(_local) and os.path.isfile(_local):
-            with open(os.path.join(base, url), "rb") as f:
-                file_content = f.read()
-            return _type, file_content
+    @staticmethod
+    def localpath(base: str, url: str):
+        # 词典目录下的文件，绝对路径、盘符以及../跳出词典目录的都不接受
+        if not url or os.path.isabs(url) or os.path.splitdrive(url)[0]:
+            return None
+        base = os.path.abspath(base)
+        path = os.path.normpath(os.path.join(base, url))
+        if os.path.commonpath([base, path]) != base:
+            return None
+        return path
 
-        if url.startswith("entry://"):
-            return 3, "javascript:safe_mdict_search_word('{}')".format(url[8:])
-        if url.startswith("sound://"):
-            file_content = self.parse_url_in_mdd(index, url[8:])
+    def loadresource(self, index: IndexBuilder, base, url: str, issound=False):
+        # -> (bytes, mime) / None
+        if issound:
+            file_content = self.parse_url_in_mdd(index, url)
             if not file_content:
                 return
             ext = os.path.splitext(url)[1].lower()[1:]
             if True:  # ext in ("aac", "spx", "opus"):
-                new, ext = bass_code_cast(file_content, fr=ext)
-                file_content = new
-            varname = "var_" + hashlib.md5(file_content).hexdigest()
-            audiob64vals[varname] = base64.b64encode(file_content).decode()
-            return 3, "javascript:mdict_play_sound('{}',{})".format(
-                query_mime(ext), varname
-            )
+                file_content, ext = bass_code_cast(file_content, fr=ext)
+            return file_content, query_mime(ext)
+        _local = self.localpath(base, url)
+        if _local and os.path.isfile(_local):
+            with open(_local, "rb") as f:
+                return f.read(), query_mime(url)
         file_content = self.parse_url_in_mdd(index, url)
         if not file_content:
             return
-        return _type, file_content
+        return file_content, query_mime(url)
+
+    def tryloadurl(self, index: IndexBuilder, base, url: str, token: str):
+        # 只有css需要读出来加上作用域后内联，其他资源都换成本地服务的地址，由webview按需加载
+        if url.startswith("entry://"):
+            return 3, "javascript:safe_mdict_search_word('{}')".format(url[8:])
+        if url.startswith("sound://"):
+            if not index.mdd_has(self.mddkey(url[8:])):
+                return
+            return 3, "javascript:mdict_play_sound('{}')".format(
+                mddresource.url(token, url[8:], True)
+            )
+        if not url.lower().endswith(".css"):
+            _local = self.localpath(base, url)
+            if not (
+                (_local and os.path.isfile(_local)) or index.mdd_has(self.mddkey(url))
+            ):
+                return
+            return 3, mddresource.url(token, url)
+        file_content = self.loadresource(index, base, url)
+        if not file_content:
+            return
+        return 1, file_content[0]
 
     def subcallback(
         self,
         index,
         fn,
         base,
-        audiob64vals: dict,
-        hrefsrcvals: dict,
+        token: str,
         divclass: str,
         csscollect: dict,
         match: re.Match,
@@ -367,9 +712,8 @@ class mdict(cishubase):
         matchall: str = match.group()
         if url.startswith("#") or url.startswith("https:") or url.startswith("http:"):
             return matchall
-        _type_1 = matchall.split("=")[0]
         try:
-            file_content = self.tryloadurl(index, base, url, audiob64vals)
+            file_content = self.tryloadurl(index, base, url, token)
         except:
             print_exc()
             print("unknown", fn, url)
@@ -391,14 +735,6 @@ class mdict(cishubase):
                 return None
             else:
                 return matchall
-        elif _type == 0:
-            varname = "var_" + hashlib.md5(file_content).hexdigest()
-            hrefsrcvals[varname] = (
-                _type_1,
-                query_mime(url),
-                base64.b64encode(file_content).decode(),
-            )
-            return matchall.replace(url, varname)
 
         return matchall
 
@@ -407,8 +743,7 @@ class mdict(cishubase):
         index,
         fn,
         html_content: str,
-        audiob64vals: dict,
-        hrefsrcvals: dict,
+        token: str,
         divclass: str,
         csscollect: dict,
     ):
@@ -418,8 +753,7 @@ class mdict(cishubase):
             index,
             fn,
             base,
-            audiob64vals,
-            hrefsrcvals,
+            token,
             divclass,
             csscollect,
         )
@@ -484,8 +818,9 @@ class mdict(cishubase):
         expanded_text = pattern.sub(replace_match, text)
         return expanded_text
 
-    def searchthread(self, allres, i, word, audiob64vals, hrefsrcvals):
-        f, index = self.builders[i]
+    def searchthread(self, f, index: IndexBuilder, word):
+        # 在查询线程池中运行
+        # -> (priority, foldflow, title, html) / None
         results = []
         __safe = []
         try:
@@ -511,9 +846,10 @@ class mdict(cishubase):
             return
         divclass = "v_" + str(uuid.uuid4())
         csscollect = {}
+        token = mddresource.register(self, f, index)
         for i in range(len(results)):
             results[i] = self.repairtarget(
-                index, f, results[i], audiob64vals, hrefsrcvals, divclass, csscollect
+                index, f, results[i], token, divclass, csscollect
             )
         collectresult = "".join(results)
         if csscollect:
@@ -521,36 +857,61 @@ class mdict(cishubase):
             for css in csscollect.values():
                 collectresult += css + "\n"
             collectresult += "</style>\n"
-        allres.append(
-            (
-                self.getpriority(f),
-                self.getFoldFlow(f),
-                self.gettitle(f, index),
-                collectresult,
-            )
+        return (
+            self.getpriority(f),
+            self.getFoldFlow(f),
+            self.gettitle(f, index),
+            collectresult,
+        )
+
+    # 每个词典的结果为一个section：((-priority, 加载顺序), foldflow, title, html, uid)。
+    # section的各个元素带有data-part和排序键，流式查询中后完成的section由页面中的insertdictsection插入到对应的位置。
+    @staticmethod
+    def sectionattrs(section, part):
+        (priority, order), _, __, ___, ____ = section
+        return 'data-part="{}" data-priority="{}" data-order="{}"'.format(
+            part, -priority, order
         )
 
+    def tabswitchsection(self, section, active):
+        _, foldflow, title, res, uid = section
+        klass2 = "tab-pane_mdict_internal"
+        klass1 = "tab-button_mdict_internal"
+        if active:
+            klass2 += " active"
+            klass1 += " active"
+        btn = """<button type="button" onclick="onclickbtn_mdict_internal('buttonid_mdict_internal{idx}')" id="buttonid_mdict_internal{idx}" class="{klass}" data-tab="tab_mdict_internal{idx}" {attrs}>{title}</button>""".format(
+            idx=uid, title=title, klass=klass1, attrs=self.sectionattrs(section, "btn")
+        )
+        content = """<div id="tab_mdict_internal{idx}" class="{klass}" {attrs}>{res}</div>""".format(
+            idx=uid, res=res, klass=klass2, attrs=self.sectionattrs(section, "pane")
+        )
+        return btn, content
+
+    def flowsection(self, section):
+        _, foldflow, title, res, uid = section
+        extra = "display: block;"
+        if foldflow:
+            extra = "display: none;"
+        return r"""<div {}><div class="collapsible-header" id="{}" onclick="mdict_flowstyle_clickcallback('{}')">{}</div><div class="collapsible-content" style="{}">
+               {}
+            </div></div>""".format(
+            self.sectionattrs(section, "flow"), uid, uid, title, extra, res
+        )
+
+    def generatesection(self, section):
+        if self.config["stylehv"] == 0:
+            return "".join(self.tabswitchsection(section, False))
+        elif self.config["stylehv"] == 1:
+            return self.flowsection(section)
+
     def generatehtml_tabswitch(self, allres):
         btns = []
         contents = []
-        idx = 0
-        for _, foldflow, title, res in allres:
-            klass2 = "tab-pane_mdict_internal"
-            klass1 = "tab-button_mdict_internal"
-            if idx == 0:
-                klass2 += " active"
-                klass1 += " active"
-            btns.append(
-                """<button type="button" onclick="onclickbtn_mdict_internal('buttonid_mdict_internal{idx}')" id="buttonid_mdict_internal{idx}" class="{klass}" data-tab="tab_mdict_internal{idx}">{title}</button>""".format(
-                    idx=idx, title=title, klass=klass1
-                )
-            )
-            contents.append(
-                """<div id="tab_mdict_internal{idx}" class="{klass}">{res}</div>""".format(
-                    idx=idx, res=res, klass=klass2
-                )
-            )
-            idx += 1
+        for idx, section in enumerate(allres):
+            btn, content = self.tabswitchsection(section, idx == 0)
+            btns.append(btn)
+            contents.append(content)
         res = """
 <script>
 function onclickbtn_mdict_internal(_id) {
@@ -601,12 +962,12 @@ function onclickbtn_mdict_internal(_id) {
 </style>"""
         res += """
 <div class="tab-widget_mdict_internal">
-    <div class="centerdiv_mdict_internal"><div>
+    <div class="centerdiv_mdict_internal"><div class="mdict_sections_internal" data-part="btn">
         {btns}
     </div>
     </div>
     <div>
-        <div class="tab-content_mdict_internal">
+        <div class="tab-content_mdict_internal mdict_sections_internal" data-part="pane">
             {contents}
         </div>
     </div>
@@ -647,22 +1008,9 @@ if (content.style.display === 'block') {
 if(window.VJSObject)
         VJSObject.mdict_fold_callback(_id,content.style.display)
 }</script>"""
-        lis = []
-
-        for _, foldflow, title, res in allres:
-            extra = "display: block;"
-            if foldflow:
-                extra = "display: none;"
-            uid = str(uuid.uuid4())
-            lis.append(
-                r"""<div><div class="collapsible-header" id="{}" onclick="mdict_flowstyle_clickcallback('{}')">{}</div><div class="collapsible-content" style="{}">
-               {}
-            </div></div>""".format(
-                    uid, uid, title, extra, res
-                )
-            )
+        lis = [self.flowsection(section) for section in allres]
         content += r"""
-<div class="collapsible-list">
+<div class="collapsible-list mdict_sections_internal" data-part="flow">
          {}
     </div>""".format(
             "".join(lis)
@@ -670,32 +1018,68 @@ if(window.VJSObject)
 
         return content
 
+    _searchpool = None
+    _searchpoollock = threading.Lock()
+
+    @staticmethod
+    def searchpool():
+        # 所有mdict实例共用，限制同时查询的词典数
+        with mdict._searchpoollock:
+            if mdict._searchpool is None:
+                mdict._searchpool = ThreadPoolExecutor(
+                    max(1, min(8, os.cpu_count() or 1))
+                )
+            return mdict._searchpool
+
     def search(self, word):
-        allres = []
-        audiob64vals = {}
-        hrefsrcvals = {}
-        for i in range(len(self.builders)):
-            self.searchthread(allres, i, word, audiob64vals, hrefsrcvals)
-        if len(allres) == 0:
+        # 各个词典并行查询。第一个完成的词典yield只含它的完整html，之后每完成一个yield一个dictsection，
+        # 由页面按优先级插入；全部完成后返回包含所有词典结果的完整html。
+        builders = self.builders
+        if not builders:
             return
-        allres.sort(key=lambda _: -_[0])
+        pool = self.searchpool()
+        futures = {}
+        for i, (f, index) in enumerate(builders):
+            futures[pool.submit(self.searchthread, f, index, word)] = i
+        sections = []
+        try:
+            for future in as_completed(futures):
+                try:
+                    res = future.result()
+                except:
+                    print_exc()
+                    continue
+                if not res:
+                    continue
+                priority, foldflow, title, html = res
+                # 优先级相同时保持词典的加载顺序
+                sortkey = (-priority, futures[future])
+                section = (sortkey, foldflow, title, html, str(uuid.uuid4()))
+                if sections:
+                    yield dictsection(sortkey, self.generatesection(section))
+                else:
+                    yield self.generatehtml([section])
+                sections.append(section)
+        finally:
+            # 调用方不再需要结果时，取消还没开始的查询
+            for future in futures:
+                future.cancel()
+        if not sections:
+            return
+        sections.sort(key=lambda _: _[0])
+        return self.generatehtml(sections)
+
+    def generatehtml(self, allres):
         func = "<script>"
         func += """
-function replacelongvarsrcs(varval, varname)
-{
-let type=varval[0]
-let elements = document.querySelectorAll('['+type+'="'+varname+'"]');
-for(let i=0;i<elements.length;i++)
-    elements[i][type]="data:"+varval[1]+";base64," + varval[2]
-}
 var lastmusicplayer=false;
-function mdict_play_sound(ext, b64){
+function mdict_play_sound(url){
 
 if(window.VJSObject)
-        VJSObject.v_audio_play_b64(b64)
+        VJSObject.v_audio_play_url(url)
     else{
     const music = new Audio();
-    music.src="data:"+ext+";base64,"+b64
+    music.src=url
     if(lastmusicplayer!=false)
     {
         lastmusicplayer.pause()
@@ -707,14 +1091,24 @@ if(window.VJSObject)
 function safe_mdict_search_word(word){
    if(window.VJSObject)
         VJSObject.v_search_word(word)
+}
+function insertdictsection(root, html){
+    //流式查询中后完成的词典，按优先级（相同时按加载顺序）插入到对应的位置
+    const frag = document.createRange().createContextualFragment(html);
+    for (const el of Array.from(frag.children)) {
+        const box = root.querySelector('.mdict_sections_internal[data-part="' + el.dataset.part + '"]');
+        if (!box) continue;
+        let before = null;
+        for (const _ of box.children) {
+            const p1 = Number(el.dataset.priority), p2 = Number(_.dataset.priority);
+            if (p1 > p2 || (p1 == p2 && Number(el.dataset.order) < Number(_.dataset.order))) {
+                before = _;
+                break;
+            }
+        }
+        box.insertBefore(el, before);
+    }
 }"""
-        for varname, val in audiob64vals.items():
-            func += '{}="{}"\n'.format(varname, val)
-        func += "</script><script id='replacelongvarsrcs_1'>"
-        for varname, (_type, mime, val) in hrefsrcvals.items():
-            func += '{}=["{}","{}","{}"]\n'.format(varname, _type, mime, val)
-            func += 'replacelongvarsrcs({},"{}")\n'.format(varname, varname)
-        func += 'document.getElementById("replacelongvarsrcs_1").remove()'
         func += "</script>"
         if self.config["stylehv"] == 0:
             return self.generatehtml_tabswitch(allres) + func
@@ -732,7 +1126,7 @@ function safe_mdict_search_word(word){
                 self.ref = ref
 
             def tips(self):
-                return (
+                tips = (
                     self.text()
                     + "\n"
                     + self.f
@@ -740,6 +1134,13 @@ function safe_mdict_search_word(word){
                     + _TR("优先级")
                     + str(self.ref.getpriority(self.f))
                 )
+                for fname, done, total in self.index.indexprogress():
+                    tips += "\n{} {} {}".format(
+                        _TR("正在建立索引"),
+                        os.path.basename(fname),
+                        "{}/{}".format(done, total) if total else done,
+                    )
+                return tips
 
             def text(self):
                 return self.ref.gettitle(self.f, self.index)
@@ -0,0 +1,116 @@
+# 建立MDX/MDD的sqlite索引。只依赖readmdict，可以在进程池的子进程中运行。
+import os, sqlite3
+from array import array
+from cishu.mdict_.readmdict import MDX, MDD
+
+_progressqueue = None
+
+
+def initworker(queue):
+    global _progressqueue
+    _progressqueue = queue
+
+
+def build_index(fname: str, db_name: str, ismdx: bool, progress=None, batchsize=20000):
+    # 边读边写：键块逐个解码，记录块只读块头不解压，每batchsize行一个事务。
+    # 先写到临时文件，完成后再替换，中途失败不会留下不完整的索引。
+    # progress(done, total)，total未知时为0
+    md = MDX(fname) if ismdx else MDD(fname)
+    tmp = db_name + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    conn = sqlite3.connect(tmp, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute(
+            """ CREATE TABLE MDX_INDEX
+               (key_text text not null{},
+                file_pos integer,
+                compressed_size integer,
+                decompressed_size integer,
+                record_start integer,
+                record_end integer,
+                offset integer
+                )""".format(
+                " unique" if (not ismdx) else ""
+            )
+        )
+        done = 0
+        batch = []
+        for row in md.iter_index_rows():
+            batch.append(row)
+            if len(batch) < batchsize:
+                continue
+            done += __insert(conn, batch)
+            batch = []
+            if progress:
+                progress(done, getattr(md, "_num_entries", 0))
+        done += __insert(conn, batch)
+        conn.execute(
+            "CREATE{} INDEX key_index ON MDX_INDEX (key_text)".format(
+                " UNIQUE" if (not ismdx) else ""
+            )
+        )
+        if ismdx:
+            build_fuzzy_index(conn)
+    finally:
+        conn.close()
+    os.replace(tmp, db_name)
+    if progress:
+        progress(done, done)
+    return done
+
+
+def __insert(conn: sqlite3.Connection, batch: list):
+    if not batch:
+        return 0
+    conn.execute("BEGIN")
+    conn.executemany("INSERT INTO MDX_INDEX VALUES (?,?,?,?,?,?,?)", batch)
+    conn.execute("COMMIT")
+    return len(batch)
+
+
+def grams(text: str):
+    # 两端补\0的字符二元组，与myutils.fuzzyindex.ngramindex一致
+    padded = "\0" + text + "\0"
+    return [padded[i : i + 2] for i in range(len(padded) - 1)]
+
+
+def build_fuzzy_index(conn: sqlite3.Connection):
+    # 近似查词用的二元组倒排索引：
+    # FUZZY_KEY(id, key_text, len)为去重后的词头（len为小写后的长度），FUZZY_GRAM(gram, ids)中ids为该二元组出现过的词头id数组。
+    # 二元组按小写计算，与原来LIKE查询的不区分大小写保持一致。
+    conn.execute(
+        "CREATE TABLE FUZZY_KEY (id integer primary key, key_text text, len integer)"
+    )
+    conn.execute("CREATE TABLE FUZZY_GRAM (gram text primary key, ids blob)")
+    postings = {}  # type: dict[str, array]
+    batch = []
+    conn.execute("BEGIN")
+    for _id, (key,) in enumerate(
+        conn.execute("SELECT DISTINCT key_text FROM MDX_INDEX")
+    ):
+        lower = key.lower()
+        batch.append((_id, key, len(lower)))
+        for gram in set(grams(lower)):
+            if gram not in postings:
+                postings[gram] = array("i")
+            postings[gram].append(_id)
+        if len(batch) >= 20000:
+            conn.executemany("INSERT INTO FUZZY_KEY VALUES (?,?,?)", batch)
+            batch = []
+    conn.executemany("INSERT INTO FUZZY_KEY VALUES (?,?,?)", batch)
+    conn.executemany(
+        "INSERT INTO FUZZY_GRAM VALUES (?,?)",
+        ((gram, ids.tobytes()) for gram, ids in postings.items()),
+    )
+    conn.execute("CREATE INDEX fuzzy_len_index ON FUZZY_KEY (len)")
+    conn.execute("COMMIT")
+
+
+def build_index_worker(fname: str, db_name: str, ismdx: bool):
+    progress = None
+    if _progressqueue is not None:
+        progress = lambda done, total: _progressqueue.put((db_name, done, total))
+    return build_index(fname, db_name, ismdx, progress)
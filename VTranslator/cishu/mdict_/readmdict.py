@@ -20,11 +20,14 @@
 # GNU General Public License for more details.
 
 import logging
+import mmap
 import re
 import sys
+import threading
 
 # zlib compression is used for engine version >=2.0
 import zlib
+from collections import OrderedDict
 from io import BytesIO
 from struct import pack, unpack
 
@@ -49,6 +52,49 @@ __all__ = ["MDD", "MDX"]
 log = logging.getLogger(__name__)
 
 
+class _RecordBlockCache:
+	"""
+	LRU of decompressed record blocks shared by all opened files,
+	keyed by (filename, file_pos) and bounded by total bytes.
+	Entries of one article and its images/css usually live in the same block,
+	so each block is decoded at most once while it stays in the cache.
+	"""
+
+	def __init__(self, maxsize):
+		self.maxsize = maxsize
+		self.size = 0
+		self.lock = threading.Lock()
+		self.blocks = OrderedDict()
+
+	def get(self, key):
+		with self.lock:
+			block = self.blocks.get(key)
+			if block is not None:
+				self.blocks.move_to_end(key)
+			return block
+
+	def put(self, key, block):
+		if len(block) > self.maxsize:
+			return
+		with self.lock:
+			old = self.blocks.pop(key, None)
+			if old is not None:
+				self.size -= len(old)
+			self.blocks[key] = block
+			self.size += len(block)
+			while self.size > self.maxsize:
+				_, old = self.blocks.popitem(last=False)
+				self.size -= len(old)
+
+	def discard(self, fname):
+		with self.lock:
+			for key in [key for key in self.blocks if key[0] == fname]:
+				self.size -= len(self.blocks.pop(key))
+
+
+record_block_cache = _RecordBlockCache(64 * 1024 * 1024)
+
+
 def _unescape_entities(text):
 	"""Unescape offending tags < > " &."""
 	text = text.replace(b"&lt;", b"<")
@@ -99,6 +145,11 @@ class MDict:
 		self._encoding = encoding.upper()
 		self._encrypted_key = None
 		self._passcode = passcode
+		self._mmap = None
+		self._fh = None
+		self._fh_lock = threading.Lock()
+		# the file may have changed since blocks were cached for it
+		record_block_cache.discard(fname)
 
 		self.header = self._read_header()
 
@@ -554,6 +605,156 @@ class MDict:
 		self._num_entries = len(key_list)
 		return key_list
 
+	def _open_stream(self):
+		"""
+		Open a private read-only memory map of the file (it has its own position,
+		so several streams can be read in turn); falls back to a plain file.
+		"""
+		f = open(self._fname, "rb")
+		try:
+			m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		except (OSError, ValueError):
+			return f
+		f.close()
+		return m
+
+	def _iter_key_blocks(self, f):
+		"""
+		Yield the key list of one key block at a time.
+		self._record_block_offset is set before the first yield.
+		"""
+		if self._version >= 3:
+			f.seek(self._key_block_offset)
+			while True:
+				block_type = self._read_int32(f)
+				block_size = self._read_number(f)
+				block_offset = f.tell()
+				if block_type == 0x01000000:
+					self._record_block_offset = block_offset
+				elif block_type == 0x02000000:
+					self._record_index_offset = block_offset
+				elif block_type == 0x03000000:
+					self._key_data_offset = block_offset
+				elif block_type == 0x04000000:
+					self._key_index_offset = block_offset
+				else:
+					raise RuntimeError("Unknown block type {}".format(block_type))
+				f.seek(block_size, 1)
+				if f.read(4):
+					f.seek(-4, 1)
+				else:
+					break
+			f.seek(self._key_data_offset)
+			number = self._read_int32(f)
+			self._read_number(f)  # total_size
+			for _ in range(number):
+				decompressed_size = self._read_int32(f)
+				compressed_size = self._read_int32(f)
+				yield self._split_key_block(
+					self._decode_block(f.read(compressed_size), decompressed_size)
+				)
+			return
+
+		if (self._encrypt & 0x01) and self._encrypted_key is None:
+			log.warning("Trying brute-force on encrypted key blocks")
+			yield self._read_keys_brutal()
+			return
+
+		f.seek(self._key_block_offset)
+		num_bytes = 8 * 5 if self._version >= 2.0 else 4 * 4
+		block = f.read(num_bytes)
+		if self._encrypt & 1:
+			block = _salsa_decrypt(block, self._encrypted_key)
+		sf = BytesIO(block)
+		num_key_blocks = self._read_number(sf)
+		self._num_entries = self._read_number(sf)
+		if self._version >= 2.0:
+			self._read_number(sf)  # key_block_info_decomp_size
+		key_block_info_size = self._read_number(sf)
+		key_block_size = self._read_number(sf)
+		if self._version >= 2.0:
+			adler32 = unpack(">I", f.read(4))[0]
+			assert adler32 == (zlib.adler32(block) & 0xFFFFFFFF)
+		key_block_info_list = self._decode_key_block_info(f.read(key_block_info_size))
+		assert num_key_blocks == len(key_block_info_list)
+		self._record_block_offset = f.tell() + key_block_size
+		for compressed_size, decompressed_size in key_block_info_list:
+			yield self._split_key_block(
+				self._decode_block(f.read(compressed_size), decompressed_size)
+			)
+
+	def _iter_record_blocks(self, f):
+		"""
+		Yield (file_pos, compressed_size, decompressed_size) of every record block
+		without decompressing it; file_pos points at the block data itself.
+		"""
+		f.seek(self._record_block_offset)
+		if self._version >= 3:
+			num_record_blocks = self._read_int32(f)
+			self._read_number(f)  # num_bytes
+			for _ in range(num_record_blocks):
+				decompressed_size = self._read_int32(f)
+				compressed_size = self._read_int32(f)
+				file_pos = f.tell()
+				yield file_pos, compressed_size, decompressed_size
+				f.seek(file_pos + compressed_size)
+			return
+		num_record_blocks = self._read_number(f)
+		self._read_number(f)  # num_entries
+		record_block_info_size = self._read_number(f)
+		self._read_number(f)  # record_block_size
+		record_block_info_list = []
+		for _ in range(num_record_blocks):
+			compressed_size = self._read_number(f)
+			decompressed_size = self._read_number(f)
+			record_block_info_list.append((compressed_size, decompressed_size))
+		assert self._number_width * 2 * num_record_blocks == record_block_info_size
+		file_pos = f.tell()
+		for compressed_size, decompressed_size in record_block_info_list:
+			yield file_pos, compressed_size, decompressed_size
+			file_pos += compressed_size
+
+	def iter_index_rows(self):
+		"""
+		Stream the record index as tuples of
+		(key_text, file_pos, compressed_size, decompressed_size, record_start, record_end, offset),
+		the same rows items() describes, without holding the whole key list
+		and without decompressing any record block.
+		"""
+		keyf = self._open_stream()
+		recf = self._open_stream()
+		try:
+			keys = (key for block in self._iter_key_blocks(keyf) for key in block)
+			current = next(keys, None)
+			following = next(keys, None)
+			offset = 0
+			for file_pos, compressed_size, decompressed_size in self._iter_record_blocks(
+				recf
+			):
+				while current is not None:
+					record_start, key_text = current
+					if record_start - offset >= decompressed_size:
+						break
+					if following is not None:
+						record_end = following[0]
+					else:
+						record_end = decompressed_size + offset
+					yield (
+						key_text,
+						file_pos,
+						compressed_size,
+						decompressed_size,
+						record_start,
+						record_end,
+						offset,
+					)
+					current = following
+					following = next(keys, None)
+				offset += decompressed_size
+		finally:
+			keyf.close()
+			recf.close()
+
 	def items(self):
 		"""
 		Return a generator which in turn produce tuples in the
@@ -655,30 +856,66 @@ class MDict:
 
 		f.close()
  
+	def _read_at(self, pos, size):
+		"""
+		Read raw bytes at pos, using a memory map kept for the lifetime of the object.
+		Falls back to a persistent file handle if the file cannot be mapped.
+		"""
+		if self._mmap is None and self._fh is None:
+			with self._fh_lock:
+				if self._mmap is None and self._fh is None:
+					f = open(self._fname, "rb")
+					try:
+						self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+						f.close()
+					except (OSError, ValueError):
+						self._fh = f
+		if self._mmap is not None:
+			return self._mmap[pos : pos + size]
+		with self._fh_lock:
+			self._fh.seek(pos)
+			return self._fh.read(size)
+
+	def close(self):
+		with self._fh_lock:
+			if self._mmap is not None:
+				self._mmap.close()
+				self._mmap = None
+			if self._fh is not None:
+				self._fh.close()
+				self._fh = None
+		record_block_cache.discard(self._fname)
+
 	def read_records(self, index):
-		f = open(self._fname, "rb")
-		f.seek(index["file_pos"])
-		record_block_compressed = f.read(index["compressed_size"]) 
-		f.close()
-		decompressed_size = index["decompressed_size"] 
-		
-		try:
-			record_block = self._decode_block(
-				record_block_compressed,
-				decompressed_size,
+		key = (self._fname, index["file_pos"])
+		record_block = record_block_cache.get(key)
+		if record_block is None:
+			record_block_compressed = self._read_at(
+				index["file_pos"], index["compressed_size"]
 			)
-		except zlib.error:
-			log.error("zlib decompress error")
-			
+			decompressed_size = index["decompressed_size"]
+
+			try:
+				record_block = self._decode_block(
+					record_block_compressed,
+					decompressed_size,
+				)
+			except zlib.error:
+				log.error("zlib decompress error")
+				raise
+			record_block_cache.put(key, record_block)
+
 		# split record block according to the offset info from key block
 		data = record_block[
-            index["record_start"]
-            - index["offset"] : index["record_end"]
-            - index["offset"]
-        ]
+			index["record_start"]
+			- index["offset"] : index["record_end"]
+			- index["offset"]
+		]
 		return data
+
 	# assert size_counter == record_block_size
 
+
 class MDD(MDict):
 	"""
 	MDict resource file format (*.MDD) reader.
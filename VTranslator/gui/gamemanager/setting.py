@@ -5,7 +5,7 @@ from traceback import print_exc
 from language import TransLanguages
 import gobject, NativeUtils
 import copy
-from myutils.post import processfunctions
+from myutils.post import processfunctions, invalidatepostpipeline
 from myutils.config import (
     savehook_new_data,
     uid2gamepath,
@@ -84,6 +84,7 @@ def maybehavebutton(self, gameuid, post):
     if post == "_11":
         if "mypost" not in save_text_process_info:
             save_text_process_info["mypost"] = str(uuid.uuid4()).replace("-", "_")
+            invalidatepostpipeline()
         return getIconButton(
             icon="fa.edit",
             callback=functools.partial(
@@ -935,7 +936,10 @@ class dialog_setting_game_internal(QWidget):
     def gettextproc(self, formLayout: LFormLayout, gameuid):
 
         vbox = self.createfollowdefault(
-            savehook_new_data[gameuid], "textproc_follow_default", formLayout
+            savehook_new_data[gameuid],
+            "textproc_follow_default",
+            formLayout,
+            callback=invalidatepostpipeline,
         )
 
         model = LStandardItemModel()
@@ -1006,6 +1010,7 @@ class dialog_setting_game_internal(QWidget):
         idx1 = __list.index(game)
         idx2 = (idx1 + dy) % len(__list)
         __list.insert(idx2, __list.pop(idx1))
+        invalidatepostpipeline()
         self.__textprocinternalmodel.removeRow(idx1)
         self.__checkaddnewmethod(idx2, game)
         self.__textprocinternaltable.setCurrentIndex(
@@ -1029,11 +1034,14 @@ class dialog_setting_game_internal(QWidget):
         if _internal not in __dict:
             __dict[_internal] = copy.deepcopy(postprocessconfig[_internal])
             __dict[_internal]["use"] = True
+        invalidatepostpipeline()
         btn = maybehavebutton(self, self.__privatetextproc_gameuid, _internal)
 
         self.__textprocinternaltable.setIndexWidget(
             self.__textprocinternalmodel.index(row, 1),
-            getsimpleswitch(__dict[_internal], "use"),
+            getsimpleswitch(
+                __dict[_internal], "use", callback=invalidatepostpipeline
+            ),
         )
         if btn:
             self.__textprocinternaltable.setIndexWidget(
@@ -1059,6 +1067,7 @@ class dialog_setting_game_internal(QWidget):
             _dict["rank"].pop(row)
             if post in _dict["postprocessconfig"]:
                 _dict["postprocessconfig"].pop(post)
+        invalidatepostpipeline()
 
     def __privatetextproc_btn2(self):
         row = self.__textprocinternaltable.currentIndex().row()
@@ -1072,6 +1081,7 @@ class dialog_setting_game_internal(QWidget):
         _dict["rank"].pop(row)
         if post in _dict["postprocessconfig"]:
             _dict["postprocessconfig"].pop(post)
+        invalidatepostpipeline()
 
     def __privatetextproc_btn1(self):
 
@@ -4,7 +4,7 @@ from traceback import print_exc
 import os, gobject, requests, sys, uuid
 from myutils.commonbase import maybejson
 from myutils.config import globalconfig, _TR, static_data
-from myutils.utils import selectdebugfile
+from myutils.utils import selectdebugfile, bumpreplacerulesversion
 from myutils.wrapper import Singleton
 from gui.usefulwidget import (
     MySwitch,
@@ -169,6 +169,7 @@ class noundictconfigdialog1(LDialog):
                     "regex": switch,
                 }
             )
+        bumpreplacerulesversion()
 
     def closeEvent(self, a0: QCloseEvent) -> None:
         self.setFocus()
@@ -453,6 +454,7 @@ class yuyinzhidingsetting(LDialog):
                     "range": self.table.getdata(row, 0),
                 }
             )
+        bumpreplacerulesversion()
 
     def closeEvent(self, a0: QCloseEvent) -> None:
         self.setFocus()
@@ -1,6 +1,6 @@
 from qtsymbols import *
 import functools, gobject
-from myutils.post import POSTSOLVE
+from myutils.post import POSTSOLVE, invalidatepostpipeline
 from myutils.utils import (
     selectdebugfile,
     checkpostlangmatch,
@@ -71,6 +71,7 @@ def setTab7_lazy(self, basel: QLayout):
             _bads.append(_)
     for _ in _bads:
         globalconfig["postprocess_rank"].remove(_)
+    invalidatepostpipeline()
     sortlist: list = globalconfig["postprocess_rank"]
     savelist = []
     savelay = []
@@ -87,6 +88,7 @@ def setTab7_lazy(self, basel: QLayout):
             return
         headoffset = 1
         sortlist[idx], sortlist[idx2] = sortlist[idx2], sortlist[idx]
+        invalidatepostpipeline()
         for i, ww in enumerate(savelist[idx + headoffset]):
             ll: QGridLayout = savelay[0]
             w1 = ll.indexOf(ww)
@@ -166,7 +168,9 @@ def setTab7_lazy(self, basel: QLayout):
         l = [
             D_getdoclink("textprocess.html#anchor-" + post),
             ((postprocessconfig[post]["name"]), 5),
-            D_getsimpleswitch(postprocessconfig[post], "use"),
+            D_getsimpleswitch(
+                postprocessconfig[post], "use", callback=invalidatepostpipeline
+            ),
             config,
             "",
             getcenterX(
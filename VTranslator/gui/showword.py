@@ -25,7 +25,7 @@ from myutils.utils import (
     checkmd5reloadmodule,
     getimageformat,
 )
-from cishu.cishubase import DictionaryRoot
+from cishu.cishubase import DictionaryRoot, dictsection
 from sometypes import WordSegResult
 from myutils.mecab import mecab
 from myutils.wrapper import threader, tryprint
@@ -1216,6 +1216,7 @@ class WordViewer(QWidget):
     from_webview_search_word = pyqtSignal(str)
     from_webview_search_word_in_new_window = pyqtSignal(str)
     __show_dict_result = pyqtSignal(object, str, str)
+    __show_dict_section = pyqtSignal(object, str, object)
     first_result_shown = pyqtSignal()
     use_bg_color_parser = False
 
@@ -1260,6 +1261,25 @@ class WordViewer(QWidget):
                 functools.partial(self.__show_dict_result.emit, current, k),
                 word,
                 sentence,
+                partial=functools.partial(self.__show_dict_section.emit, current, k),
+            )
+
+    @tryprint
+    def __show_dict_section_function(self, timestamp, k, res):
+        # 流式返回的词典：第一部分与普通结果一样显示，之后的部分插入到正在显示的页面中
+        if self.current != timestamp:
+            return
+        if not isinstance(res, dictsection):
+            self.__show_dict_result_function(timestamp, k, res)
+            self.streamsections[k] = []
+            return
+        if k not in self.streamsections:
+            return
+        self.streamsections[k].append(res.html)
+        idx = self.tab.currentIndex()
+        if self.hasclicked and idx != -1 and self.tabks[idx] == k:
+            self.textOutput.eval(
+                "insertdictsection(document, {})".format(json.dumps(res.html))
             )
 
     @tryprint
@@ -1278,6 +1298,13 @@ class WordViewer(QWidget):
             self.thisps.pop(k)
             self.bad_result.add(k)
             return
+        if k in self.streamsections:
+            # 流式返回的词典结束了，各部分都已经显示，只需要保存完整的结果
+            self.streamsections.pop(k)
+            if res:
+                self.cache_results[k] = res
+                self.cache_results_highlighted.pop(k, None)
+            return
         self.cache_results[k] = res
 
         thisp = self.thisps.get(k, 0)
@@ -1335,6 +1362,7 @@ class WordViewer(QWidget):
         self.textOutput.clear()
         # 状态
         self.cache_results.clear()
+        self.streamsections.clear()
         self.bad_result.clear()
         self.cache_results_highlighted.clear()
         self.savemdictfoldstate.clear()
@@ -1384,10 +1412,12 @@ class WordViewer(QWidget):
         self.thisps = {}
         self.tabks = []
         self.cache_results = {}
+        self.streamsections = {}
         self.bad_result = set()
         self.cache_results_highlighted = {}
         self.tab = CustomTabBar()
         self.__show_dict_result.connect(self.__show_dict_result_function)
+        self.__show_dict_section.connect(self.__show_dict_section_function)
         self.tab.tabBarClicked.connect(self.tabclicked)
 
         self.tabcurrentindex = -1
@@ -1468,12 +1498,7 @@ class WordViewer(QWidget):
             "v_recheck_current_html", self.v_recheck_current_html
         )
         self.textOutput.bind("v_search_word", self.from_webview_search_word.emit)
-        self.textOutput.bind(
-            "v_audio_play_b64",
-            lambda b64: gobject.base.audioplayer.play(
-                base64.b64decode(b64.encode()), force=True
-            ),
-        )
+        self.textOutput.bind("v_audio_play_url", self.v_audio_play_url)
         tablayout.setContentsMargins(0, 0, 0, 0)
         tablayout.setSpacing(0)
         tablayout.addWidget(self.tab)
@@ -1487,6 +1512,13 @@ class WordViewer(QWidget):
         self.ishightlight = not self.ishightlight
         return self.ishightlight
 
+    def v_audio_play_url(self, url):
+        from cishu.mdict import mddresource
+
+        res = mddresource.load(url)
+        if res:
+            gobject.base.audioplayer.play(res[0], force=True)
+
     def v_recheck_current_html(self, html):
         self.cache_results_highlighted[self.tabks[self.tab.currentIndex()]] = html
 
@@ -1507,7 +1539,9 @@ class WordViewer(QWidget):
 
         if buttons == Qt.MouseButton.RightButton:
             return self.tabmenu(idx)
+        self.showtab(idx)
 
+    def showtab(self, idx):
         self.tab.setCurrentIndex(idx)
         self.hasclicked = True
         try:
@@ -1536,9 +1570,24 @@ class WordViewer(QWidget):
         html = frame.replace("__v_dict_internal_view__", html).replace(
             "__v_dict_internal_handle_bgcolor__", backgroundparser
         )
+        html += self.loadstreamsections(k)
         html += self.loadmdictfoldstate(k)
         self.textOutput.setHtml(html)
 
+    def loadstreamsections(self, k):
+        # 还在流式返回的词典，已经收到的后续部分在页面中插入
+        sections = self.streamsections.get(k)
+        if not sections:
+            return ""
+        datas = []
+        for html in sections:
+            datas.append(
+                "insertdictsection(document, {});".format(
+                    json.dumps(html).replace("</", "<\\/")
+                )
+            )
+        return """<script>{}</script>""".format("".join(datas))
+
     def loadmdictfoldstate(self, k):
         if k != "mdict":
             return ""
@@ -7,10 +7,11 @@ from gui.usefulwidget import closeashidewindow, WebviewWidget, Exteditor
 from gui.dynalang import LAction
 from urllib.parse import quote
 from myutils.wrapper import threader
+from myutils.historystore import historystore
 from traceback import print_exc
 from gui.setting.display_text import extrahtml
 from network.server.servicecollection_1 import WSForEach, transhistwsoutputsave
-import time, threading, windows
+import time, windows
 
 
 class somecommon:
@@ -38,7 +39,9 @@ class somecommon:
 
     def refresh(self):
         self.debugeval(
-            'fastinit("{}");'.format(quote(json.dumps(gobject.base.transhis.trace)))
+            'fastinit("{}");'.format(
+                quote(json.dumps(gobject.base.transhis.trace.tail()))
+            )
         )
 
     def setf(self):
@@ -94,26 +97,20 @@ class somecommon:
 
 class sharedfunctions:
     startuptime = time.time()
-    logfilename = "cache/history/{}.txt".format(get_time_stamp(forfilename=True))
-    writelogfilelock = threading.Lock()
 
     @staticmethod
-    def autosavecheckifneedninit(trace):
-        with sharedfunctions.writelogfilelock:
-            text = sharedfunctions.createSaveContent(trace)
-            has = os.path.exists(sharedfunctions.logfilename)
-            if not text and not has:
-                return
-            try:
-                os.makedirs("cache/history", exist_ok=True)
-                with open(
-                    sharedfunctions.logfilename,
-                    "w",
-                    encoding="utf8",
-                ) as ff:
-                    ff.write(text)
-            except:
-                print_exc()
+    def createstore():
+        return historystore(
+            gobject.getcachedir("history"),
+            gobject.gettempdir("history"),
+            get_time_stamp(forfilename=True),
+            globalconfig["history"]["autosave"],
+        )
+
+    @staticmethod
+    def setautosave(trace: historystore, autosave: bool):
+        globalconfig["history"]["autosave"] = autosave
+        trace.setpersistent(autosave)
 
     @staticmethod
     def savesrt(self, trace):
@@ -204,39 +201,6 @@ class sharedfunctions:
                 seted = True
         return collect
 
-    @staticmethod
-    def ifformatchangedrewriteautosave(trace):
-        if not globalconfig["history"]["autosave"]:
-            return
-        sharedfunctions.autosavecheckifneedninit(trace)
-
-    @staticmethod
-    def autosave(line):
-        if not globalconfig["history"]["autosave"]:
-            return
-        l = sharedfunctions.visline(line)
-        with sharedfunctions.writelogfilelock:
-            has = os.path.exists(sharedfunctions.logfilename)
-            out = ""
-            if line[0] == 0:
-                if has:
-                    out += "\n"
-            if l:
-                if has:
-                    out += "\n"
-                out += l
-            try:
-                if out:
-                    os.makedirs("cache/history", exist_ok=True)
-                    with open(
-                        sharedfunctions.logfilename,
-                        "a",
-                        encoding="utf8",
-                    ) as ff:
-                        ff.write(out)
-            except:
-                print_exc()
-
     @staticmethod
     def visline(line):
         ii, line = line
@@ -267,9 +231,9 @@ class wvtranshist(WebviewWidget, somecommon):
         self.debugeval("scrollend()")
 
     def autosavecb(self):
-        globalconfig["history"]["autosave"] = not globalconfig["history"]["autosave"]
-        if globalconfig["history"]["autosave"]:
-            sharedfunctions.autosavecheckifneedninit(self.p.trace)
+        sharedfunctions.setautosave(
+            self.p.trace, not globalconfig["history"]["autosave"]
+        )
 
     def __init__(self, p):
         super().__init__(p, loadext=globalconfig["history"]["webviewLoadExt"])
@@ -533,9 +497,7 @@ class Qtranshist(QPlainTextEdit):
             globalconfig["history"]["usewebview2"] = webview2qt.isChecked()
             self.p.loadviewer(True)
         elif action == baocunauto:
-            globalconfig["history"]["autosave"] = baocunauto.isCheckable()
-            if baocunauto.isCheckable():
-                sharedfunctions.autosavecheckifneedninit(self.p.trace)
+            sharedfunctions.setautosave(self.p.trace, baocunauto.isChecked())
         elif action == search:
             gobject.base.searchwordW.search_word.emit(
                 self.textCursor().selectedText(), None, False
@@ -590,7 +552,7 @@ class Qtranshist(QPlainTextEdit):
             self.setStyleSheet("QPlainTextEdit{" + _style + "}")
 
     def refresh(self):
-        collect = sharedfunctions.createSaveContent(self.p.trace)
+        collect = sharedfunctions.createSaveContent(self.p.trace.tail())
         self.setPlainText(collect)
         self.move_cursor_to_end()
 
@@ -618,7 +580,7 @@ class transhist(closeashidewindow):
 
     def __init__(self, parent):
         super(transhist, self).__init__(parent, globalconfig["hist_geo"])
-        self.trace = []
+        self.trace = sharedfunctions.createstore()
         self.textOutput = None
         # self.setWindowFlags(self.windowFlags()&~Qt.WindowMinimizeButtonHint)
         self.getnewsentencesignal.connect(self.getnewsentence)
@@ -643,37 +605,31 @@ class transhist(closeashidewindow):
 
     def showtransname(self):
         WSForEach(transhistwsoutputsave, lambda _: _.showtransname())
-        sharedfunctions.ifformatchangedrewriteautosave(self.trace)
 
     def showhidetime(self):
         WSForEach(transhistwsoutputsave, lambda _: _.showhidetime())
-        sharedfunctions.ifformatchangedrewriteautosave(self.trace)
 
     def showtrans(self):
         WSForEach(transhistwsoutputsave, lambda _: _.showtrans())
-        sharedfunctions.ifformatchangedrewriteautosave(self.trace)
 
     def showhideraw(self):
         WSForEach(transhistwsoutputsave, lambda _: _.showhideraw())
-        sharedfunctions.ifformatchangedrewriteautosave(self.trace)
 
     def getnewsentence(self, sentence):
         tm = time.time()
         line = (0, (tm, sentence))
         self.trace.append(line)
-        sharedfunctions.autosave(line)
         if self.state == 2:
-            self.textOutput.getnewsentence(self.trace[-1])
-        WSForEach(transhistwsoutputsave, lambda _: _.getnewsentence(self.trace[-1]))
+            self.textOutput.getnewsentence(line)
+        WSForEach(transhistwsoutputsave, lambda _: _.getnewsentence(line))
 
     def getnewtrans(self, api, sentence):
         tm = time.time()
         line = (1, (tm, api, sentence))
         self.trace.append(line)
-        sharedfunctions.autosave(line)
         if self.state == 2:
-            self.textOutput.getnewtrans(self.trace[-1])
-        WSForEach(transhistwsoutputsave, lambda _: _.getnewtrans(self.trace[-1]))
+            self.textOutput.getnewtrans(line)
+        WSForEach(transhistwsoutputsave, lambda _: _.getnewtrans(line))
 
     def loadviewer(self, shoudong=False):
         if self.textOutput:
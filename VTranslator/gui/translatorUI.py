@@ -1854,6 +1854,15 @@ class TranslatorWindow(resizableframeless):
 
             gobject.base.textsource = None
             gobject.base.destroytray()
+            # 进程最后以os._exit结束，atexit不会执行，需要在这里写入还在内存中的数据
+            try:
+                gobject.base.somedatabase.tracker.stop()
+            except:
+                print_exc()
+            try:
+                gobject.base.transhis.trace.flush()
+            except:
+                print_exc()
             _ = NativeUtils.SimpleCreateMutex("VSAVECONFIGUPDATE")
             if windows.GetLastError() != windows.ERROR_ALREADY_EXISTS:
                 errors = saveallconfig()
@@ -2,7 +2,7 @@ import os, hashlib, queue, gobject, json
 from myutils.proxy import getproxy
 from myutils.commonbase import proxysession
 from myutils.config import globalconfig, savehook_new_data, extradatas
-from myutils.utils import getlangtgt
+from myutils.utils import getlangtgt, bumpreplacerulesversion
 from traceback import print_exc
 from requests import RequestException
 from myutils.wrapper import tryprint, threader
@@ -250,6 +250,7 @@ class common:
                             "info": "",
                         }
                     )
+            bumpreplacerulesversion()
 
         for _ in webtags:
             if _ in savehook_new_data[gameuid]["webtags"]:
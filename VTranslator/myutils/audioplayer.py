@@ -18,6 +18,9 @@ from ctypes import (
     create_string_buffer,
     c_wchar_p,
     c_char,
+    memmove,
+    Structure,
+    byref,
 )
 
 HENCODE = DWORD
@@ -51,6 +54,27 @@ BASS_Init = WINFUNCTYPE(BOOL, c_int, DWORD, DWORD, HWND, c_void_p)(("BASS_Init",
 BASS_StreamCreateFile = WINFUNCTYPE(HSTREAM, BOOL, c_void_p, QWORD, QWORD, DWORD)(
     ("BASS_StreamCreateFile", bass)
 )
+BASS_ChannelIsActive = WINFUNCTYPE(DWORD, DWORD)(("BASS_ChannelIsActive", bass))
+FILECLOSEPROC = WINFUNCTYPE(None, c_void_p)
+FILELENPROC = WINFUNCTYPE(QWORD, c_void_p)
+FILEREADPROC = WINFUNCTYPE(DWORD, c_void_p, DWORD, c_void_p)
+FILESEEKPROC = WINFUNCTYPE(BOOL, QWORD, c_void_p)
+
+
+class BASS_FILEPROCS(Structure):
+    _fields_ = [
+        ("close", FILECLOSEPROC),
+        ("length", FILELENPROC),
+        ("read", FILEREADPROC),
+        ("seek", FILESEEKPROC),
+    ]
+
+
+STREAMFILE_BUFFER = 1
+BASS_STREAM_BLOCK = 0x100000
+BASS_StreamCreateFileUser = WINFUNCTYPE(
+    HSTREAM, DWORD, DWORD, POINTER(BASS_FILEPROCS), c_void_p
+)(("BASS_StreamCreateFileUser", bass))
 BASS_Free = WINFUNCTYPE(BOOL)(("BASS_Free", bass))
 BASS_PluginLoad = WINFUNCTYPE(HPLUGIN, c_char_p, DWORD)(("BASS_PluginLoad", bass))
 
@@ -59,16 +83,45 @@ bassenc = WinDLL(gobject.GetDllpath("bassenc.dll"))
 BASS_Encode_IsActive = WINFUNCTYPE(DWORD, DWORD)(("BASS_Encode_IsActive", bassenc))
 BASS_Encode_Stop = WINFUNCTYPE(BOOL, DWORD)(("BASS_Encode_Stop", bassenc))
 
-BASS_ChannelIsActive = WINFUNCTYPE(DWORD, DWORD)(("BASS_ChannelIsActive", bass))
 BASS_ChannelGetData = WINFUNCTYPE(DWORD, DWORD, c_void_p, DWORD)(
     ("BASS_ChannelGetData", bass)
 )
 
 
+class streamfile:
+    # 把合成中的TTSStream作为BASS的网络流：BASS在自己的下载线程里调用read，没有数据时阻塞等待
+    def __init__(self, stream):
+        self.stream = stream
+        self.pos = 0
+        self.aborted = False
+        self.procs = BASS_FILEPROCS(
+            FILECLOSEPROC(lambda _: None),
+            FILELENPROC(lambda _: 0),
+            FILEREADPROC(self.read),
+            FILESEEKPROC(lambda *_: False),
+        )
+
+    def read(self, buffer, length, _):
+        data = None
+        while data is None:
+            if self.aborted:
+                return 0
+            data = self.stream.read(self.pos, length, 0.1)
+        memmove(buffer, data, len(data))
+        self.pos += len(data)
+        return len(data)
+
+    def open(self):
+        return BASS_StreamCreateFileUser(
+            STREAMFILE_BUFFER, BASS_STREAM_BLOCK, byref(self.procs), None
+        )
+
+
 class playonce:
     def __init__(self, fileormem, volume) -> None:
         self.handle = None
         self.channel_length = 0
+        self.streamfile = None
         self.__play(fileormem, volume)
 
     def __del__(self):
@@ -78,6 +131,9 @@ class playonce:
     def isplaying(self):
         if not self.handle:
             return False
+        if self.streamfile:
+            # 边下边播的流长度未知，播放到数据结束后才会停止
+            return BASS_ChannelIsActive(self.handle) != 0
         if not self.channel_length:
             return False
         if self.channel_length == -1:
@@ -90,6 +146,10 @@ class playonce:
     def __play(self, fileormem, volume):
         if isinstance(fileormem, bytes):
             handle = BASS_StreamCreateFile(True, fileormem, 0, len(fileormem), 0)
+        elif hasattr(fileormem, "read"):
+            # tts.basettsclass.TTSStream
+            self.streamfile = streamfile(fileormem)
+            handle = self.streamfile.open()
         else:
             handle = BASS_StreamCreateFile(False, fileormem, 0, 0, BASS_UNICODE)
         if not handle:
@@ -107,6 +167,9 @@ class playonce:
         if not _:
             return
         self.handle = None
+        if self.streamfile:
+            # 让BASS的下载线程不再等待数据
+            self.streamfile.aborted = True
         BASS_StreamFree(_)
 
 
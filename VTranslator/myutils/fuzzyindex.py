@@ -0,0 +1,83 @@
+import threading
+import NativeUtils
+
+
+class ngramindex:
+    # 字符二元组倒排索引，用于近似匹配。
+    # 两端补\0后长度为n的字符串有n+1个二元组，每次编辑最多破坏2个，
+    # 所以编辑距离不超过d的两个串至少共享n+1-2d个二元组：只要扫描查询串中最稀有的2d+1个二元组的倒排表，就不会漏掉候选。
+    # 候选再经过长度过滤，最后用NativeUtils计算真实的距离/相似度。
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.texts = {}  # type: dict[int, str]
+        self.postings = {}  # type: dict[str, list[int]]
+        self.bylength = {}  # type: dict[int, list[int]]
+
+    def __len__(self):
+        return len(self.texts)
+
+    @staticmethod
+    def grams(text: str):
+        padded = "\0" + text + "\0"
+        return [padded[i : i + 2] for i in range(len(padded) - 1)]
+
+    def add(self, _id, text: str):
+        if not text:
+            return
+        with self.lock:
+            if _id in self.texts:
+                return
+            self.texts[_id] = text
+            for gram in self.grams(text):
+                self.postings.setdefault(gram, []).append(_id)
+            self.bylength.setdefault(len(text), []).append(_id)
+
+    def __candidates(self, text: str, maxdist: int, minlen: int, maxlen: int):
+        grams = set(self.grams(text))
+        need = 2 * maxdist + 1
+        if need > len(grams):
+            # 太短或者阈值太宽松，二元组过滤无效，只按长度过滤
+            cands = []
+            for l in range(minlen, maxlen + 1):
+                cands.extend(self.bylength.get(l, ()))
+            return cands
+        rarest = sorted(grams, key=lambda g: len(self.postings.get(g, ())))[:need]
+        cands = set()
+        for gram in rarest:
+            cands.update(self.postings.get(gram, ()))
+        return [_ for _ in cands if minlen <= len(self.texts[_]) <= maxlen]
+
+    def nearest_by_distance(self, text: str, maxdist: int, topk=None):
+        # -> [(distance, id), ...] 按距离升序
+        n = len(text)
+        with self.lock:
+            cands = self.__candidates(text, maxdist, max(1, n - maxdist), n + maxdist)
+            result = []
+            for _id in cands:
+                dis = NativeUtils.distance(text, self.texts[_id])
+                if dis <= maxdist:
+                    result.append((dis, _id))
+        result.sort()
+        return result[:topk] if topk else result
+
+    def nearest_by_similarity(self, text: str, threshold: float, topk=None):
+        # threshold: 0~1，NativeUtils.similarity = 1 - distance/max(len1, len2)
+        # -> [(similarity, id), ...] 按相似度降序
+        n = len(text)
+        if not n:
+            return []
+        threshold = max(threshold, 0.01)
+        # 加上eps，避免0.1*10=0.9999...这样的浮点误差导致漏掉恰好达到阈值的候选
+        eps = 1e-9
+        maxlen = int(n / threshold + eps)
+        minlen = max(1, n - int((1 - threshold) * n + eps))
+        maxdist = int((1 - threshold) * maxlen + eps)
+        with self.lock:
+            cands = self.__candidates(text, maxdist, minlen, maxlen)
+            result = []
+            for _id in cands:
+                sim = NativeUtils.similarity(text, self.texts[_id])
+                if sim >= threshold:
+                    result.append((sim, _id))
+        result.sort(key=lambda _: -_[0])
+        return result[:topk] if topk else result
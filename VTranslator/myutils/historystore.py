@@ -0,0 +1,141 @@
+import os, json, time, queue, threading
+from collections import deque
+from traceback import print_exc
+
+
+class historystore:
+    # 翻译历史的存储：每条记录一行JSON，[0, 时间, 原文] 或 [1, 时间, 翻译器, 译文]。
+    # 写入全部在后台线程中完成，始终只保持一个打开的文件，缓冲满flushsize或距上次写入超过flushinterval秒时刷新，
+    # 单个文件超过rotatesize后换新文件。保存txt/srt是迭代这里的记录现生成，不在内存中保留全部历史；
+    # 历史窗口只显示内存中最近的tailsize条(tail())，不需要等待写入，也不读文件。
+    flushinterval = 1
+    flushsize = 0x10000
+    rotatesize = 0x1000000
+    tailsize = 5000
+
+    def __init__(self, persistentdir: str, tempdir: str, name: str, persistent: bool):
+        self.persistentdir = persistentdir
+        self.tempdir = tempdir
+        self.name = name
+        self.persistent = persistent
+        self.segments = []  # type: list[str]
+        # 清空之后只显示start之后的文件
+        self.start = 0
+        self.queue = queue.Queue()
+        self.file = None
+        self.filesize = 0
+        self.taillock = threading.Lock()
+        self.recent = deque(maxlen=self.tailsize)
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def append(self, line):
+        # line: (0, (tm, sentence)) / (1, (tm, api, sentence))
+        with self.taillock:
+            self.recent.append((line[0], tuple(line[1])))
+        self.queue.put(("append", [line[0]] + list(line[1])))
+
+    def clear(self):
+        with self.taillock:
+            self.recent.clear()
+        self.queue.put(("clear", None))
+
+    def tail(self) -> list:
+        with self.taillock:
+            return list(self.recent)
+
+    def setpersistent(self, persistent: bool):
+        # 开启时把当前显示的历史复制到持久目录下的新文件，之后继续写在那里
+        self.queue.put(("persistent", persistent))
+
+    def flush(self):
+        # 等待此前的记录都写入文件。退出时由主窗口调用（进程以os._exit结束，atexit不会执行）
+        event = threading.Event()
+        self.queue.put(("flush", event))
+        event.wait()
+
+    def __iter__(self):
+        self.flush()
+        return self.__read()
+
+    def __read(self):
+        for segment in self.segments[self.start :]:
+            try:
+                with open(segment, "r", encoding="utf8") as ff:
+                    for line in ff:
+                        try:
+                            record = json.loads(line)
+                        except:
+                            # 最后一行可能因为异常退出而不完整
+                            continue
+                        yield record[0], tuple(record[1:])
+            except FileNotFoundError:
+                pass
+
+    def __close(self):
+        # 下一次写入时再创建新文件
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def __open(self):
+        directory = (self.tempdir, self.persistentdir)[self.persistent]
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.name + ".jsonl")
+        i = 0
+        while path in self.segments or os.path.exists(path):
+            i += 1
+            path = os.path.join(directory, "{}_{}.jsonl".format(self.name, i))
+        self.file = open(path, "w", encoding="utf8", buffering=self.flushsize)
+        self.filesize = 0
+        self.segments.append(path)
+
+    def __write(self, record):
+        if self.file and self.filesize > self.rotatesize:
+            self.__close()
+        if not self.file:
+            self.__open()
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        self.file.write(line)
+        self.filesize += len(line.encode("utf8"))
+
+    def __setpersistent(self, persistent: bool):
+        if persistent == self.persistent:
+            return
+        records = []
+        if persistent:
+            if self.file:
+                self.file.flush()
+            records = [[_[0]] + list(_[1]) for _ in self.__read()]
+        self.__close()
+        self.persistent = persistent
+        if persistent:
+            self.start = len(self.segments)
+            for record in records:
+                self.__write(record)
+
+    def __run(self):
+        deadline = None
+        while True:
+            try:
+                timeout = None if deadline is None else max(0, deadline - time.time())
+                op, arg = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                op, arg = "flush", None
+            try:
+                if op == "append":
+                    self.__write(arg)
+                    if deadline is None:
+                        deadline = time.time() + self.flushinterval
+                    continue
+                elif op == "clear":
+                    self.__close()
+                    self.start = len(self.segments)
+                elif op == "persistent":
+                    self.__setpersistent(arg)
+                if self.file:
+                    self.file.flush()
+            except:
+                print_exc()
+            deadline = None
+            if op == "flush" and arg:
+                arg.set()
@@ -0,0 +1,171 @@
+import re
+
+
+def trieregex(keys: "list[str]") -> str:
+    # 把一组字面量合并成按前缀共享的正则，例如 abc,abd,b -> (?:ab[cd]|b)
+    # 同一位置能匹配多个key时（只可能是互为前缀），总是优先更长的那个。
+    trie = {}
+    for key in keys:
+        node = trie
+        for c in key:
+            node = node.setdefault(c, {})
+        node[""] = None
+
+    def build(node: dict) -> str:
+        end = "" in node
+        children = sorted(c for c in node if c)
+        if not children:
+            return ""
+        single = []
+        alts = []
+        for c in children:
+            sub = build(node[c])
+            if sub or "" not in node[c] or len(node[c]) > 1:
+                alts.append(re.escape(c) + sub)
+            else:
+                single.append(c)
+        if single:
+            if len(single) == 1:
+                alts.append(re.escape(single[0]))
+            else:
+                alts.append("[" + "".join(re.escape(c) for c in single) + "]")
+        if len(alts) == 1 and not end:
+            return alts[0]
+        pattern = "(?:" + "|".join(alts) + ")"
+        if end:
+            # 贪婪的?先尝试更长的后续，失败时才退回到当前位置结束
+            pattern += "?"
+        return pattern
+
+    return build(trie)
+
+
+class literalreplacer:
+    # 一次扫描完成多组字面量替换
+    def __init__(self, rules: "list[tuple[str, str]]"):
+        self.table = {}
+        for key, value in rules:
+            self.table.setdefault(key, value)
+        self.pattern = re.compile(trieregex(list(self.table)))
+
+    def __call__(self, line: str) -> str:
+        return self.pattern.sub(lambda m: self.table[m.group()], line)
+
+
+class literalrun:
+    # 连续的若干条字面量规则，只有在一次扫描的结果与逐条str.replace完全一致时才合并：
+    # 1. 前面规则的value不能为空，且不含后面规则key中的任何字符，否则替换后的文本可能产生新的匹配
+    # 2. 前面规则的key不能是后面规则key的子串，否则逐条替换时前者会先破坏后者
+    # 3. 后面规则key的真后缀不能是前面规则key的前缀，否则两者重叠时一次扫描会让更靠左的后者先匹配
+    maxkeylen = 64
+
+    def __init__(self):
+        self.rules = []  # type: list[tuple[str, str]]
+        self.keys = set()
+        self.keylens = set()
+        self.prefixes = set()
+        self.valuechars = set()
+        self.closed = False
+
+    def tryadd(self, key: str, value: str) -> bool:
+        if self.rules:
+            if len(key) > self.maxkeylen or self.closed:
+                return False
+            if self.valuechars.intersection(key):
+                return False
+            n = len(key)
+            for l in self.keylens:
+                for i in range(n - l + 1):
+                    if key[i : i + l] in self.keys:
+                        return False
+            for i in range(1, n):
+                if key[i:] in self.prefixes:
+                    return False
+        elif len(key) > self.maxkeylen:
+            # 过长的key单独成组
+            self.rules.append((key, value))
+            self.closed = True
+            return True
+        self.rules.append((key, value))
+        self.keys.add(key)
+        self.keylens.add(len(key))
+        for i in range(1, len(key) + 1):
+            self.prefixes.add(key[:i])
+        self.valuechars.update(value)
+        self.closed = self.closed or not value
+        return True
+
+    def compile(self):
+        # 条目很少时逐条str.replace反而更快，两者结果相同
+        if len(self.rules) <= 8:
+            rules = self.rules
+
+            def _(line: str):
+                for key, value in rules:
+                    line = line.replace(key, value)
+                return line
+
+            return _
+        return literalreplacer(self.rules)
+
+
+class ahocorasick:
+    # 多模式匹配自动机，一次扫描找出所有（可重叠的）出现位置
+    def __init__(self, keys: "list[str]"):
+        self.keys = keys
+        self.goto = [{}]  # type: list[dict[str, int]]
+        fail = [0]
+        out = [[]]  # type: list[list[int]]
+        for idx, key in enumerate(keys):
+            if not key:
+                continue
+            state = 0
+            for c in key:
+                nxt = self.goto[state].get(c)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][c] = nxt
+                    self.goto.append({})
+                    fail.append(0)
+                    out.append([])
+                state = nxt
+            out[state].append(idx)
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for c, nxt in self.goto[state].items():
+                f = fail[state]
+                while f and c not in self.goto[f]:
+                    f = fail[f]
+                f = self.goto[f].get(c, 0)
+                fail[nxt] = f if f != nxt else 0
+                out[nxt] += out[fail[nxt]]
+                queue.append(nxt)
+        self.fail = fail
+        self.out = [tuple(_) for _ in out]
+
+    def finditer(self, text: str):
+        # -> (start, end, keyindex)
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        keys = self.keys
+        state = 0
+        for i, c in enumerate(text):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            for idx in out[state]:
+                yield i + 1 - len(keys[idx]), i + 1, idx
+
+    @staticmethod
+    def longest(matches: "list[tuple[int, int, int]]"):
+        # 从finditer的结果中从左到右不重叠地选取匹配，同一起点优先最长的
+        # -> [(start, end, keyindex)]
+        matches = sorted(matches, key=lambda _: (_[0], -_[1]))
+        result = []
+        end = 0
+        for match in matches:
+            if match[0] >= end:
+                result.append(match)
+                end = match[1]
+        return result
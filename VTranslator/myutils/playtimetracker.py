@@ -0,0 +1,137 @@
+import time, threading
+from traceback import print_exc
+
+
+class playtimetracker:
+    # 统计游戏时间。
+    # 每个tick只取一次进程快照(pid, 进程名)，只有进程集合或者游戏列表变化时才解析进程路径并查找gameuid，
+    # pid->路径、路径->gameuid都缓存起来。时间段只在内存中累计，游戏结束时或者每flushinterval秒才在一个事务里写入。
+    # provider需要提供：
+    #   listprocesses() -> [(pid, 进程名)]
+    #   getprocessfilename(pid) -> 进程路径或None
+    #   foregroundexes() -> 严格模式下视为正在玩的进程路径
+    # save(sessions)：sessions为[(table, gameuid, timestart, timestop, inserted)]，inserted为False的需要新插入
+    interval = 5
+    flushinterval = 60
+
+    def __init__(self, provider, finduid, configstamp, save, clock=time.time):
+        self.provider = provider
+        self.finduid = finduid
+        self.configstamp = configstamp
+        self.save = save
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.lastprocesses = None
+        self.laststamp = None
+        self.pathcache = {}  # (pid, 进程名) -> 路径
+        self.uidcache = {}  # 路径 -> gameuid
+        self.looseuids = set()
+        # (table, gameuid) -> [timestart, timestop, inserted]
+        self.sessions = {}
+        self.ended = []
+        self.lasttick = None
+        self.lastflush = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def stop(self):
+        # 退出时由主窗口调用（进程以os._exit结束，atexit不会执行）
+        self.stopped.set()
+        self.flush()
+
+    def __run(self):
+        while not self.stopped.is_set():
+            try:
+                self.tick()
+            except:
+                print_exc()
+            self.stopped.wait(self.interval)
+
+    def finduids(self, exes):
+        uids = set()
+        for exe in exes:
+            if exe in self.uidcache:
+                uid = self.uidcache[exe]
+            else:
+                uid = self.uidcache[exe] = self.finduid(exe)
+            if uid:
+                uids.add(uid)
+        return uids
+
+    def __rescanloose(self):
+        processes = frozenset(self.provider.listprocesses())
+        stamp = self.configstamp()
+        if stamp != self.laststamp:
+            # 游戏列表变了，之前的查找结果都不可信
+            self.uidcache.clear()
+        elif processes == self.lastprocesses:
+            return
+        self.laststamp = stamp
+        self.lastprocesses = processes
+        pathcache = {}
+        for key in processes:
+            if key in self.pathcache:
+                pathcache[key] = self.pathcache[key]
+            else:
+                try:
+                    pathcache[key] = self.provider.getprocessfilename(key[0])
+                except:
+                    pathcache[key] = None
+        self.pathcache = pathcache
+        self.looseuids = self.finduids(_ for _ in pathcache.values() if _)
+
+    def tick(self):
+        with self.lock:
+            t = self.clock()
+            tlast = self.lasttick
+            self.lasttick = t
+            if self.lastflush is None:
+                self.lastflush = t
+            if tlast is not None and t - tlast > 2 * self.interval:
+                # 虚拟机暂停，之前的时间段就在暂停前结束
+                self.__endall()
+                self.__flush(t)
+                return
+            self.__rescanloose()
+            stricts = self.finduids(_ for _ in self.provider.foregroundexes() if _)
+            self.__update(t, "trace_loose", self.looseuids)
+            self.__update(t, "trace_strict", stricts)
+            if self.ended or (
+                self.sessions and t - self.lastflush >= self.flushinterval
+            ):
+                self.__flush(t)
+
+    def __update(self, t, table, uids):
+        for uid in uids:
+            session = self.sessions.get((table, uid))
+            if session:
+                session[1] = t
+            else:
+                self.sessions[(table, uid)] = [t, t, False]
+        for key in list(self.sessions):
+            if key[0] == table and key[1] not in uids:
+                self.ended.append((key, self.sessions.pop(key)))
+
+    def __endall(self):
+        self.ended.extend(self.sessions.items())
+        self.sessions.clear()
+
+    def flush(self):
+        with self.lock:
+            self.__flush(self.clock())
+
+    def __flush(self, t):
+        self.lastflush = t
+        if not (self.sessions or self.ended):
+            return
+        pending = self.ended + list(self.sessions.items())
+        try:
+            self.save([(k[0], k[1], s[0], s[1], s[2]) for k, s in pending])
+        except:
+            print_exc()
+            return
+        self.ended.clear()
+        for session in self.sessions.values():
+            session[2] = True
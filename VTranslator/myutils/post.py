@@ -1,4 +1,4 @@
-import re, inspect
+import re, inspect, os
 from traceback import print_exc
 from collections import Counter
 import gobject
@@ -184,16 +184,25 @@ def _13_fEX(line: str):
     return "".join(reversed(saves))
 
 
+_1_re1 = re.compile(r"\{(\w+)(.*?)\}(.*?)\{\/\1\}")
+_1_re2 = re.compile(r"\{([^}]?)[:/](.*?)\}")
+_1_re3 = re.compile(r"\{.*?\}")
+
+
 def _1_f(line):
-    line = re.sub(r"\{(\w+)(.*?)\}(.*?)\{\/\1\}", r"\3", line)
-    line = re.sub(r"\{([^}]?)[:/](.*?)\}", r"\1", line)
-    line = re.sub(r"\{.*?\}", r"", line)
+    line = _1_re1.sub(r"\3", line)
+    line = _1_re2.sub(r"\1", line)
+    line = _1_re3.sub(r"", line)
     return line
 
 
+_4_re1 = re.compile("<(.*?)>")
+_4_re2 = re.compile("</(.*?)>")
+
+
 def _4_f(line):
-    line = re.sub("<(.*?)>", "", line)
-    line = re.sub("</(.*?)>", "*", line)
+    line = _4_re1.sub("", line)
+    line = _4_re2.sub("*", line)
     return line
 
 
@@ -203,13 +212,17 @@ def _6_fEX(line: str):
     return line
 
 
+_91_re = re.compile("([0-9]+)")
+_92_re = re.compile("([a-zA-Z]+)")
+
+
 def _91_f(line):
-    line = re.sub("([0-9]+)", "", line)
+    line = _91_re.sub("", line)
     return line
 
 
 def _92_f(line):
-    line = re.sub("([a-zA-Z]+)", "", line)
+    line = _92_re.sub("", line)
     return line
 
 
@@ -300,9 +313,23 @@ def lines_threshold(line: str, args: dict):
     return line
 
 
-def _mypostloader(line, file, module):
+_mypostmtime = {}
+
 
-    _ = checkmd5reloadmodule(file, module)
+def _mypostloader(line, file, module):
+    # 每行都读文件算md5太慢了，文件修改时间变化时才交给checkmd5reloadmodule重新检查
+    key = (file, module)
+    try:
+        mtime = os.stat(file).st_mtime_ns
+    except OSError:
+        _mypostmtime.pop(key, None)
+        return line
+    cached = _mypostmtime.get(key)
+    if cached and cached[0] == mtime:
+        _ = cached[1]
+    else:
+        _ = checkmd5reloadmodule(file, module)
+        _mypostmtime[key] = mtime, _
     # 这个是单独函数的模块，不需要用isnew来判断是否需要重新初始化
     if not _:
         return line
@@ -337,64 +364,108 @@ processfunctions = {
 }
 
 
-def POSTSOLVE(line: str, isEx=False, isFromHook=False, useAll=False) -> str:
-    if not line:
-        return ""
-    useranklist = globalconfig["postprocess_rank"]
-    usedpostprocessconfig = postprocessconfig
-    usemypostpath = "mypost.py"
-    usemodule = "mypost"
-    try:
+# 参数个数在导入时确定一次，不再每行调用inspect.signature
+processfunctions_nparams = {
+    name: len(inspect.signature(_f).parameters)
+    for name, _f in processfunctions.items()
+}
 
-        gameuid = gobject.base.gameuid
-        if gameuid and not savehook_new_data[gameuid].get(
-            "textproc_follow_default", True
-        ):
-            useranklist = savehook_new_data[gameuid]["save_text_process_info"]["rank"]
-            usedpostprocessconfig = savehook_new_data[gameuid][
-                "save_text_process_info"
-            ]["postprocessconfig"]
-            if savehook_new_data[gameuid]["save_text_process_info"].get("mypost", None):
-                usemodule = (
-                    "posts."
-                    + savehook_new_data[gameuid]["save_text_process_info"]["mypost"]
-                )
-                usemypostpath = "posts/{}.py".format(
-                    savehook_new_data[gameuid]["save_text_process_info"]["mypost"]
-                )
-    except:
-        print_exc()
-    for postitem in useranklist:
-        if postitem not in processfunctions:
-            continue
-        if postitem not in usedpostprocessconfig:
-            continue
-        if usedpostprocessconfig[postitem]["use"]:
+
+class postpipeline:
+    # 编译后的处理流程：[(postitem, 可直接调用的函数)]，按(gameuid, 模式)缓存，查找时不再检查配置。
+    # 排序、开关、跟随默认、mypost模块等在设置界面中修改后需要调用invalidate；
+    # args按引用绑定，设置界面里原地修改参数无需重建。
+    def __init__(self):
+        self.pipelines = {}
+
+    def invalidate(self):
+        # 整个替换，正在编译的旧结果只会写入旧的字典
+        self.pipelines = {}
+
+    @staticmethod
+    def getusing():
+        useranklist = globalconfig["postprocess_rank"]
+        usedpostprocessconfig = postprocessconfig
+        usemypostpath = "mypost.py"
+        usemodule = "mypost"
+        try:
+
+            gameuid = gobject.base.gameuid
+            if gameuid and not savehook_new_data[gameuid].get(
+                "textproc_follow_default", True
+            ):
+                info = savehook_new_data[gameuid]["save_text_process_info"]
+                useranklist = info["rank"]
+                usedpostprocessconfig = info["postprocessconfig"]
+                if info.get("mypost", None):
+                    usemodule = "posts." + info["mypost"]
+                    usemypostpath = "posts/{}.py".format(info["mypost"])
+        except:
+            print_exc()
+        return useranklist, usedpostprocessconfig, usemypostpath, usemodule
+
+    @staticmethod
+    def bind(postitem, itemconfig, usemypostpath, usemodule):
+        _f = processfunctions[postitem]
+        if postitem == "_11":
+            path = gobject.getconfig(usemypostpath)
+            return lambda line: _f(line, path, usemodule)
+        np = processfunctions_nparams[postitem]
+        if np == 1:
+            return _f
+        elif np == 2:
+            return lambda line: _f(line, itemconfig.get("args", {}))
+        raise Exception("unsupported parameters num")
+
+    def compile(self, using, isEx, isFromHook, useAll):
+        useranklist, usedpostprocessconfig, usemypostpath, usemodule = using
+        pipeline = []
+        for postitem in useranklist:
+            if postitem not in processfunctions:
+                continue
+            if postitem not in usedpostprocessconfig:
+                continue
+            itemconfig = usedpostprocessconfig[postitem]
+            if not itemconfig["use"]:
+                continue
             if not useAll:
-                if isEx and not (usedpostprocessconfig[postitem].get("isExUse", False)):
+                if isEx and not (itemconfig.get("isExUse", False)):
                     continue
-                if (not isFromHook) and (
-                    usedpostprocessconfig[postitem].get("isHookOnly", False)
-                ):
+                if (not isFromHook) and (itemconfig.get("isHookOnly", False)):
                     continue
             try:
-                _f = processfunctions[postitem]
-                if postitem == "_11":
-                    line = processfunctions[postitem](
-                        line, gobject.getconfig(usemypostpath), usemodule
-                    )
-                else:
-                    sig = inspect.signature(_f)
-                    np = len(sig.parameters)
-                    if np == 1:
-                        line = processfunctions[postitem](line)
-                    elif np == 2:
-                        line = processfunctions[postitem](
-                            line, usedpostprocessconfig[postitem].get("args", {})
-                        )
-                    else:
-                        raise Exception("unsupported parameters num")
-
+                pipeline.append(
+                    (postitem, self.bind(postitem, itemconfig, usemypostpath, usemodule))
+                )
             except:
                 print_exc()
+        return pipeline
+
+    def get(self, isEx, isFromHook, useAll):
+        pipelines = self.pipelines
+        gameuid = getattr(gobject.base, "gameuid", 0)
+        key = (gameuid, bool(isEx), bool(isFromHook), bool(useAll))
+        pipeline = pipelines.get(key)
+        if pipeline is None:
+            pipeline = self.compile(self.getusing(), *key[1:])
+            pipelines[key] = pipeline
+        return pipeline
+
+
+_postpipeline = postpipeline()
+
+
+def invalidatepostpipeline(*_):
+    # 可以直接作为设置界面控件的回调
+    _postpipeline.invalidate()
+
+
+def POSTSOLVE(line: str, isEx=False, isFromHook=False, useAll=False) -> str:
+    if not line:
+        return ""
+    for _, _f in _postpipeline.get(isEx, isFromHook, useAll):
+        try:
+            line = _f(line)
+        except:
+            print_exc()
     return line
@@ -1,16 +1,22 @@
 import sqlite3, gobject, time, windows
 import time
 import os
+import NativeUtils
 from qtsymbols import *
-from myutils.config import findgameuidofpath, globalconfig
-from myutils.hwnd import ListProcess
-from myutils.wrapper import threader
+from myutils.config import (
+    findgameuidofpath,
+    globalconfig,
+    savehook_new_list,
+    gamepath2uid_index,
+)
+from myutils.playtimetracker import playtimetracker
 import windows
 import gobject
 
 
 class somedatabase:
     def all(self):
+        self.tracker.flush()
         res = self.sqlsavegameinfo.execute(
             "SELECT gameinternalid_v2.gameuid, trace_strict.timestart, trace_strict.timestop FROM gameinternalid_v2 JOIN trace_strict ON gameinternalid_v2.gameinternalid = trace_strict.gameinternalid "
         ).fetchall()
@@ -98,6 +104,7 @@ class somedatabase:
     def querytraceplaytime(self, gameuid):
         table = ["trace_loose", "trace_strict"][globalconfig["is_tracetime_strict"]]
         gameinternalid = self.get_gameinternalid(gameuid)
+        self.tracker.flush()
         return self.sqlsavegameinfo.execute(
             "SELECT timestart,timestop FROM {} WHERE gameinternalid = ?".format(table),
             (gameinternalid,),
@@ -131,59 +138,57 @@ class somedatabase:
                 exes.add(windows.GetProcessFileName(gamepid))
         return exes
 
-    def finduids(self, exes):
-        uids = []
-        for exe in exes:
-            uid, _ = findgameuidofpath(exe)
-            if not uid:
-                continue
-            uids.append(uid)
-        return uids
+    def savesessions(self, sessions: list):
+        # 由playtimetracker批量调用，同一个事务里写入
+        ids = {}
+        for _, uid, _, _, _ in sessions:
+            if uid not in ids:
+                ids[uid] = self.get_gameinternalid(uid)
+        self.sqlsavegameinfo.execute("BEGIN")
+        try:
+            for table, uid, timestart, timestop, inserted in sessions:
+                if inserted:
+                    self.sqlsavegameinfo.execute(
+                        "UPDATE {} SET timestop = ? WHERE (gameinternalid = ? and timestart = ?)".format(
+                            table
+                        ),
+                        (timestop, ids[uid], timestart),
+                    )
+                else:
+                    self.sqlsavegameinfo.execute(
+                        "INSERT INTO {} VALUES(?,?,?)".format(table),
+                        (ids[uid], timestart, timestop),
+                    )
+            self.sqlsavegameinfo.execute("COMMIT")
+        except:
+            self.sqlsavegameinfo.execute("ROLLBACK")
+            raise
 
-    def tracex(self, _t: float, uids: list, dic: dict, table: str):
-        for uid in uids:
-            gameinternalid = self.get_gameinternalid(uid)
-            if uid in dic:
-                self.sqlsavegameinfo.execute(
-                    "UPDATE {} SET timestop = ? WHERE (gameinternalid = ? and timestart = ?)".format(
-                        table
-                    ),
-                    (_t, gameinternalid, dic[uid]),
-                )
+    def checkgameplayingthread(self):
+        self.tracker = playtimetracker(
+            processprovider(self.stricttraceexe),
+            lambda exe: findgameuidofpath(exe)[0],
+            gamelistsstamp,
+            self.savesessions,
+        )
+        self.tracker.start()
 
-            else:
-                dic[uid] = _t
-                self.sqlsavegameinfo.execute(
-                    "INSERT INTO {} VALUES(?,?,?)".format(table),
-                    (gameinternalid, _t, _t),
-                )
-        for k in list(dic.keys()):
-            if k not in uids:
-                dic.pop(k)
 
-    @threader
-    def checkgameplayingthread(self):
-        self.trace_loose = {}
-        self.trace_strict = {}
-        tlast = None
-        t = time.time()
-        while True:
-            tlast = t
-            t = time.time()
-            if t - tlast > 10:
-                # 虚拟机暂停
-                self.trace_loose.clear()
-                self.trace_strict.clear()
-                continue
+class processprovider:
+    def __init__(self, foregroundexes):
+        self.foregroundexes = foregroundexes
 
-            self.tracex(
-                t, self.finduids(ListProcess()), self.trace_loose, "trace_loose"
-            )
-            self.tracex(
-                t,
-                self.finduids(self.stricttraceexe()),
-                self.trace_strict,
-                "trace_strict",
-            )
-            self.sqlsavegameinfo.commit()
-            time.sleep(5)
+    def listprocesses(self):
+        pid = os.getpid()
+        return [_ for _ in NativeUtils.ListProcesses() if _[0] != pid]
+
+    def getprocessfilename(self, pid):
+        return windows.GetProcessFileName(pid)
+
+
+def gamelistsstamp():
+    # 游戏列表或者游戏路径变化时，之前 路径->gameuid 的查找结果失效
+    return (
+        len(savehook_new_list),
+        hash(frozenset(k for k, v in gamepath2uid_index.items() if v)),
+    )
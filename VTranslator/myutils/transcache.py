@@ -0,0 +1,231 @@
+import hashlib, sys
+import sqlite3
+import queue, threading
+from collections import OrderedDict
+from traceback import print_exc
+from myutils.utils import autosql
+from myutils.config import globalconfig
+
+
+def sourcehash(source: str) -> int:
+    # 64位整数作为键，比直接给长文本建索引小得多。查询时仍会比对source，碰撞不会返回错误结果。
+    return int.from_bytes(
+        hashlib.md5(source.encode("utf8")).digest()[:8], "little", signed=True
+    )
+
+
+class longtermcache:
+    # cache/<engine>.sqlite
+    # 旧版表cache(srclang,tgtlang,source,trans)没有任何索引，每次未命中都是全表扫描，DELETE+INSERT也是逐句自动提交。
+    # 新版表cache_v2以(srclang,tgtlang,sourcehash)为唯一键，WAL模式下读写分离，写入线程批量提交。
+    batchsize = 256
+
+    def __init__(self, path: str):
+        self.path = path
+        self.writequeue = queue.Queue()
+        self.writer = autosql(path, check_same_thread=False, isolation_level=None)
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.writer.execute("PRAGMA synchronous=NORMAL")
+        self.writer.execute(
+            "CREATE TABLE IF NOT EXISTS cache_v2(srclang TEXT,tgtlang TEXT,sourcehash INTEGER,source TEXT,trans TEXT);"
+        )
+        self.writer.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS cache_v2_key ON cache_v2(srclang,tgtlang,sourcehash);"
+        )
+        self.reader = autosql(path, check_same_thread=False, isolation_level=None)
+        self.needmigrate = bool(
+            self.writer.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name='cache'"
+            ).fetchone()
+        )
+
+    def migrate(self):
+        # 旧表一次性导入新表后删除。旧版中同一句子可能被写入多次，按rowid顺序REPLACE保留最后一次的结果。
+        if not self.needmigrate:
+            return
+        self.writer.create_function("sourcehash", 1, sourcehash)
+        try:
+            self.writer.execute("BEGIN")
+            self.writer.execute(
+                "INSERT OR REPLACE INTO cache_v2 SELECT srclang,tgtlang,sourcehash(source),source,trans FROM cache WHERE typeof(source)='text' ORDER BY rowid"
+            )
+            self.writer.execute("DROP TABLE cache")
+            self.writer.execute("COMMIT")
+        except:
+            print_exc()
+            self.writer.execute("ROLLBACK")
+        self.needmigrate = False
+
+    def get(self, langpairs: "list[tuple[str, str]]", source: str):
+        h = sourcehash(source)
+        for srclang, tgtlang in langpairs:
+            ret = self.reader.execute(
+                "SELECT trans FROM cache_v2 WHERE srclang=? AND tgtlang=? AND sourcehash=? AND source=?",
+                (srclang, tgtlang, h, source),
+            ).fetchone()
+            if ret:
+                return ret[0]
+        return None
+
+    def put(self, srclang: str, tgtlang: str, source: str, trans: str):
+        self.writequeue.put((srclang, tgtlang, sourcehash(source), source, trans))
+
+    def end(self):
+        self.writequeue.put(None)
+
+    def __write(self, tasks: list):
+        try:
+            self.writer.execute("BEGIN")
+            self.writer.executemany(
+                "INSERT OR REPLACE INTO cache_v2 VALUES(?,?,?,?,?)", tasks
+            )
+            self.writer.execute("COMMIT")
+        except sqlite3.Error:
+            print_exc()
+            try:
+                self.writer.execute("ROLLBACK")
+            except:
+                pass
+
+    def writethread(self, checkrunning):
+        try:
+            self.migrate()
+        except:
+            print_exc()
+        while checkrunning():
+            task = self.writequeue.get()
+            if task is None:
+                break
+            tasks = [task]
+            end = False
+            # 把已经堆积在队列里的请求合并到同一个事务里
+            while len(tasks) < self.batchsize:
+                try:
+                    task = self.writequeue.get_nowait()
+                except queue.Empty:
+                    break
+                if task is None:
+                    end = True
+                    break
+                tasks.append(task)
+            self.__write(tasks)
+            if end:
+                break
+
+
+class shorttermcache:
+    # 内存中的翻译缓存，所有翻译器共用一个实例。
+    # 每个翻译器各自一个按访问顺序排列的OrderedDict，按字节计数：
+    # 单个翻译器超过上限时淘汰自己最久未使用的条目；总量超过上限时从占用最多的翻译器淘汰。
+    def __init__(self, enginelimit: int, globallimit: int):
+        self.lock = threading.Lock()
+        self.enginelimit = enginelimit
+        self.globallimit = globallimit
+        self.engines = {}  # type: dict[str, OrderedDict]
+        self.enginesize = {}  # type: dict[str, int]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def sizeof(key, value):
+        # 键是(srclang, tgtlang, 原文)，getsizeof只算元组本身，需要加上其中每一项
+        size = sys.getsizeof(value)
+        if isinstance(key, tuple):
+            size += sys.getsizeof(key) + sum(sys.getsizeof(_) for _ in key)
+        else:
+            size += sys.getsizeof(key)
+        return size
+
+    def setlimit(self, enginelimit: int, globallimit: int):
+        with self.lock:
+            self.enginelimit = enginelimit
+            self.globallimit = globallimit
+            for engine in list(self.engines):
+                self.__shrink(engine)
+
+    def get(self, engine: str, key):
+        with self.lock:
+            cache = self.engines.get(engine)
+            if cache is None or key not in cache:
+                self.misses += 1
+                return None
+            cache.move_to_end(key)
+            self.hits += 1
+            return cache[key][0]
+
+    def set(self, engine: str, key, value):
+        size = self.sizeof(key, value)
+        with self.lock:
+            if engine not in self.engines:
+                self.engines[engine] = OrderedDict()
+                self.enginesize[engine] = 0
+            cache = self.engines[engine]
+            if key in cache:
+                self.__remove(engine, key)
+            cache[key] = value, size
+            self.enginesize[engine] += size
+            self.size += size
+            self.__shrink(engine)
+
+    def clear(self, engine: str = None):
+        with self.lock:
+            for _ in [engine] if engine else list(self.engines):
+                self.size -= self.enginesize.pop(_, 0)
+                self.engines.pop(_, None)
+
+    def stats(self, engine: str = None):
+        with self.lock:
+            if engine:
+                return {
+                    "size": self.enginesize.get(engine, 0),
+                    "count": len(self.engines.get(engine, ())),
+                }
+            return {
+                "size": self.size,
+                "count": sum(len(_) for _ in self.engines.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def __remove(self, engine, key):
+        _, size = self.engines[engine].pop(key)
+        self.enginesize[engine] -= size
+        self.size -= size
+
+    def __evictoldest(self, engine):
+        _, (__, size) = self.engines[engine].popitem(last=False)
+        self.enginesize[engine] -= size
+        self.size -= size
+        self.evictions += 1
+
+    def __shrink(self, engine):
+        while self.enginesize[engine] > self.enginelimit and self.engines[engine]:
+            self.__evictoldest(engine)
+        while self.size > self.globallimit:
+            largest = max(self.enginesize, key=self.enginesize.get)
+            if not self.engines[largest]:
+                break
+            self.__evictoldest(largest)
+
+
+__shorttermcache = None
+__shorttermcachelock = threading.Lock()
+
+
+def getshorttermcache() -> shorttermcache:
+    global __shorttermcache
+    enginelimit = globalconfig["shorttermcache_engine_mb"] * 1024 * 1024
+    globallimit = globalconfig["shorttermcache_global_mb"] * 1024 * 1024
+    with __shorttermcachelock:
+        if __shorttermcache is None:
+            __shorttermcache = shorttermcache(enginelimit, globallimit)
+        elif (__shorttermcache.enginelimit, __shorttermcache.globallimit) != (
+            enginelimit,
+            globallimit,
+        ):
+            # 设置中修改了上限
+            __shorttermcache.setlimit(enginelimit, globallimit)
+    return __shorttermcache
@@ -0,0 +1,148 @@
+import os, time, hashlib, sqlite3
+import queue, threading
+from collections import OrderedDict
+from traceback import print_exc
+import gobject
+from myutils.utils import autosql
+from myutils.config import globalconfig
+
+
+class ttsdiskcache:
+    # cache/tts下按内容寻址保存合成好的音频，所有tts引擎和/api/tts共用一个实例。
+    # 键为(引擎, 声音, 语速, 音调, 文本)的sha1，文件为<键的前两位>/<键>。
+    # index.sqlite记录每个文件的mime、大小和最近访问时间，启动时按访问时间读入内存，之后查找只看内存；
+    # 总大小超过limit时淘汰最久未访问的文件。索引的修改交给后台线程批量提交。
+    batchsize = 256
+
+    def __init__(self, directory: str, limit: int):
+        self.directory = directory
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # type: OrderedDict[str, tuple[str, int]]
+        self.size = 0
+        self.writequeue = queue.Queue()
+        os.makedirs(directory, exist_ok=True)
+        self.db = autosql(
+            os.path.join(directory, "index.sqlite"),
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries(key TEXT PRIMARY KEY,mime TEXT,size INTEGER,atime REAL);"
+        )
+        for key, mime, size in self.db.execute(
+            "SELECT key,mime,size FROM entries ORDER BY atime"
+        ):
+            self.entries[key] = mime, size
+            self.size += size
+        threading.Thread(target=self.__writethread, daemon=True).start()
+
+    @staticmethod
+    def hashkey(key) -> str:
+        # key需要有稳定的repr
+        return hashlib.sha1(repr(key).encode("utf8")).hexdigest()
+
+    def __path(self, key: str):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str) -> "tuple[bytes, str]":
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+        try:
+            with open(self.__path(key), "rb") as ff:
+                data = ff.read()
+        except OSError:
+            # 文件被手动删除了
+            self.__discard(key)
+            return None
+        self.writequeue.put(("UPDATE entries SET atime=? WHERE key=?", (time.time(), key)))
+        return data, entry[0]
+
+    def put(self, key: str, data: bytes, mime: str):
+        if not data or len(data) > self.limit:
+            return
+        path = self.__path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as ff:
+                ff.write(data)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            print_exc()
+            return
+        evicted = []
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.size -= old[1]
+            self.entries[key] = mime, len(data)
+            self.size += len(data)
+            while self.size > self.limit and len(self.entries) > 1:
+                _, (__, size) = self.entries.popitem(last=False)
+                self.size -= size
+                evicted.append(_)
+        self.writequeue.put(
+            (
+                "INSERT OR REPLACE INTO entries VALUES(?,?,?,?)",
+                (key, mime, len(data), time.time()),
+            )
+        )
+        for _ in evicted:
+            self.__remove(_)
+
+    def __discard(self, key: str):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry:
+                self.size -= entry[1]
+        self.writequeue.put(("DELETE FROM entries WHERE key=?", (key,)))
+
+    def __remove(self, key: str):
+        try:
+            os.remove(self.__path(key))
+        except OSError:
+            pass
+        self.writequeue.put(("DELETE FROM entries WHERE key=?", (key,)))
+
+    def __writethread(self):
+        while True:
+            tasks = [self.writequeue.get()]
+            # 把已经堆积在队列里的修改合并到同一个事务里
+            while len(tasks) < self.batchsize:
+                try:
+                    tasks.append(self.writequeue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.db.execute("BEGIN")
+                for sql, args in tasks:
+                    self.db.execute(sql, args)
+                self.db.execute("COMMIT")
+            except sqlite3.Error:
+                print_exc()
+                try:
+                    self.db.execute("ROLLBACK")
+                except:
+                    pass
+
+
+_cache = None
+_lock = threading.Lock()
+
+
+def getttscache() -> ttsdiskcache:
+    # ttsdiskcache_mb为0时不使用磁盘缓存
+    global _cache
+    limit = globalconfig["ttsdiskcache_mb"] * 1024 * 1024
+    if limit <= 0:
+        return None
+    with _lock:
+        if _cache is None:
+            _cache = ttsdiskcache(gobject.getcachedir("tts"), limit)
+    _cache.limit = limit
+    return _cache
@@ -0,0 +1,93 @@
+import re, threading
+from collections import deque, OrderedDict
+from traceback import print_exc
+
+# 句末标点，之后(可能跟着的引号括号)为一个完整的句子
+_sentenceend = re.compile(r"[。！？!?…\n][」』）)\"'”’】]*")
+
+
+def completedprefix(text: str) -> str:
+    # 流式输出中到最后一个句末为止的部分
+    end = 0
+    for m in _sentenceend.finditer(text):
+        end = m.end()
+    return text[:end].rstrip("\n")
+
+
+class ttsprefetcher:
+    # 在后台预先合成接下来可能朗读的文本，结果进入tts的内存和磁盘缓存；
+    # 真正朗读时直接命中缓存，或者接上还没结束的这次合成(见tts.basettsclass.ttsflight)。
+    # 每个来源(group)至多保留lookahead条还没开始的请求，更新的请求把最旧的挤掉，是上一条的延长时直接替换它；
+    # 同一来源更短的版本还在合成中时，延长的版本直接跳过，不重复合成；
+    # cancel丢弃来源中还没开始的请求。
+    # resolve(text, isorigin) -> (reader, 实际朗读的文本) 或 None，与朗读时选择引擎和修正文本的方式相同。
+    lookahead = 2
+
+    def __init__(self, resolve):
+        self.resolve = resolve
+        self.cond = threading.Condition()
+        self.pending = OrderedDict()  # type: OrderedDict[str, deque]
+        self.last = {}
+        self.inflight = {}
+        self.thread = None
+
+    def put(self, group: str, text: str, isorigin: bool):
+        if not text:
+            return
+        with self.cond:
+            # 流式输出每来一块都会调用，同一句只放一次
+            if self.last.get(group) == (text, isorigin):
+                return
+            self.last[group] = text, isorigin
+            inflight = self.inflight.get(group)
+            if inflight and inflight[1] == isorigin and text.startswith(inflight[0]):
+                # 流式输出中同一句的较短版本正在合成，再合成更长的版本几乎都是重复的工作
+                return
+            queue = self.pending.get(group)
+            if queue is None:
+                queue = self.pending[group] = deque(maxlen=self.lookahead)
+            if queue and queue[-1][1] == isorigin and text.startswith(queue[-1][0]):
+                # 流式输出中同一句的更长版本，还没开始的旧请求不需要了
+                queue[-1] = text, isorigin
+            else:
+                queue.append((text, isorigin))
+            if not self.thread:
+                self.thread = threading.Thread(target=self.__run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def cancel(self, group: str = None):
+        with self.cond:
+            if group is None:
+                self.pending.clear()
+                self.last.clear()
+            else:
+                self.pending.pop(group, None)
+                self.last.pop(group, None)
+
+    def __take(self):
+        with self.cond:
+            while True:
+                for group, queue in self.pending.items():
+                    if queue:
+                        # 各来源轮流
+                        self.pending.move_to_end(group)
+                        item = self.inflight[group] = queue.popleft()
+                        return group, item
+                self.cond.wait()
+
+    def __run(self):
+        while True:
+            group, item = self.__take()
+            try:
+                _ = self.resolve(*item)
+                if not _:
+                    continue
+                reader, text = _
+                reader.prefetch(text)
+            except:
+                print_exc()
+            finally:
+                with self.cond:
+                    if self.inflight.get(group) is item:
+                        self.inflight.pop(group)
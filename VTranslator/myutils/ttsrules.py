@@ -0,0 +1,178 @@
+import re, types
+from myutils.config import globalconfig, savehook_new_data
+from myutils.utils import (
+    safe_escape,
+    compilereplacerules,
+    replacerulesversion,
+    LRUCache,
+)
+
+
+def compileregex(key):
+    try:
+        return re.compile(key)
+    except re.error:
+        # 保持原来的行为：检查到这条规则时报错
+        return types.SimpleNamespace(
+            search=lambda s: re.search(key, s), match=lambda s: re.match(key, s)
+        )
+
+
+class ttsskipmatcher:
+    # 朗读的跳过/指定规则。按原来逐条检查的语义，返回第一条命中的规则：
+    # 非正则的“开头或结尾”规则放进按长度分组的字典，只需按长度切片查表；
+    # 纯ASCII的“包含”规则在文本也是纯ASCII时按空格分词查表，否则与其他“包含”规则一样做子串判断；
+    # 正则预先编译。查表得到的最小序号之后的规则不再检查。
+    def __init__(self, items: "list[dict]"):
+        self.items = items
+        self.compiled = {True: self.__compile(True), False: self.__compile(False)}
+
+    def __compile(self, isorigin):
+        prefix = {}  # type: dict[int, dict[str, int]]
+        suffix = {}  # type: dict[int, dict[str, int]]
+        words = {}  # type: dict[str, int]
+        ordered = []  # [(index, predicate)]
+        asciiordered = []
+        for index, item in enumerate(self.items):
+            range_ = item.get("range", 0)
+            if range_ and ((range_ == 1) ^ isorigin):
+                continue
+            key = item["key"]
+            condition = item["condition"]
+            if item["regex"]:
+                pattern = compileregex(safe_escape(key))
+                if condition == 1:
+                    ordered.append((index, pattern.search))
+                elif condition == 0:
+                    # 用^xxx|xxx$有可能有点危险
+                    end = compileregex(safe_escape(key) + "[\n\r]*$")
+                    ordered.append(
+                        (index, lambda s, p=pattern, e=end: p.match(s) or e.search(s))
+                    )
+            elif condition == 1:
+                if key.isascii() and (" " not in key):  # 目标可能有空格
+                    words.setdefault(key, index)
+                    asciiordered.append((index, lambda s, k=key: k in s))
+                else:
+                    ordered.append((index, lambda s, k=key: k in s))
+            elif condition == 0:
+                prefix.setdefault(len(key), {}).setdefault(key, index)
+                if key:
+                    suffix.setdefault(len(key), {}).setdefault(key, index)
+        # 纯ASCII的“包含”规则在文本不是纯ASCII时按子串判断，与其他规则按序号合并
+        ordered.sort(key=lambda _: _[0])
+        merged = sorted(ordered + asciiordered, key=lambda _: _[0])
+        return prefix, suffix, words, ordered, merged
+
+    def match(self, res: str, isorigin: bool) -> dict:
+        prefix, suffix, words, ordered, merged = self.compiled[isorigin]
+        best = None
+        for length, table in prefix.items():
+            index = table.get(res[:length])
+            if index is not None and (best is None or index < best):
+                best = index
+        if suffix:
+            stripped = res.rstrip("\n\r")
+            for length, table in suffix.items():
+                index = table.get(stripped[-length:])
+                if index is not None and (best is None or index < best):
+                    best = index
+        if res.isascii():
+            for word in res.split(" "):
+                index = words.get(word)
+                if index is not None and (best is None or index < best):
+                    best = index
+        else:
+            ordered = merged
+        for index, predicate in ordered:
+            if best is not None and index >= best:
+                break
+            if predicate(res):
+                best = index
+                break
+        if best is None:
+            return None
+        return self.items[best]
+
+
+class ttsrules:
+    # 一个游戏(或全局)生效的朗读跳过/修正规则。开关直接读设置，规则列表编译一次
+    def __init__(self, usedict: dict, skipitems: list, repairitems: list):
+        self.usedict = usedict
+        self.skipmatcher = ttsskipmatcher(skipitems)
+        self.repairsteps = compilereplacerules(repairitems)
+
+    @property
+    def skip(self):
+        return self.usedict.get("tts_skip", False)
+
+    @property
+    def repair(self):
+        return self.usedict.get("tts_repair", False)
+
+    @property
+    def process(self):
+        return self.usedict.get("ttsprocess_use", False)
+
+    @property
+    def processpath(self):
+        return self.usedict.get("ttsprocess_path")
+
+    def match(self, text, isorigin) -> dict:
+        if not self.skip:
+            return None
+        return self.skipmatcher.match(text, isorigin)
+
+    def replace(self, text):
+        for step in self.repairsteps:
+            text = step(text)
+        return text
+
+
+def __source(gameuid):
+    # -> 缓存键中表示规则来源的部分：使用全局设置时为None
+    try:
+        if gameuid and not savehook_new_data[gameuid].get("tts_follow_default", True):
+            game = savehook_new_data[gameuid]
+            return (
+                gameuid,
+                game.get("tts_skip_merge", False),
+                game.get("tts_repair_merge", False),
+            )
+    except:
+        pass
+    return None
+
+
+def __sources(source):
+    # -> (生效的设置, 跳过规则, 修正规则)，不再深拷贝合并后的设置
+    common = globalconfig["ttscommon"]
+    if source is None:
+        return (
+            common,
+            common.get("tts_skip_regex", []),
+            common.get("tts_repair_regex", []),
+        )
+    gameuid, skipmerge, repairmerge = source
+    game = savehook_new_data[gameuid]
+    skip = game.get("tts_skip_regex", [])
+    repair = game.get("tts_repair_regex", [])
+    if skipmerge:
+        skip = skip + common["tts_skip_regex"]
+    if repairmerge:
+        repair = repair + common["tts_repair_regex"]
+    return game, skip, repair
+
+
+__rulescache = LRUCache(8)
+
+
+def getttsrules(gameuid) -> ttsrules:
+    # 规则列表只在设置界面中被原地修改，保存时增加版本号(bumpreplacerulesversion)，所以以(来源, 版本)为键缓存
+    source = __source(gameuid)
+    key = source, replacerulesversion()
+    rules = __rulescache.get(key)
+    if rules is None:
+        rules = ttsrules(*__sources(source))
+        __rulescache.put(key, rules)
+    return rules
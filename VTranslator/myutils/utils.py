@@ -25,7 +25,9 @@ import threading, winreg
 import re, heapq, NativeUtils
 from myutils.wrapper import tryprint, threader
 from html.parser import HTMLParser
+from collections import OrderedDict
 from myutils.audioplayer import bass_code_cast
+from myutils.multireplace import literalrun
 
 
 class localcachehelper:
@@ -246,6 +248,26 @@ class PriorityQueue:
         return bool(len(self._heap) == 0)
 
 
+class ratelimiter:
+    # 多个线程共用的请求间隔。每次请求预约下一个可用的时间点，并发请求依次错开，而不是各自sleep同样的时间。
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def reserve(self, interval) -> float:
+        # -> 需要等待的秒数
+        with self._lock:
+            now = time.time()
+            t = max(now, self._next)
+            self._next = t + interval
+            return t - now
+
+    def penalize(self, seconds):
+        # 被服务端限流（429）后，推迟之后的所有请求
+        with self._lock:
+            self._next = max(self._next, time.time() + seconds)
+
+
 def guessmaybetitle(gamepath, title):
 
     __t = []
@@ -556,10 +578,20 @@ def case_insensitive_replace(text: str, old: str, new: str) -> str:
     return re.sub(re.escape(old), replace_match, text, flags=re.IGNORECASE)
 
 
-@tryprint
-def parsemayberegexreplace(lst: "list[dict]", line: str) -> str:
-    if not line:
-        line = ""
+def __compileregexrule(key, value):
+    try:
+        pattern = re.compile(key)
+    except re.error:
+        # 保持原来的行为：执行到这条规则时报错
+        return lambda line: re.sub(key, value, line)
+    return lambda line: pattern.sub(value, line)
+
+
+def compilereplacerules(lst: "list[dict]"):
+    # -> [callable(line)->line]
+    # 正则规则预编译、转义预先解码；相邻的字面量规则在不改变逐条替换结果的前提下合并为一次扫描。
+    steps = []
+    run = None
     for fil in lst:
         regex = fil.get("regex", False)
         escape = fil.get("escape", regex)
@@ -567,17 +599,59 @@ def parsemayberegexreplace(lst: "list[dict]", line: str) -> str:
         value = fil.get("value", "")
         if key == "":
             continue
+        if escape:
+            key = safe_escape(key)
+            value = safe_escape(value)
         if regex:
-            if escape:
-                line = re.sub(safe_escape(key), safe_escape(value), line)
-            else:
-                line = re.sub(key, value, line)
-        else:
-            if escape:
-                line = line.replace(safe_escape(key), safe_escape(value))
-            else:
-                line = line.replace(key, value)
+            if run:
+                steps.append(run.compile())
+                run = None
+            steps.append(__compileregexrule(key, value))
+            continue
+        if run and run.tryadd(key, value):
+            continue
+        if run:
+            steps.append(run.compile())
+        run = literalrun()
+        run.tryadd(key, value)
+    if run:
+        steps.append(run.compile())
+    return steps
+
+
+__replacerulescache = None
+__replacerulesversion = 0
+
+
+def bumpreplacerulesversion():
+    # 替换规则和朗读规则只在设置界面中被原地修改，保存时调用，之前缓存的编译结果全部作废
+    global __replacerulesversion
+    __replacerulesversion += 1
+
 
+def replacerulesversion():
+    return __replacerulesversion
+
+
+@tryprint
+def parsemayberegexreplace(lst: "list[dict]", line: str, key=None) -> str:
+    # 编译结果以(key, 版本)缓存，命中时不需要检查规则内容。
+    # 规则列表每次新生成的（如游戏和全局合并），需要给出表示其来源的key，此时lst可以是返回规则列表的函数，只在未命中时调用；
+    # 否则以列表对象本身为键。
+    global __replacerulescache
+    if not line:
+        line = ""
+    if __replacerulescache is None:
+        __replacerulescache = LRUCache(16)
+    cachekey = (id(lst) if key is None else key, __replacerulesversion)
+    entry = __replacerulescache.get(cachekey)
+    if (entry is None) or (key is None and entry[0] is not lst):
+        rules = lst() if callable(lst) else lst
+        # 保留列表的引用，避免id被重用
+        entry = lst, compilereplacerules(rules if rules else [])
+        __replacerulescache.put(cachekey, entry)
+    for step in entry[1]:
+        line = step(line)
     return line
 
 
@@ -725,26 +799,78 @@ def get_time_stamp(ct=None, ms=True, forfilename=False):
 
 
 class LRUCache:
-    def __init__(self, capacity: int):
-        self.cache = {}
+    # capacity限制条目数，0为不缓存，-1为不限制。
+    # maxsize不为None时另外按sizeof(value)的总和限制，用于大小差异很大的值（如TTS音频）。
+    # ttl不为None时，超过ttl秒的条目视为不存在。
+    def __init__(self, capacity: int, maxsize: int = None, sizeof=None, ttl=None):
+        self.cache = OrderedDict()
         self.Lock = threading.Lock()
-        self.capacity = capacity
-        self.order = []
+        self.capacity = LRUCache.normalizecap(capacity)
+        self.maxsize = maxsize
+        self.sizeof = sizeof if sizeof else LRUCache.defaultsizeof
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def normalizecap(cap):
+        # -1表示不限制
+        return 9999999999 if cap == -1 else cap
+
+    @staticmethod
+    def defaultsizeof(value):
+        if isinstance(value, (bytes, bytearray, str)):
+            return len(value)
+        return 0
 
     def setcap(self, cap):
         with self.Lock:
-            if cap == -1:
-                cap = 9999999999
-            self.capacity = cap
-            while len(self.cache) > self.capacity:
-                self.cache.popitem(last=False)
+            self.capacity = LRUCache.normalizecap(cap)
+            self.__shrink()
+
+    def setmaxsize(self, maxsize):
+        with self.Lock:
+            self.maxsize = maxsize
+            self.__shrink()
+
+    def stats(self):
+        with self.Lock:
+            return dict(
+                count=len(self.cache),
+                size=self.size,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+            )
+
+    def __pop(self, key):
+        _, size, __ = self.cache.pop(key)
+        self.size -= size
+
+    def __shrink(self):
+        while self.cache and (
+            (len(self.cache) > self.capacity)
+            or (self.maxsize is not None and self.size > self.maxsize)
+        ):
+            _, (__, size, ___) = self.cache.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
 
     def __get(self, key):
-        if key in self.cache:
-            self.order.remove(key)
-            self.order.append(key)
-            return self.cache[key]
-        return None
+        _ = self.cache.get(key)
+        if _ is None:
+            self.misses += 1
+            return None
+        value, _, t = _
+        if self.ttl is not None and time.time() - t > self.ttl:
+            self.__pop(key)
+            self.misses += 1
+            return None
+        self.cache.move_to_end(key)
+        self.hits += 1
+        return value
 
     def get(self, key):
         with self.Lock:
@@ -753,13 +879,14 @@ class LRUCache:
     def __put(self, key, value=True) -> None:
         if not self.capacity:
             return
+        size = self.sizeof(value)
+        if self.maxsize is not None and size > self.maxsize:
+            return
         if key in self.cache:
-            self.order.remove(key)
-        elif len(self.order) == self.capacity:
-            old_key = self.order.pop(0)
-            del self.cache[old_key]
-        self.cache[key] = value
-        self.order.append(key)
+            self.__pop(key)
+        self.cache[key] = value, size, time.time()
+        self.size += size
+        self.__shrink()
 
     def put(self, key, value=True) -> None:
         with self.Lock:
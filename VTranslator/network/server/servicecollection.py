@@ -18,10 +18,12 @@ from network.server.servicecollection_1 import (
     transhistwsoutputsave,
     wsoutputsave,
 )
-import threading, functools
+import threading, functools, queue
 from qtsymbols import *
 from myutils.config import globalconfig, _TR, dynamicapiname
 from myutils.utils import dynamiccishuname
+from cishu.cishubase import dictsection
+from cishu.mdict import mddresource
 from tts.basettsclass import TTSResult
 
 
@@ -228,18 +230,43 @@ class APISearchWord(HTTPHandler):
     path = "/api/dictionary"
 
     def iterhelper(self, word):
+        # 按完成顺序推送。流式查询的词典先推送第一部分的完整结果，
+        # 之后以相同的id和section=true推送新完成的部分，由页面插入到对应的位置
         cnt = 0
-        ret = []
-        sema = threading.Semaphore(0)
+        results = queue.Queue()
         for k, cishu in gobject.base.cishus.items():
             cnt += 1
-            cishu.safesearch(functools.partial(self.__notify, k, sema, ret), word)
-        for _ in range(cnt):
-            sema.acquire()
-            k, result = ret[_]
+            cishu.safesearch(
+                functools.partial(self.__notifyqueue, k, results, True),
+                word,
+                partial=functools.partial(self.__notifyqueue, k, results, False),
+            )
+        streamed = set()
+        while cnt:
+            k, result, done = results.get()
+            if done:
+                cnt -= 1
             if not result:
                 continue
-            yield dict(name=_TR(dynamiccishuname(k)), result=result, id=k)
+            if isinstance(result, dictsection):
+                yield dict(
+                    name=_TR(dynamiccishuname(k)),
+                    result=mddresource.relative(result.html),
+                    id=k,
+                    section=True,
+                )
+                continue
+            if done and (k in streamed):
+                # 各部分都已经推送过了
+                continue
+            if not done:
+                streamed.add(k)
+            yield dict(
+                name=_TR(dynamiccishuname(k)), result=mddresource.relative(result), id=k
+            )
+
+    def __notifyqueue(self, k, results: queue.Queue, done, result):
+        results.put((k, result, done))
 
     def parse(self, _: RequestInfo):
         word = _.query.get("word")
@@ -259,7 +286,9 @@ class APISearchWord(HTTPHandler):
         k, result = ret[0]
         if not result:
             return {}
-        return dict(name=_TR(dynamiccishuname(k)), result=result, id=k)
+        return dict(
+            name=_TR(dynamiccishuname(k)), result=mddresource.relative(result), id=k
+        )
 
     def __notify(
         self, k, sema: "threading.Event | threading.Semaphore", ret: list, result
@@ -317,6 +346,7 @@ class BasePage(HTTPHandler):
 
 def registerall(service: TCPService):
     service.register(APISearchWord)
+    service.register(mddresource)
     service.register(APImecab)
     service.register(APITranslators)
     service.register(APIdicts)
@@ -1,23 +1,48 @@
 from network.server.tcpservice import WSHandler
 from typing import List
-from myutils.wrapper import threader
 from traceback import print_exc
+import threading, queue
 
 mainuiwsoutputsave: List["internalservicemainuiws"] = []
 transhistwsoutputsave: List["internalservicetranshistws"] = []
 wsoutputsave: List[WSHandler] = []
 
 
-@threader
-def WSForEach(LS: list, func):
-    for L in tuple(LS):
-        try:
-            func(L)
-        except Exception as e:
-            if not isinstance(e, OSError):
-                print_exc()
-            else:
+class WSBroadcaster:
+    # 所有广播在同一个线程中按顺序执行。func里的send_text只是放进各个客户端自己的发送队列，
+    # 由客户端的发送线程写出，所以一个慢的客户端不会阻塞广播线程
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def put(self, LS: list, func):
+        with self.lock:
+            if not self.thread:
+                self.thread = threading.Thread(target=self.__run, daemon=True)
+                self.thread.start()
+        self.queue.put((LS, func))
+
+    def __run(self):
+        while True:
+            LS, func = self.queue.get()
+            for L in tuple(LS):
                 try:
-                    LS.remove(L)
-                except:
-                    pass
+                    func(L)
+                except Exception as e:
+                    if not isinstance(e, OSError):
+                        print_exc()
+                    else:
+                        try:
+                            LS.remove(L)
+                        except:
+                            pass
+
+
+broadcaster = WSBroadcaster()
+
+
+def WSForEach(LS: list, func):
+    if not LS:
+        return
+    broadcaster.put(LS, func)
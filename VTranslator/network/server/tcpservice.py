@@ -1,9 +1,10 @@
 from traceback import print_exc
-import socket
+import socket, selectors, threading, queue, time
 from base64 import encodebytes as base64encode
-import hashlib, os
+import hashlib, os, functools
 import types
-import io, json, struct
+import json, struct
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import parse_qsl, urlsplit
 from network.structures import CaseInsensitiveDict
 from myutils.wrapper import threader
@@ -12,9 +13,10 @@ from myutils.config import globalconfig
 
 
 class ResponseWithHeader:
-    def __init__(self, data, headers):
+    def __init__(self, data, headers, code=200):
         self.headers = headers
         self.data = data
+        self.code = code
 
 
 class FileResponse:
@@ -35,7 +37,10 @@ class RedirectResponse:
 class ResponseInfo:
     @staticmethod
     def _404(sock: socket.socket):
-        ResponseInfo(404, "Not Found", body="Not Found").write(sock)
+        try:
+            ResponseInfo(404, "Not Found", body="Not Found").write(sock)
+        except:
+            pass
         sock.close()
 
     def __init__(
@@ -45,6 +50,7 @@ class ResponseInfo:
         version="HTTP/1.1",
         headers: CaseInsensitiveDict = {},
         body=None,
+        keepalive=False,
     ):
         self.code, self.reason, self.headers = (
             code,
@@ -55,6 +61,7 @@ class ResponseInfo:
         self.headers["Access-Control-Allow-Origin"] = "*"
         if isinstance(body, ResponseWithHeader):
             self.headers.update(body.headers)
+            self.code = body.code
             body = body.data
         if isinstance(body, bytes):
             self.headers["Content-Length"] = len(body)
@@ -75,6 +82,13 @@ class ResponseInfo:
             body = None
         elif isinstance(body, types.GeneratorType):
             self.headers["Content-Type"] = "text/event-stream; charset=utf-8"
+            # 长度未知，只能以关闭连接结束
+            keepalive = False
+        if body is None and keepalive:
+            self.headers["Content-Length"] = 0
+        self.keepalive = keepalive
+        if "Connection" not in self.headers:
+            self.headers["Connection"] = ("close", "keep-alive")[keepalive]
         self.body = body
 
     def write(self, client_socket: socket.socket):
@@ -82,25 +96,40 @@ class ResponseInfo:
         for k, v in self.headers.items():
             resp += "{}: {}\r\n".format(k, v)
         resp += "\r\n"
-        client_socket.send(resp.encode())
+        head = resp.encode()
+        if isinstance(self.body, bytes) and len(self.body) <= 0x10000:
+            # 小的响应和头合并成一次发送
+            client_socket.sendall(head + self.body)
+            return
+        client_socket.sendall(head)
         if not self.body:
             return
         if isinstance(self.body, bytes):
-            client_socket.send(self.body)
+            client_socket.sendall(self.body)
         elif isinstance(self.body, FileResponse):
-            with open(self.body.filename, "rb") as ff:
-                while True:
-                    bs = ff.read(1024)
-                    if not bs:
-                        break
-                    client_socket.send(bs)
+            self.__sendfile(client_socket, self.body.filename)
         elif isinstance(self.body, types.GeneratorType):
             for body in self.body:
                 if isinstance(body, str):
                     body: bytes = body.encode()
                 elif isinstance(body, (dict, list, tuple)):
                     body: bytes = json.dumps(body, ensure_ascii=False).encode()
-                client_socket.send(b"data: " + body + b"\n\n")
+                client_socket.sendall(b"data: " + body + b"\n\n")
+
+    @staticmethod
+    def __sendfile(client_socket: socket.socket, filename):
+        with open(filename, "rb") as ff:
+            if hasattr(os, "sendfile"):
+                client_socket.sendfile(ff)
+                return
+            # Windows上socket.sendfile会退回到8KB一块的send，不如直接用大缓冲区
+            buff = bytearray(0x40000)
+            view = memoryview(buff)
+            while True:
+                size = ff.readinto(buff)
+                if not size:
+                    break
+                client_socket.sendall(view[:size])
 
 
 class RequestBody:
@@ -112,11 +141,56 @@ class RequestBody:
         return json.loads(self.bs.decode())
 
 
+class SocketReader:
+    # 每个连接一个，按块recv，多读出来的数据留给同一连接上的下一个请求
+    maxheadersize = 0x100000
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.buffer = b""
+
+    def readuntil(self, sep: bytes):
+        # -> 到sep为止的数据（不含sep），连接在此之前关闭时返回None
+        start = 0
+        while True:
+            idx = self.buffer.find(sep, start)
+            if idx != -1:
+                data = self.buffer[:idx]
+                self.buffer = self.buffer[idx + len(sep) :]
+                return data
+            if len(self.buffer) > self.maxheadersize:
+                raise Exception()
+            start = max(0, len(self.buffer) - len(sep) + 1)
+            bs = self.sock.recv(0x10000)
+            if not bs:
+                return None
+            self.buffer += bs
+
+    def readexactly(self, size: int):
+        chunks = [self.buffer[:size]]
+        self.buffer = self.buffer[size:]
+        left = size - len(chunks[0])
+        while left > 0:
+            bs = self.sock.recv(min(left, 0x40000))
+            if not bs:
+                return None
+            chunks.append(bs)
+            left -= len(bs)
+        return b"".join(chunks)
+
+
 class RequestInfo:
     @property
     def log(self):
         return "{} {}".format(self.method, self.rawpath)
 
+    @property
+    def keepalive(self):
+        connection = self.headers.get("Connection", "").lower()
+        if self.version.upper() == "HTTP/1.1":
+            return "close" not in connection
+        return "keep-alive" in connection
+
     def __str__(self):
         vis = dict(
             method=self.method,
@@ -127,14 +201,18 @@ class RequestInfo:
         return str(vis)
 
     @staticmethod
-    def readfrom(client_socket: socket.socket):
-        fp = client_socket.makefile("rb")
-        info = RequestInfo._parseheader(RequestInfo._read_headers(fp))
+    def readfrom(reader: SocketReader):
+        # 连接在请求开始前被关闭（keep-alive的连接空闲后客户端断开）时返回None
+        head = reader.readuntil(b"\r\n\r\n")
+        if head is None:
+            return None
+        lines = [_ for _ in head.decode("iso-8859-1").split("\r\n") if _]
+        info = RequestInfo._parseheader(lines)
         clen = info.headers.get("Content-Length")
         if clen:
             try:
                 clen = int(clen)
-                info.body = RequestBody(fp.read(clen))
+                info.body = RequestBody(reader.readexactly(clen))
             except:
                 pass
         return info
@@ -161,29 +239,6 @@ class RequestInfo:
             header[line[:idx]] = line[idx + 2 :]
         return RequestInfo(method, path, version, CaseInsensitiveDict(header))
 
-    @staticmethod
-    def _read_headers(fp: io.TextIOWrapper):
-        """Reads potential header lines into a list from a file pointer.
-
-        Length of line is limited by _MAXLINE, and number of
-        headers is limited by _MAXHEADERS.
-        """
-        headers = []
-        while True:
-            line: bytes = fp.readline(65536 + 1)
-            if len(line) > 65536:
-                raise Exception()
-            if len(headers) > 65536:
-                raise Exception()
-            if line in (b"\r\n", b"\n", b""):
-                break
-            line = line.decode("iso-8859-1")
-            if line.endswith("\r\n"):
-                line = line[:-2]
-            if line:
-                headers.append(line)
-        return headers
-
 
 class HandlerBase:
     path: str = ...
@@ -193,8 +248,40 @@ class HandlerBase:
     def parse(self, info: RequestInfo): ...
 
 
+def ws_unmask(payload: bytes, masking_key: bytes):
+    # 按大整数一次异或，不逐字节循环
+    size = len(payload)
+    if not size:
+        return payload
+    mask = (masking_key * (size // 4 + 1))[:size]
+    return (
+        int.from_bytes(payload, "little") ^ int.from_bytes(mask, "little")
+    ).to_bytes(size, "little")
+
+
+def ws_build_frame(opcode, payload: bytes):
+    """构建WebSocket帧"""
+    # 服务器发送不需要掩码
+    payload_length = len(payload)
+    if payload_length <= 125:
+        header = struct.pack(">BB", 0x80 | opcode, payload_length)
+    elif payload_length <= 65535:
+        header = struct.pack(">BBH", 0x80 | opcode, 126, payload_length)
+    else:
+        header = struct.pack(">BBQ", 0x80 | opcode, 127, payload_length)
+    return header + payload
+
+
+@functools.lru_cache(maxsize=16)
+def ws_text_frame(message: str):
+    # 广播时同一条消息发给所有客户端，只编码一次
+    return ws_build_frame(0x1, message.encode("utf-8"))
+
+
 class WSHandler(HandlerBase):
     path = ...
+    # 每个客户端的发送队列上限，消费太慢堆满时直接断开这个客户端，不拖慢其他客户端
+    sendqueuesize = 256
 
     def _upgrade(self, headers: dict):
         Upgrade: str = headers.get("Upgrade")
@@ -215,9 +302,12 @@ class WSHandler(HandlerBase):
 
     def __init__(self, info: RequestInfo, sock: socket.socket):
         self.sock = sock
+        self.closed = False
+        self.__sendqueue = queue.Queue(self.sendqueuesize)
         ResponseInfo(
             101, "Switching Protocols", headers=self._upgrade(info.headers)
         ).write(sock)
+        self.__send()
         self.parse(info)
         self.__recv()
 
@@ -230,15 +320,68 @@ class WSHandler(HandlerBase):
             if isinstance(msg, bool):
                 continue
             self.onmessage(msg)
+        self.close()
+
+    @threader
+    def __send(self):
+        while True:
+            frame = self.__sendqueue.get()
+            if frame is None:
+                break
+            try:
+                self.sock.sendall(frame)
+            except OSError:
+                break
+        self.closed = True
+        self.__shutdown()
+
+    def __shutdown(self):
+        try:
+            # shutdown可以打断其他线程中阻塞的recv/sendall
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.sock.close()
 
+    def close(self):
+        # 已经排队的帧（比如关闭帧）发送完再关闭；队列满时立即关闭
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.__sendqueue.put_nowait(None)
+        except queue.Full:
+            self.__shutdown()
+
+    def send_frame(self, frame: bytes):
+        # 只放进发送队列，不阻塞调用方。已断开或者被判定为太慢时抛出OSError，
+        # WSForEach据此把它从订阅列表中移除
+        if self.closed:
+            raise OSError("websocket closed")
+        try:
+            self.__sendqueue.put_nowait(frame)
+        except queue.Full:
+            self.close()
+            raise OSError("websocket client too slow")
+
+    @staticmethod
+    def __recvexactly(client_socket: socket.socket, size: int):
+        chunks = []
+        while size > 0:
+            bs = client_socket.recv(min(size, 0x40000))
+            if not bs:
+                return None
+            chunks.append(bs)
+            size -= len(bs)
+        return b"".join(chunks)
+
     @staticmethod
     def receive_frame(client_socket: socket.socket):
         """接收并解析WebSocket帧"""
         try:
             # 读取前2字节
-            header = client_socket.recv(2)
-            if len(header) < 2:
+            header = WSHandler.__recvexactly(client_socket, 2)
+            if not header:
                 return None, None
 
             first_byte, second_byte = header[0], header[1]
@@ -249,29 +392,31 @@ class WSHandler(HandlerBase):
 
             # 处理扩展长度
             if payload_length == 126:
-                extended_length = client_socket.recv(2)
-                if len(extended_length) < 2:
+                extended_length = WSHandler.__recvexactly(client_socket, 2)
+                if not extended_length:
                     return None, None
                 payload_length = struct.unpack(">H", extended_length)[0]
             elif payload_length == 127:
-                extended_length = client_socket.recv(8)
-                if len(extended_length) < 8:
+                extended_length = WSHandler.__recvexactly(client_socket, 8)
+                if not extended_length:
                     return None, None
                 payload_length = struct.unpack(">Q", extended_length)[0]
 
             # 读取掩码键
-            masking_key = client_socket.recv(4) if mask else None
+            masking_key = None
+            if mask:
+                masking_key = WSHandler.__recvexactly(client_socket, 4)
+                if not masking_key:
+                    return None, None
 
             # 读取载荷数据
-            payload = client_socket.recv(payload_length)
-            if len(payload) < payload_length:
+            payload = WSHandler.__recvexactly(client_socket, payload_length)
+            if payload is None:
                 return None, None
 
             # 如果有掩码，解码数据
-            if mask and masking_key:
-                payload = bytearray(payload)
-                for i in range(len(payload)):
-                    payload[i] ^= masking_key[i % 4]
+            if masking_key:
+                payload = ws_unmask(payload, masking_key)
 
             # 如果是文本帧，解码为字符串
             if opcode == 0x1:
@@ -302,51 +447,31 @@ class WSHandler(HandlerBase):
             self.send_close_frame(self.sock, status_code, reason)
 
         elif opcode == 0x9:  # Ping 帧
-            pong_frame = self.build_frame(0xA, payload)
-            self.sock.send(pong_frame)
+            try:
+                self.send_frame(self.build_frame(0xA, payload))
+            except OSError:
+                return
             return True
 
     def send_close_frame(
         self, client_socket: socket.socket, status_code=1000, reason=""
     ):
-        payload = struct.pack(">H", status_code) + (
+        payload = struct.pack(">H", status_code or 1000) + (
             reason.encode("utf-8") if reason else b""
         )
         frame = self.build_frame(0x8, payload)
-        client_socket.send(frame)
+        try:
+            self.send_frame(frame)
+        except OSError:
+            pass
 
     def build_frame(self, opcode, payload):
-        """构建WebSocket帧"""
-        fin = 0x80
-        frame = bytearray()
-
-        # 第一个字节: FIN + opcode
-        frame.append(fin | opcode)
-
-        # 第二个字节: MASK + 载荷长度
-        mask = 0  # 服务器发送不需要掩码
-        payload_length = len(payload)
-
-        if payload_length <= 125:
-            frame.append(mask << 7 | payload_length)
-        elif payload_length <= 65535:
-            frame.append(mask << 7 | 126)
-            frame.extend(struct.pack(">H", payload_length))
-        else:
-            frame.append(mask << 7 | 127)
-            frame.extend(struct.pack(">Q", payload_length))
-
-        # 添加载荷
-        frame.extend(payload)
-
-        return frame
+        return ws_build_frame(opcode, payload)
 
     def onmessage(self, message: str): ...
 
     def send_text(self, message: str):
-        payload = message.encode("utf-8")
-        frame = self.build_frame(0x1, payload)
-        self.sock.send(frame)
+        self.send_frame(ws_text_frame(message))
 
 
 class HTTPHandler(HandlerBase):
@@ -354,19 +479,24 @@ class HTTPHandler(HandlerBase):
     method: "str|list[str]|tuple[str]" = None
 
     def __init__(self, info: RequestInfo, client_socket: socket.socket):
+        # 响应完成后keepalive为True时连接交还给TCPService，否则关闭
+        self.keepalive = False
         try:
             if not self._checkmethod(info.method):
                 raise Exception()
             ret = self.parse(info)
-            resp = ResponseInfo(body=ret)
-            try:
-                resp.write(client_socket)
-            except:
-                print_exc()
-            client_socket.close()
         except Exception as e:
             print_exc()
             self._404(client_socket)
+            return
+        resp = ResponseInfo(body=ret, keepalive=info.keepalive)
+        try:
+            resp.write(client_socket)
+            self.keepalive = resp.keepalive
+        except:
+            print_exc()
+        if not self.keepalive:
+            client_socket.close()
 
     def _checkmethod(self, method: str):
         if not self.method:
@@ -381,41 +511,153 @@ class HTTPHandler(HandlerBase):
         ResponseInfo._404(client_socket)
 
 
+class ConnectionLoop:
+    # 一个线程用selector同时等待新连接和空闲的keep-alive连接，有请求到达时才交给线程池处理，
+    # 空闲的连接不占用工作线程，超过keepalivetimeout没有新请求就关闭。
+    def __init__(self, service: "TCPService", server_socket: socket.socket):
+        self.service = service
+        self.server_socket = server_socket
+        self.executor = ThreadPoolExecutor(service.maxworkers)
+        self.selector = selectors.DefaultSelector()
+        self.pending = queue.Queue()
+        self.stopped = threading.Event()
+        self.__wakeup_r, self.__wakeup_w = socket.socketpair()
+        self.__wakeup_r.setblocking(False)
+
+    def wakeup(self):
+        try:
+            self.__wakeup_w.send(b"\0")
+        except OSError:
+            pass
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup()
+
+    def rearm(self, reader: SocketReader):
+        # 由工作线程调用，把处理完请求的连接放回selector
+        if self.stopped.is_set():
+            reader.sock.close()
+            return
+        if reader.buffer:
+            # 客户端已经发来了下一个请求（pipelining）
+            self.executor.submit(self.service.handle_client, self, reader)
+            return
+        self.pending.put(reader)
+        self.wakeup()
+
+    @threader
+    def run(self):
+        selector = self.selector
+        selector.register(self.server_socket, selectors.EVENT_READ)
+        selector.register(self.__wakeup_r, selectors.EVENT_READ)
+        idle = {}  # type: dict[SocketReader, float]
+        timeout = self.service.keepalivetimeout
+        while not self.stopped.is_set():
+            try:
+                events = selector.select(1)
+            except (OSError, ValueError):
+                break
+            now = time.monotonic()
+            for key, _ in events:
+                if key.fileobj is self.server_socket:
+                    try:
+                        client_socket, _ = self.server_socket.accept()
+                    except OSError:
+                        continue
+                    client_socket.settimeout(timeout)
+                    self.executor.submit(
+                        self.service.handle_client, self, SocketReader(client_socket)
+                    )
+                elif key.fileobj is self.__wakeup_r:
+                    try:
+                        self.__wakeup_r.recv(0x1000)
+                    except OSError:
+                        pass
+                    while not self.pending.empty():
+                        reader = self.pending.get()
+                        try:
+                            selector.register(reader.sock, selectors.EVENT_READ, reader)
+                        except (OSError, ValueError, KeyError):
+                            reader.sock.close()
+                            continue
+                        idle[reader] = now + timeout
+                else:
+                    reader = key.data  # type: SocketReader
+                    selector.unregister(reader.sock)
+                    idle.pop(reader, None)
+                    self.executor.submit(self.service.handle_client, self, reader)
+            for reader, deadline in list(idle.items()):
+                if deadline > now:
+                    continue
+                idle.pop(reader)
+                selector.unregister(reader.sock)
+                reader.sock.close()
+        for reader in idle:
+            reader.sock.close()
+        selector.close()
+        self.__wakeup_r.close()
+        self.__wakeup_w.close()
+        self.executor.shutdown(wait=False)
+
+
 class TCPService:
+    maxworkers = 32
+    keepalivetimeout = 15
+    backlog = 128
+
     def __init__(self):
         self.server_socket = None
+        self.loop = None  # type: ConnectionLoop
         self.handlers: "list[HandlerBase]" = []
 
     def register(self, Handler):
         self.handlers.append(Handler)
 
     def stop(self):
+        if self.loop:
+            self.loop.stop()
+            self.loop = None
         if self.server_socket:
             self.server_socket.close()
 
-    def init(self, port):
+    def init(self, port, host="0.0.0.0"):
+        # port为0时由系统分配，实际端口见self.port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind(("0.0.0.0", port))
+        self.server_socket.bind((host, port))
         self.listen()
 
-    @threader
-    def listen(self):
+    @property
+    def port(self) -> int:
+        return self.server_socket.getsockname()[1]
 
-        self.server_socket.listen(1)
-        while True:
-            try:
-                client_socket, _ = self.server_socket.accept()
-            except OSError:
-                break
-            self.handle_client(client_socket)
+    def listen(self):
+        self.server_socket.listen(self.backlog)
+        self.loop = ConnectionLoop(self, self.server_socket)
+        self.loop.run()
 
     def __checkifwebsocket(self, headers: dict):
         Upgrade: str = headers.get("Upgrade")
         return Upgrade and Upgrade.lower() == "websocket"
 
-    @threader
-    def handle_client(self, client_socket: socket.socket):
-        info = RequestInfo.readfrom(client_socket)
+    def handle_client(self, loop: ConnectionLoop, reader: SocketReader):
+        try:
+            info = RequestInfo.readfrom(reader)
+        except:
+            # 超时或者请求格式错误
+            info = None
+        if not info:
+            reader.sock.close()
+            return
+        try:
+            self.__dispatch(loop, reader, info)
+        except:
+            # 在线程池中运行，异常不会自动打印
+            print_exc()
+            reader.sock.close()
+
+    def __dispatch(self, loop: ConnectionLoop, reader: SocketReader, info: RequestInfo):
+        client_socket = reader.sock
         print(info.log)
         if info.path in globalconfig["network_service_disabled_paths"]:
             print("disabled", info.path)
@@ -427,5 +669,11 @@ class TCPService:
             ):
                 continue
             if info.path == handler.path:
-                return handler(info, client_socket)
+                if iswsreq:
+                    # websocket连接由WSHandler自己的线程长期持有，不再超时
+                    client_socket.settimeout(None)
+                    return handler(info, client_socket)
+                if handler(info, client_socket).keepalive:
+                    loop.rearm(reader)
+                return
         return ResponseInfo._404(client_socket)
@@ -1,6 +1,10 @@
 from textio.textsource.textsourcebase import basetext
 from myutils.wrapper import threader
 import json, time, os, gobject, NativeUtils, uuid
+import functools
+from traceback import print_exc
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
 from myutils.config import globalconfig
 from gui.usefulwidget import request_for_something
 
@@ -209,32 +213,115 @@ class filetrans(basetext):
                 file = parsevtt(file)
             self.__starttranslatefile(file, i, len(files))
 
+    def __progress(self, i, n, index, lenfile):
+        gobject.base.progresssignal2.emit(
+            "{}{}/{}{}{:0.2f}% ".format(
+                "{}/{}{}".format(i + 1, n, " " * 8) if (n > 1) else "",
+                index + 1,
+                lenfile,
+                " " * 8,
+                100 * (index + 1) / lenfile,
+            ),
+            (index + 1),
+        )
+
+    def __save(self, file: parsetxt, index, line: str, ts: str):
+        if not ts:
+            return
+        if len(ts.split("\n")) == len(line.split("\n")):
+            file.save(index, line, ts)
+        elif len(ts.split("\n")) > len(line.split("\n")):
+            # 删除空行
+            lines = [line for line in ts.split("\n") if line]
+            tsx = "\n".join(lines)
+            if len(tsx.split("\n")) == len(line.split("\n")):
+                file.save(index, line, tsx)
+
+    def __waitautorunning(self):
+        while not self.isautorunning:
+            if self.ending:
+                return False
+            time.sleep(0.1)
+        return not self.ending
+
     def __starttranslatefile(self, file: parsetxt, i, n):
         gobject.base.progresssignal3.emit(len(file))
         gobject.base.progresssignal2.emit("", 0)
+        engine = None
+        if globalconfig["filetrans_batch"]:
+            engine = gobject.base.batchtranslateengine()
+        if engine:
+            self.__starttranslatefile_batch(file, i, n, engine)
+        else:
+            self.__starttranslatefile_1(file, i, n)
+
+    def __starttranslatefile_batch(self, file: parsetxt, i, n, engine):
+        # 按块提交，至多filetrans_concurrency个块同时在翻译；按提交顺序取回结果并写入。
+        lenfile = len(file)
+        chunksize = max(1, globalconfig["filetrans_chunksize"])
+        concurrency = max(1, globalconfig["filetrans_concurrency"])
+        chunk = []
+        running = deque()
+
+        def collect(future: Future, chunk):
+            try:
+                tss = future.result()
+            except:
+                print_exc()
+                tss = []
+            for (index, line), ts in zip(chunk, tss):
+                self.__save(file, index, line, ts)
+            self.__progress(i, n, chunk[-1][0], lenfile)
+
+        with ThreadPoolExecutor(concurrency) as pool:
+
+            def submit(chunk):
+                while len(running) >= concurrency:
+                    collect(*running.popleft())
+                if not self.__waitautorunning():
+                    return False
+                future = pool.submit(
+                    gobject.base.translatebatch, [line for _, line in chunk], engine
+                )
+                running.append((future, chunk))
+                return True
 
-        for index, line in enumerate(file.load()):
-            if self.ending:
+            for index, line in enumerate(file.load()):
+                if self.ending:
+                    return
+                if not line:
+                    continue
+                ts = self.query(line)
+                if ts:
+                    # 已经翻译过的直接写入
+                    self.__save(file, index, line, ts)
+                    continue
+                chunk.append((index, line))
+                if len(chunk) >= chunksize:
+                    if not submit(chunk):
+                        return
+                    chunk = []
+            if chunk and not submit(chunk):
                 return
-            while not self.isautorunning:
+            while running:
                 if self.ending:
                     return
-                time.sleep(0.1)
+                collect(*running.popleft())
+        if lenfile:
+            self.__progress(i, n, lenfile - 1, lenfile)
+
+    def __starttranslatefile_1(self, file: parsetxt, i, n):
+
+        for index, line in enumerate(file.load()):
+            if not self.__waitautorunning():
+                return
 
             lenfile = len(file)
+            progress = functools.partial(self.__progress, i, n, index, lenfile)
 
             class __p:
                 def __del__(self):
-                    gobject.base.progresssignal2.emit(
-                        "{}{}/{}{}{:0.2f}% ".format(
-                            "{}/{}{}".format(i + 1, n, " " * 8) if (n > 1) else "",
-                            index + 1,
-                            lenfile,
-                            " " * 8,
-                            100 * (index + 1) / lenfile,
-                        ),
-                        (index + 1),
-                    )
+                    progress()
 
             _ref = __p()
             if not line:
@@ -244,14 +331,4 @@ class filetrans(basetext):
                 ts = self.waitfortranslation(line)
             if self.ending:
                 return
-
-            if not ts:
-                continue
-            if len(ts.split("\n")) == len(line.split("\n")):
-                file.save(index, line, ts)
-            elif len(ts.split("\n")) > len(line.split("\n")):
-                # 删除空行
-                lines = [line for line in ts.split("\n") if line]
-                tsx = "\n".join(lines)
-                if len(tsx.split("\n")) == len(line.split("\n")):
-                    file.save(index, line, tsx)
+            self.__save(file, index, line, ts)
@@ -1,13 +1,16 @@
 from traceback import print_exc
-from queue import Queue
 from threading import Thread
-import time, types
+from queue import Queue, Empty
+import time, types, threading
+import requests
 import gobject
 import json
 import functools
+from collections import deque
 from myutils.wrapper import threader
 from myutils.config import globalconfig, translatorsetting, dynamicapiname
-from myutils.utils import stringfyerror, autosql, PriorityQueue
+from myutils.utils import stringfyerror, PriorityQueue, ratelimiter
+from myutils.transcache import longtermcache, getshorttermcache
 from myutils.commonbase import ArgsEmptyExc, commonbase
 
 
@@ -58,6 +61,60 @@ class GptTextWithDict:
         )
 
 
+class GptContext:
+    # 大模型的对话历史。只保留最近的若干轮，同时按估算的token数限制总量，超出时丢弃最旧的一轮。
+    # 每一轮为(user, assistant)，内容可以是消息dict也可以是字符串。
+    # 轮次带有从0开始的绝对序号，淘汰旧轮次不影响按序号截取。
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.turns = deque()  # type: deque[tuple[object, object, int]]
+        self.tokens = 0
+        self.total = 0
+        self.__cache = None
+
+    @staticmethod
+    def estimatetokens(item) -> int:
+        # 粗略估计：ASCII约4字符一个token，其他字符按一个token计
+        text = item.get("content", "") if isinstance(item, dict) else item
+        if not isinstance(text, str):
+            return 0
+        asc = len(text.encode("ascii", "ignore"))
+        return (len(text) - asc) + (asc + 3) // 4
+
+    def __len__(self):
+        return len(self.turns)
+
+    def append(self, user, assistant):
+        tokens = self.estimatetokens(user) + self.estimatetokens(assistant)
+        maxturns = max(1, globalconfig["llm_context_max_turns"])
+        maxtokens = globalconfig["llm_context_max_tokens"]
+        with self.lock:
+            self.turns.append((user, assistant, tokens))
+            self.tokens += tokens
+            self.total += 1
+            while len(self.turns) > 1 and (
+                len(self.turns) > maxturns or self.tokens > maxtokens
+            ):
+                self.tokens -= self.turns.popleft()[2]
+            self.__cache = None
+
+    def last(self, num: int, since: int = 0) -> "list":
+        # 绝对序号不小于since的轮次中的最后num轮，按时间顺序展开为[user, assistant, user, assistant, ...]
+        # 结果在下次append之前是不变的，同一个句子多次组装prompt时直接复用
+        with self.lock:
+            key = num, since
+            if self.__cache and self.__cache[0] == key:
+                return list(self.__cache[1])
+            num = max(0, min(num, len(self.turns), self.total - since))
+            messages = []
+            for i in range(len(self.turns) - num, len(self.turns)):
+                user, assistant, _ = self.turns[i]
+                messages.append(user)
+                messages.append(assistant)
+            self.__cache = key, tuple(messages)
+            return messages
+
+
 class Threadwithresult(Thread):
     def __init__(self, func):
         super(Threadwithresult, self).__init__(daemon=True)
@@ -104,6 +161,15 @@ class basetrans(commonbase):
     def translate(self, content: "str|GptTextWithDict"):
         return ""
 
+    @property
+    def batch_size(self):
+        # 大于1时表示支持批量翻译，translate_batch一次最多接收这么多句
+        return 1
+
+    def translate_batch(self, contents: "list[str|GptTextWithDict]") -> "list[str]":
+        # 一次请求翻译多句，返回与contents一一对应的结果，缺失的位置为None
+        return [self._collectresult(self.__cap_trans(_)) for _ in contents]
+
     ############################################################
     _globalconfig_key = "fanyi"
     _setting_dict = translatorsetting
@@ -113,6 +179,12 @@ class basetrans(commonbase):
         if (self.transtype == "offline") and (not self.is_gpt_like):
             self.gconfig["useproxy"] = False
         self.queue = PriorityQueue()
+        self.mustcompletequeue = Queue()
+        self.mustcompleteworkers = 0
+        self.mustcompletelock = threading.Lock()
+        self.reinitlock = threading.Lock()
+        self.ratelimiter = ratelimiter()
+        self.needreinit = False
         self.sqlqueue = None
         self.sqlwrite2 = None
         try:
@@ -126,37 +198,29 @@ class basetrans(commonbase):
             )
             print_exc()
 
-        self.lastrequesttime = 0
-        self._cache = {}
-
         self.newline = None
 
         if not self.never_use_trans_cache:
             try:
-
-                self.sqlwrite2 = autosql(
+                self.sqlwrite2 = longtermcache(
                     gobject.gettranslationrecorddir(
                         "cache/{}.sqlite".format(self.typename)
-                    ),
-                    check_same_thread=False,
-                    isolation_level=None,
-                )
-                try:
-                    self.sqlwrite2.execute(
-                        "CREATE TABLE cache(srclang,tgtlang,source,trans);"
                     )
-                except:
-                    pass
+                )
+                self.sqlqueue = self.sqlwrite2.writequeue
+                threader(self._sqlitethread)()
             except:
-                print_exc
-            self.sqlqueue = Queue()
-            threader(self._sqlitethread)()
+                print_exc()
+                self.sqlwrite2 = None
         threader(self._fythread)()
 
     def notifyqueuforend(self):
+        getshorttermcache().clear(self.typename)
         if self.sqlqueue:
             self.sqlqueue.put(None)
         self.queue.put(None, 999)
+        for _ in range(self.mustcompleteworkers):
+            self.mustcompletequeue.put(None)
 
     def _private_init(self):
         self.initok = False
@@ -164,22 +228,7 @@ class basetrans(commonbase):
         self.initok = True
 
     def _sqlitethread(self):
-        while self.using:
-            task = self.sqlqueue.get()
-            if task is None:
-                break
-            try:
-                src, trans = task
-                self.sqlwrite2.execute(
-                    "DELETE from cache WHERE (srclang=? and tgtlang=? and source=?)",
-                    (str(self.srclang_1), str(self.tgtlang_1), src),
-                )
-                self.sqlwrite2.execute(
-                    "INSERT into cache VALUES(?,?,?,?)",
-                    (str(self.srclang_1), str(self.tgtlang_1), src, trans),
-                )
-            except:
-                print_exc()
+        self.sqlwrite2.writethread(lambda: self.using)
 
     @property
     def using_gpt_dict(self):
@@ -217,56 +266,59 @@ class basetrans(commonbase):
         # offline不被新的请求打断
         return self.gconfig.get("type", "free")
 
+    @property
+    def max_inflight(self):
+        # 同时进行中的请求数上限。实时文本始终独占_fythread，其余的由必须完成的请求共享。
+        return max(2, globalconfig["translator_max_inflight"])
+
     def gettask(self, content):
+        # 两类请求：
+        # 实时文本（无waitforresultcallback）只关心最新的一句，由_fythread处理，新请求会打断旧请求；
+        # 内嵌翻译/网络API/文件翻译等每一句都必须完成的，交给工作线程池并发处理，不影响实时文本。
         # fmt: off
-        callback, contentsolved, callback, is_auto_run, optimization_params = content
+        callback, contentsolved, waitforresultcallback, is_auto_run, optimization_params = content
         # fmt: on
-        if callback:
-            priority = 1
-        else:
-            priority = 0
-        self.queue.put(content, priority)
+        if waitforresultcallback is None:
+            self.queue.put(content, 0)
+            return
+        self._putmustcomplete(content)
+
+    def _putmustcomplete(self, content):
+        # content为请求元组，或者是批量翻译的一块（无参数的函数）
+        with self.mustcompletelock:
+            if self.mustcompleteworkers < self.max_inflight - 1:
+                self.mustcompleteworkers += 1
+                threader(self._mustcompletethread)()
+        self.mustcompletequeue.put(content)
 
     def longtermcacheget(self, src):
         if not self.sqlwrite2:
             return
         try:
-            ret = self.sqlwrite2.execute(
-                "SELECT trans FROM cache WHERE (( (srclang=? and tgtlang=?) or  (srclang=? and tgtlang=?)) and source=?)",
-                (
-                    str(self.srclang_1),
-                    str(self.tgtlang_1),
-                    str(self.srclang),
-                    str(self.tgtlang),
-                    src,
-                ),
-            ).fetchone()
-            if ret:
-                return ret[0]
-            return None
+            return self.sqlwrite2.get(
+                [
+                    (str(self.srclang_1), str(self.tgtlang_1)),
+                    (str(self.srclang), str(self.tgtlang)),
+                ],
+                src,
+            )
         except:
             print_exc()
             return None
 
     def longtermcacheset(self, src, tgt):
-        if self.sqlqueue:
-            self.sqlqueue.put((src, tgt))
+        if self.sqlwrite2:
+            self.sqlwrite2.put(str(self.srclang_1), str(self.tgtlang_1), src, tgt)
 
     def shorttermcacheget(self, src):
-        langkey = (self.srclang_1, self.tgtlang_1)
-        if langkey not in self._cache:
-            self._cache[langkey] = {}
-        try:
-            return self._cache[langkey][src]
-        except KeyError:
-            return None
+        return getshorttermcache().get(
+            self.typename, (self.srclang_1, self.tgtlang_1, src)
+        )
 
     def shorttermcacheset(self, src, tgt):
-        langkey = (self.srclang_1, self.tgtlang_1)
-
-        if langkey not in self._cache:
-            self._cache[langkey] = {}
-        self._cache[langkey][src] = tgt
+        getshorttermcache().set(
+            self.typename, (self.srclang_1, self.tgtlang_1, src), tgt
+        )
 
     def shortorlongcacheget(self, content, is_auto_run):
         if self.is_gpt_like and not is_auto_run:
@@ -288,19 +340,34 @@ class basetrans(commonbase):
             t = str(t)
         return self.translate(t)
 
-    def intervaledtranslate(self, content):
-        interval = globalconfig["requestinterval"]
-        current = time.time()
-        self.current = current
-        sleeptime = interval - (current - self.lastrequesttime)
-
+    def _waitratelimit(self):
+        sleeptime = self.ratelimiter.reserve(globalconfig["requestinterval"])
         if sleeptime > 0:
             time.sleep(sleeptime)
-        self.lastrequesttime = time.time()
-        if (current != self.current) or (self.using == False):
-            raise Exception()
 
-        return self.multiapikeywrapper(self.__cap_trans)(content)
+    def _checkratelimited(self, e: Exception):
+        if not (e.args and isinstance(e.args[0], requests.Response)):
+            return
+        if e.args[0].status_code != 429:
+            return
+        try:
+            retry = float(e.args[0].headers.get("retry-after"))
+        except:
+            retry = max(5, globalconfig["requestinterval"] * 2)
+        self.ratelimiter.penalize(retry)
+
+    def intervaledtranslate(self, content, interactive=True):
+        current = time.time()
+        if interactive:
+            self.current = current
+        self._waitratelimit()
+        if (interactive and current != self.current) or (self.using == False):
+            raise Exception()
+        try:
+            return self.multiapikeywrapper(self.__cap_trans)(content)
+        except Exception as e:
+            self._checkratelimited(e)
+            raise e
 
     def _gptlike_createquery(self, query, usekey, tempk):
         return self._gptlike_get_user_prompt(usekey, tempk).replace("{sentence}", query)
@@ -330,8 +397,11 @@ class basetrans(commonbase):
         return user_prompt
 
     def _gpt_common_parse_context(
-        self, messages: list, context: "list[dict]", num: int
+        self, messages: list, context: "list[dict]|GptContext", num: int
     ):
+        if isinstance(context, GptContext):
+            messages.extend(context.last(num))
+            return
         offset = 0
         _i = 0
         msgs = []
@@ -345,12 +415,16 @@ class basetrans(commonbase):
     def maybeneedreinit(self):
         if not (self.needreinit or not self.initok):
             return
-        self.needreinit = False
-        self.renewsesion()
-        try:
-            self._private_init()
-        except Exception as e:
-            raise Exception("init translator failed : " + str(stringfyerror(e)))
+        # 多个工作线程可能同时发现需要重新初始化，只做一次
+        with self.reinitlock:
+            if not (self.needreinit or not self.initok):
+                return
+            self.needreinit = False
+            self.renewsesion()
+            try:
+                self._private_init()
+            except Exception as e:
+                raise Exception("init translator failed : " + str(stringfyerror(e)))
 
     def maybezhconvwrapper(self, callback, tgtlang_1):
         def __maybeshow(callback, tgtlang_1, res, is_iter_res):
@@ -360,20 +434,130 @@ class basetrans(commonbase):
 
         return functools.partial(__maybeshow, callback, tgtlang_1)
 
-    def translate_and_collect(
-        self, tgtlang_1, contentsolved: "GptTextWithDict|str", is_auto_run, callback
-    ):
+    @staticmethod
+    def _cachekey(contentsolved: "GptTextWithDict|str"):
         if isinstance(contentsolved, GptTextWithDict):
             cache_use = contentsolved.rawtext
             if contentsolved.dictionary:
                 cache_use = str((contentsolved, contentsolved.dictionary))
-            TS_use = contentsolved
-        else:
-            cache_use = TS_use = contentsolved
+            return cache_use
+        return contentsolved
+
+    @staticmethod
+    def _collectresult(res):
+        if not isinstance(res, types.GeneratorType):
+            return res
+        collectiterres = ""
+        for _res in res:
+            if _res == "\0":
+                collectiterres = ""
+            elif _res:
+                collectiterres += _res
+        return collectiterres
+
+    def translate_lines(self, tasks: "list[tuple[str, list]]", is_auto_run=True):
+        # 文件翻译等每一句都需要结果的场景使用，调用者等待全部完成。
+        # tasks: [(contentsolved, optimization_params), ...]
+        # 先逐句查缓存，未命中的按batch_size分块调用translate_batch，结果写回缓存并按原顺序返回。
+        # 每一块与其他必须完成的请求一样交给工作线程池，受max_inflight和请求间隔的限制。
+        # 整块失败时逐句重试；仍然失败的句子结果为None。
+        if self.srclang_1 == self.tgtlang_1:
+            return [contentsolved for contentsolved, _ in tasks]
+        results = [None] * len(tasks)
+        contents = []
+        todo = []
+        for i, (contentsolved, optimization_params) in enumerate(tasks):
+            if self.using_gpt_dict:
+                contentsolved = self.__parse_gpt_dict(
+                    contentsolved, optimization_params
+                )
+            contents.append(contentsolved)
+            res = self.shortorlongcacheget(self._cachekey(contentsolved), is_auto_run)
+            if res:
+                results[i] = res
+            else:
+                todo.append(i)
+        batch_size = max(1, self.batch_size)
+        done = Queue()
+        chunks = [todo[_ : _ + batch_size] for _ in range(0, len(todo), batch_size)]
+        for chunk in chunks:
+            self._putmustcomplete(
+                functools.partial(
+                    self.__runchunk, chunk, [contents[i] for i in chunk], done
+                )
+            )
+        for _ in chunks:
+            while True:
+                try:
+                    chunk, ress = done.get(timeout=1)
+                    break
+                except Empty:
+                    if not self.using:
+                        # 翻译器被关闭，剩下的块不会再被执行
+                        chunk = None
+                        break
+            if chunk is None:
+                break
+            for i, res in zip(chunk, ress):
+                if not res:
+                    continue
+                cache_use = self._cachekey(contents[i])
+                self.shorttermcacheset(cache_use, res)
+                self.longtermcacheset(cache_use, res)
+                results[i] = res
+        if self.needzhconv:
+            results = [self.checklangzhconv(self.tgtlang_1, _) for _ in results]
+        return results
+
+    def __runchunk(self, chunk: "list[int]", contents: list, done: Queue):
+        ress = [None] * len(contents)
+        try:
+            ress = list(self.__translate_chunk(contents))
+            if len(contents) > 1:
+                for i, res in enumerate(ress):
+                    if not res:
+                        # 批量请求失败，或者成功了但这一句没有对应的结果，单独重试
+                        ress[i] = self.__translate_line(contents[i])
+        finally:
+            done.put((chunk, ress))
+
+    def __translate_chunk(self, chunk: list) -> list:
+        self.maybeneedreinit()
+        self._waitratelimit()
+        try:
+            return self.multiapikeywrapper(self.translate_batch)(chunk)
+        except Exception as e:
+            print_exc()
+            self._checkratelimited(e)
+            self.needreinit = True
+            return [None] * len(chunk)
+
+    def __translate_line(self, content):
+        # 同样经过translate_batch，不影响实时翻译的上下文
+        self.maybeneedreinit()
+        self._waitratelimit()
+        try:
+            return self.multiapikeywrapper(self.translate_batch)([content])[0]
+        except Exception as e:
+            print_exc()
+            self._checkratelimited(e)
+            self.needreinit = True
+            return None
+
+    def translate_and_collect(
+        self,
+        tgtlang_1,
+        contentsolved: "GptTextWithDict|str",
+        is_auto_run,
+        callback,
+        interactive=True,
+    ):
+        cache_use = self._cachekey(contentsolved)
+        TS_use = contentsolved
 
         res = self.shortorlongcacheget(cache_use, is_auto_run)
         if not res:
-            res = self.intervaledtranslate(TS_use)
+            res = self.intervaledtranslate(TS_use, interactive=interactive)
         # 不能因为被打断而放弃后面的操作，发出的请求不会因为不再处理而无效，所以与其浪费不如存下来
         # gettranslationcallback里已经有了是否为当前请求的校验，这里无脑输出就行了
 
@@ -418,6 +602,21 @@ class basetrans(commonbase):
             parsedtext=contentsolved, dictionary=gpt_dict, rawtext=contentraw
         )
 
+    def _mustcompletethread(self):
+        while self.using:
+            content = self.mustcompletequeue.get()
+            if content is None:
+                break
+            if callable(content):
+                try:
+                    content()
+                except:
+                    print_exc()
+                continue
+            self._runtask(content, interactive=False)
+        with self.mustcompletelock:
+            self.mustcompleteworkers -= 1
+
     def _fythread(self):
         self.needreinit = False
         while self.using:
@@ -427,55 +626,60 @@ class basetrans(commonbase):
                 break
             if content is None:
                 break
-            # fmt: off
-            callback, contentsolved, waitforresultcallback, is_auto_run, optimization_params = content
-            # fmt: on
-            if self.onlymanual and is_auto_run:
-                continue
-            if self.srclang_1 == self.tgtlang_1:
-                callback(None, 0)
-                continue
-            try:
-                checktutukufunction = (
-                    lambda: ((waitforresultcallback is not None) or self.queue.empty())
-                    and self.using
-                )
-                if not checktutukufunction():
-                    # 检查请求队列是否空，请求队列有新的请求，则放弃当前请求。但对于内嵌翻译请求，不可以放弃。
-                    continue
+            self._runtask(content, interactive=True)
+
+    def _runtask(self, content, interactive):
+        # fmt: off
+        callback, contentsolved, waitforresultcallback, is_auto_run, optimization_params = content
+        # fmt: on
+        if self.onlymanual and is_auto_run:
+            return
+        if self.srclang_1 == self.tgtlang_1:
+            callback(None, 0)
+            return
+        try:
+            checktutukufunction = (
+                lambda: ((waitforresultcallback is not None) or self.queue.empty())
+                and self.using
+            )
+            if not checktutukufunction():
+                # 检查请求队列是否空，请求队列有新的请求，则放弃当前请求。但对于内嵌翻译请求，不可以放弃。
+                return
 
-                self.maybeneedreinit()
+            self.maybeneedreinit()
 
-                if self.using_gpt_dict:
-                    contentsolved = self.__parse_gpt_dict(
-                        contentsolved, optimization_params
-                    )
+            if self.using_gpt_dict:
+                contentsolved = self.__parse_gpt_dict(
+                    contentsolved, optimization_params
+                )
 
-                func = functools.partial(
-                    self.translate_and_collect,
-                    self.tgtlang_1,
-                    contentsolved,
-                    is_auto_run,
-                    callback,
+            func = functools.partial(
+                self.translate_and_collect,
+                self.tgtlang_1,
+                contentsolved,
+                is_auto_run,
+                callback,
+                interactive=interactive,
+            )
+            if (self.transtype == "offline") or (not interactive):
+                # 离线翻译例如sakura不要被中断，因为即使中断了，部署的服务仍然在运行，直到请求结束
+                # 必须完成的请求本来就不会被中断，直接在工作线程中执行
+                func()
+            else:
+                timeoutfunction(
+                    func,
+                    checktutukufunction=checktutukufunction,
                 )
-                if self.transtype == "offline":
-                    # 离线翻译例如sakura不要被中断，因为即使中断了，部署的服务仍然在运行，直到请求结束
-                    func()
-                else:
-                    timeoutfunction(
-                        func,
-                        checktutukufunction=checktutukufunction,
-                    )
-            except Exception as e:
-                if not (self.using):
-                    continue
-                if isinstance(e, ArgsEmptyExc):
-                    msg = str(e)
-                elif isinstance(e, Interrupted):
-                    # 因为有新的请求而被打断
-                    continue
-                else:
-                    print_exc()
-                    msg = stringfyerror(e)
-                    self.needreinit = True
-                callback(msg, 0, True)
+        except Exception as e:
+            if not (self.using):
+                return
+            if isinstance(e, ArgsEmptyExc):
+                msg = str(e)
+            elif isinstance(e, Interrupted):
+                # 因为有新的请求而被打断
+                return
+            else:
+                print_exc()
+                msg = stringfyerror(e)
+                self.needreinit = True
+            callback(msg, 0, True)
@@ -17,7 +17,15 @@ class TS(basetrans):
             return "ZH-HANT"
         return self.tgtlang_1.upper()
 
+    @property
+    def batch_size(self):
+        # 官方文档：单次请求最多50条text
+        return 50
+
     def translate(self, query):
+        return self.translate_batch([query])[0]
+
+    def translate_batch(self, queries):
         if self.config["usewhich"] == 0:
             self.checkempty(["DeepL-Auth-Key"])
             appid = self.multiapikeycurrent["DeepL-Auth-Key"]
@@ -32,7 +40,8 @@ class TS(basetrans):
             "Content-Type": "application/x-www-form-urlencoded",
         }
 
-        data = "text=" + parse.quote(query) + "&target_lang=" + self.tgtlang
+        data = "&".join("text=" + parse.quote(query) for query in queries)
+        data += "&target_lang=" + self.tgtlang
         if not self.is_src_auto:
             data += "&source_lang=" + self.srclang
         response = self.proxysession.post(
@@ -40,6 +49,10 @@ class TS(basetrans):
         )
 
         try:
-            return response.json()["translations"][0]["text"]
+            results = [_["text"] for _ in response.json()["translations"]]
         except:
             raise Exception(response)
+        if len(results) != len(queries):
+            # 结果与请求无法一一对应
+            raise Exception(response)
+        return results
@@ -7,24 +7,36 @@ class TS(basetrans):
     def langmap(self):
         return {Languages.Chinese: "zh-CN", Languages.TradChinese: "zh-TW"}
 
+    @property
+    def batch_size(self):
+        return 50
+
     def translate(self, query):
+        return self.translate_batch([query])[0]
+
+    def translate_batch(self, queries):
         self.checkempty(["key"])
 
         key = self.multiapikeycurrent["key"]
         params = {
             "key": key,
             "target": self.tgtlang,
-            "q": (query),
+            "q": queries,
         }
         if not self.is_src_auto:
             params["source"] = self.srclang
-        response = self.proxysession.get(
-            "https://translation.googleapis.com/language/translate/v2/", params=params
+        response = self.proxysession.post(
+            "https://translation.googleapis.com/language/translate/v2/", data=params
         )
 
         try:
-            return unescape(
-                response.json()["data"]["translations"][0]["translatedText"]
-            )
+            results = [
+                unescape(_["translatedText"])
+                for _ in response.json()["data"]["translations"]
+            ]
         except:
             raise Exception(response)
+        if len(results) != len(queries):
+            # 结果与请求无法一一对应
+            raise Exception(response)
+        return results
@@ -1,5 +1,5 @@
-from translator.basetranslator import basetrans, GptTextWithDict, GptDict
-import json, requests, hmac, hashlib, NativeUtils, re, functools
+from translator.basetranslator import basetrans, GptTextWithDict, GptDict, GptContext
+import json, requests, hmac, hashlib, NativeUtils, re, functools, threading
 from datetime import datetime, timezone
 from myutils.utils import (
     createurl,
@@ -9,6 +9,7 @@ from myutils.utils import (
     common_create_gpt_data,
 )
 from myutils.proxy import getproxy
+from myutils.config import globalconfig
 from language import Languages
 from gui.customparams import getcustombodyheaders
 
@@ -227,21 +228,26 @@ class gptcommon(basetrans):
         return Languages.createenglishlangmap()
 
     def __init__(self, typename):
-        self.context = []
-        self.context_for_cache = []
+        self.context = GptContext()
+        self.context_for_cache = GptContext()
+        # context_for_cache中开始截取的轮次（绝对序号）
         self.context_for_cache_skipinter = 0
         self.context_for_cache_skipinter_shouldmove = False
+        # 实时翻译和必须完成的请求在不同线程中同时读写上下文
+        self.contextlock = threading.Lock()
         self.maybeuse = {}
         super().__init__(typename)
 
-    def translate(self, query_2: GptTextWithDict):
+    def translate(self, query_2: GptTextWithDict, usecontext=True):
+        # usecontext为False时（批量翻译）不附带也不记录上下文
         if isinstance(query_2, str):
             query_2 = GptTextWithDict(query_2)
         extrabody, extraheader = getcustombodyheaders(
             self.config.get("customparams"), **locals()
         )
         usingstream = self.config["流式输出"]
-        messages, query, query_1 = self.commoncreatemessages(query_2)
+        with self.contextlock:
+            messages, query, query_1 = self.commoncreatemessages(query_2, usecontext)
         if self.apiurl.startswith("https://generativelanguage.googleapis.com"):
             response = self.request_gemini(messages, extrabody, extraheader)
         elif self.apiurl.startswith("https://api.anthropic.com/v1/messages"):
@@ -274,20 +280,61 @@ class gptcommon(basetrans):
                 yield "VSHOWHTML" + NativeUtils.Markdown2Html(respmessage)
             else:
                 yield respmessage
-        if not (respmessage and query_1.strip() and respmessage.strip()):
+        if not (
+            usecontext and respmessage and query_1.strip() and respmessage.strip()
+        ):
             return
-        self.context.append({"role": "user", "content": query_1})
-        self.context_for_cache.append({"role": "user", "content": query})
-        self.context.append({"role": "assistant", "content": respmessage})
-        self.context_for_cache.append({"role": "assistant", "content": respmessage})
+        with self.contextlock:
+            self.context.append(
+                {"role": "user", "content": query_1},
+                {"role": "assistant", "content": respmessage},
+            )
+            self.context_for_cache.append(
+                {"role": "user", "content": query},
+                {"role": "assistant", "content": respmessage},
+            )
+
+    batchinstruction = "The text below consists of numbered segments. Translate every segment separately, keep the <N> marker at the start of each translated segment, and do not merge or split segments."
+
+    @property
+    def batch_size(self):
+        return globalconfig["llm_batch_size"]
+
+    def translate_batch(self, contents: "list[GptTextWithDict|str]"):
+        # 多句用<N>标记编号后合并为一次请求，再按标记拆分结果
+        queries = [GptTextWithDict(_) if isinstance(_, str) else _ for _ in contents]
+        if len(queries) == 1:
+            return [self._collectresult(self.translate(queries[0], usecontext=False))]
+        dictionary = []
+        srcs = set()
+        for query in queries:
+            for item in query.dictionary:
+                if item.src in srcs:
+                    continue
+                srcs.add(item.src)
+                dictionary.append(dict(src=item.src, dst=item.dst, info=item.info))
+        packed = lambda texts: "\n".join(
+            [self.batchinstruction]
+            + ["<{}>{}".format(i + 1, text) for i, text in enumerate(texts)]
+        )
+        query = GptTextWithDict(
+            rawtext=packed([_.rawtext or _.parsedtext for _ in queries]),
+            parsedtext=packed([_.parsedtext for _ in queries]),
+            dictionary=dictionary,
+        )
+        respmessage = self._collectresult(self.translate(query, usecontext=False))
+        parts = re.split(r"<(\d+)>", respmessage or "")
+        result = {}
+        for i in range(1, len(parts) - 1, 2):
+            result[int(parts[i])] = parts[i + 1].strip()
+        return [result.get(i + 1) for i in range(len(queries))]
 
     def createurl(self):
         return createurl(self.apiurl)
 
     def __replace_history(self, which, match: re.Match):
         n = int(match.group(1))
-        __message: "list[dict]" = []
-        self._gpt_common_parse_context(__message, self.context, n)
+        __message: "list[dict]" = self.context.last(n)
         check = lambda k: (which == 2) or (k == ("user", "assistant")[which])
         __message = [_.get("content") for _ in __message if (check(_.get("role")))]
         return "\n".join(__message)
@@ -338,30 +385,32 @@ class gptcommon(basetrans):
         query = self.__parsecontextN(query)
         return query, query_1
 
-    def commoncreatemessages(self, query_2: GptTextWithDict):
+    def commoncreatemessages(self, query_2: GptTextWithDict, usecontext=True):
         sysprompt = self._gptlike_createsys("使用自定义promt", "自定义promt")
         sysprompt, _has = self.__if_has_dwp(query_2.dictionary, sysprompt)
         query, query_1 = self.__gpt_create_query_maybe_with_dict(query_2, _has)
         sysprompt = self.__parsecontextN(sysprompt)
         message = [{"role": "system", "content": sysprompt}]
         checknum = self.config["附带上下文个数"]
-        __message = []
-        if self.config.get("cachecontext", False):
+        if not usecontext:
+            __message = []
+        elif self.config.get("cachecontext", False):
+            # 窗口攒满checknum轮后才整体前移到只剩一半，期间消息前缀保持不变，便于服务端缓存命中
+            total = self.context_for_cache.total
             if self.context_for_cache_skipinter_shouldmove:
-                self.context_for_cache_skipinter = (
-                    len(self.context_for_cache) - (checknum // 2) * 2
-                )
+                self.context_for_cache_skipinter = total - checknum // 2
                 self.context_for_cache_skipinter_shouldmove = False
-            if len(self.context_for_cache) < checknum:
+            if total * 2 < checknum:
                 self.context_for_cache_skipinter = 0
-            self._gpt_common_parse_context(
-                __message,
-                self.context_for_cache[self.context_for_cache_skipinter :],
-                checknum,
+            __message = self.context_for_cache.last(
+                checknum, self.context_for_cache_skipinter
             )
         else:
-            self._gpt_common_parse_context(__message, self.context, checknum)
-        self.context_for_cache_skipinter_shouldmove = len(__message) == checknum * 2
+            __message = self.context.last(checknum)
+        if usecontext:
+            self.context_for_cache_skipinter_shouldmove = (
+                len(__message) == checknum * 2
+            )
         message.extend(__message)
         message.append({"role": "user", "content": query})
         prefill = self._gptlike_create_prefill("prefill_use", "prefill")
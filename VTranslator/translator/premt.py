@@ -4,8 +4,7 @@ from myutils.utils import autosql
 import os
 import gobject
 import json
-import sqlite3
-import NativeUtils
+from myutils.fuzzyindex import ngramindex
 
 
 class TS(basetrans):
@@ -28,7 +27,23 @@ class TS(basetrans):
                     self.sql = autosql(p1, check_same_thread=False)
             self.paths = (p1, p)
 
+    def syncfuzzyindex(self, sql):
+        # 按id增量同步，文本源写入新行后下次查询时自动加入索引
+        if self.fuzzyindex is None or self.fuzzyindexsql is not sql:
+            self.fuzzyindex = ngramindex()
+            self.fuzzyindexsql = sql
+            self.fuzzyindexlastid = -1
+        for _id, source in sql.execute(
+            "SELECT id, source FROM artificialtrans WHERE id > ? ORDER BY id",
+            (self.fuzzyindexlastid,),
+        ):
+            self.fuzzyindex.add(_id, source)
+            self.fuzzyindexlastid = _id
+        return self.fuzzyindex
+
     def init(self):
+        self.fuzzyindex = None
+        self.fuzzyindexsql = None
         self.sql = None
         self.paths = (None, None)
         self.checkfilechanged(
@@ -47,24 +62,23 @@ class TS(basetrans):
         else:
             sql = self.sql
         if self.config["premtsimi2"] < 100:
-            maxsim = 0
-            savet = "{}"
-            ret = sql.execute("SELECT * FROM artificialtrans  ").fetchall()
-            if not ret:
-                return {}
-            for line in ret:
-                text = line[1]
-                trans = line[2]
-                dis = NativeUtils.similarity(content, text)
-                if dis > maxsim:
-                    maxsim = dis
-                    if maxsim * 100 >= self.config["premtsimi2"]:
-                        savet = trans
-            try:
-                ret = json.loads(savet)
-            except:
-                # 旧版兼容
-                ret = {"premt": ret[0]}
+            index = self.syncfuzzyindex(sql)
+            ret = {}
+            for _, _id in index.nearest_by_similarity(
+                content, self.config["premtsimi2"] / 100
+            ):
+                # 行可能已被删除
+                line = sql.execute(
+                    "SELECT machineTrans FROM artificialtrans WHERE id = ?", (_id,)
+                ).fetchone()
+                if not line:
+                    continue
+                try:
+                    ret = json.loads(line[0])
+                except:
+                    # 旧版兼容
+                    ret = {"premt": line[0]}
+                break
 
         else:
 
@@ -1,4 +1,4 @@
-from translator.basetranslator import basetrans, GptTextWithDict, GptDict
+from translator.basetranslator import basetrans, GptTextWithDict, GptDict, GptContext
 import requests
 import json
 from myutils.config import urlpathjoin
@@ -15,7 +15,7 @@ class TS(basetrans):
 
     def __init__(self, typename):
         super().__init__(typename)
-        self.context = []
+        self.context = GptContext()
 
     def get_client(self, api_url):
         if api_url[-4:] == "/v1/":
@@ -306,5 +306,4 @@ class TS(basetrans):
                     break
         if not (query.strip() and output_text.strip()):
             return
-        self.context.append(query)
-        self.context.append(output_text)
+        self.context.append(query, output_text)
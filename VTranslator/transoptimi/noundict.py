@@ -1,7 +1,8 @@
 from myutils.config import savehook_new_data, globalconfig
-import gobject, json
+import gobject, json, re, operator
 from qtsymbols import *
-from myutils.utils import postusewhich, case_insensitive_replace
+from myutils.utils import postusewhich
+from myutils.multireplace import ahocorasick
 from myutils.config import get_launchpath
 from myutils.hwnd import getExeIcon
 from gui.inputdialog import postconfigdialog_1
@@ -31,6 +32,8 @@ class postconfigdialog_2(postconfigdialog_1):
 
 
 class Process:
+    _matcher = None
+
     @staticmethod
     def get_setting_window(parent_window):
         return postconfigdialog_2(
@@ -67,31 +70,50 @@ class Process:
                 + globalconfig["noundictconfig_ex"]
             )
 
-    def __createfake(self):
+    @staticmethod
+    def __createfake(idx):
         ___idx = 1
         if ___idx == 1:
-            xx = "ZX{}Z".format(chr(ord("B") + self.zhanweifu))
+            xx = "ZX{}Z".format(chr(ord("B") + idx))
         elif ___idx == 2:
-            xx = "{{{}}}".format(self.zhanweifu)
-        self.zhanweifu += 1
+            xx = "{{{}}}".format(idx)
         return xx
 
+    def __getmatcher(self):
+        # 词典条目（dict对象）没有变化时复用自动机。设置界面保存时会重新生成条目，所以按对象身份比较即可；
+        # 缓存中持有这些对象，不会出现id被复用的问题。
+        entries = self.usewhich() or []
+        cached = self._matcher
+        if (
+            cached
+            and len(cached[0]) == len(entries)
+            and all(map(operator.is_, cached[0], entries))
+        ):
+            return cached[1]
+        uniq = {}
+        for gpt in entries:
+            # 同一原文只取第一条
+            uniq.setdefault(gpt["src"], gpt)
+        gpts = list(uniq.values())
+        # 译文为空的条目只用于gpt_dict，不参与替换，否则更长的空条目会挡住较短的有译文的条目
+        replaces = [gpt for gpt in gpts if gpt["dst"]]
+        matcher = (
+            ahocorasick([gpt["src"] for gpt in gpts]),
+            gpts,
+            ahocorasick([gpt["src"] for gpt in replaces]),
+            replaces,
+        )
+        self._matcher = list(entries), matcher
+        return matcher
+
     def process_before(self, japanese):
-        used = []
-        gpt_dict = []
-        srcs = set()
-        for gpt in self.usewhich():
-            src = gpt["src"]
-            if src in srcs:
-                continue
-            srcs.add(src)
-            if src not in japanese:
-                continue
-            gpt_dict.append(gpt)
-            used.append((src, gpt["dst"]))
+        automaton, gpts, replaceautomaton, replaces = self.__getmatcher()
+        gpt_dict = [
+            gpts[_] for _ in sorted(set(_[2] for _ in automaton.finditer(japanese)))
+        ]
+        matches = replaceautomaton.longest(list(replaceautomaton.finditer(japanese)))
 
-        self.zhanweifu = 0
-        japanese1, mp1 = self.process_before1(japanese, used)
+        japanese1, mp1 = self.process_before1(japanese, matches, replaces)
 
         return japanese1, {
             "gpt_dict": gpt_dict,
@@ -99,23 +121,38 @@ class Process:
             "zhanweifu": mp1,
         }
 
-    def process_before1(self, content: str, dic: list):
+    def process_before1(self, content: str, matches: list, gpts: list):
+        # 一次扫描的结果：不重叠、同一位置优先最长的词条
         mp1 = {}
-        for k, v in dic:
-            if not k:
-                continue
+        fakes = {}
+        parts = []
+        last = 0
+        for start, end, idx in matches:
+            v = gpts[idx]["dst"]
             if not v:
                 # 译文不可以为空
                 # 这是为了方便自动从VNDB中导入人名表，且避免破坏现有翻译
                 # 而且如果把译文置空，完全没必要使用这个优化。
                 continue
-            xx = self.__createfake()
-            content = content.replace(k, xx)
-            mp1[xx] = v
-        return content, mp1
+            if idx not in fakes:
+                fakes[idx] = self.__createfake(len(fakes))
+                mp1[fakes[idx]] = v
+            parts.append(content[last:start])
+            parts.append(fakes[idx])
+            last = end
+        parts.append(content[last:])
+        return "".join(parts), mp1
 
     def process_after(self, res: str, context):
         mp1 = context["zhanweifu"]
+        if not mp1:
+            return res
+        # 所有占位符一次替换，不区分大小写
+        lower = {}
         for key in mp1:
-            res = case_insensitive_replace(res, key, mp1[key])
-        return res
+            lower.setdefault(key.lower(), mp1[key])
+        pattern = re.compile(
+            "|".join(re.escape(_) for _ in sorted(mp1, key=len, reverse=True)),
+            re.IGNORECASE,
+        )
+        return pattern.sub(lambda m: lower[m.group().lower()], res)
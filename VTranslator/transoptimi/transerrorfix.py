@@ -29,7 +29,9 @@ class Process:
         ).setWindowIcon(getExeIcon(get_launchpath(gameuid), cache=True))
 
     def process_after(self, res, _):
-        res = parsemayberegexreplace(self.usewhich(), res)
+        which = postusewhich("transerrorfix")
+        key = ("transerrorfix", which, gobject.base.gameuid if which > 1 else None)
+        res = parsemayberegexreplace(self.usewhich, res, key)
         return res
 
     @property
@@ -50,6 +50,7 @@ class Process:
 
     def process_before(self, s):
 
-        namemap = self.usewhich()
-        s = parsemayberegexreplace(namemap, s)
+        which = postusewhich("vndbnamemap")
+        key = ("vndbnamemap", which, gobject.base.gameuid if which > 1 else None)
+        s = parsemayberegexreplace(self.usewhich, s, key)
         return s, {}
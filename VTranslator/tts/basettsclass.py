@@ -6,8 +6,41 @@ from traceback import print_exc
 from myutils.utils import LRUCache, stringfyerror
 from myutils.commonbase import commonbase
 from requests import Response
-import types
+import types, threading, json
 from myutils.mimehelper import query_mime
+from myutils.ttscache import getttscache, ttsdiskcache
+
+
+class TTSStream:
+    # 边合成边播放：合成线程write音频块，播放器按位置read，数据不够时等待
+    def __init__(self):
+        self.buffer = bytearray()
+        self.done = False
+        self.cond = threading.Condition()
+
+    def write(self, chunk: bytes):
+        with self.cond:
+            self.buffer += chunk
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    def read(self, pos: int, size: int, timeout=None) -> bytes:
+        # 返回空表示已经结束，超时返回None
+        with self.cond:
+            if not self.cond.wait_for(
+                lambda: len(self.buffer) > pos or self.done, timeout
+            ):
+                return None
+            return bytes(self.buffer[pos : pos + size])
+
+    def getvalue(self) -> bytes:
+        with self.cond:
+            self.cond.wait_for(lambda: self.done)
+            return bytes(self.buffer)
 
 
 class TTSResult:
@@ -45,6 +78,57 @@ class TTSResult:
             self._type = type
         self.error = error
 
+    @staticmethod
+    def sizeof(result: "TTSResult"):
+        if isinstance(result.data, (bytes, bytearray)):
+            return len(result.data)
+        return 0
+
+
+class ttsflight:
+    # 同一句话正在合成时，后来的请求(比如预合成还没结束时真正的朗读)不再重复合成，而是等待这一次的结果；
+    # 流式合成开始后，需要流的请求直接拿到流
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = []  # type: list[tuple[callable, bool]]
+        self.streamresult = None
+        self.result = None
+        self.done = False
+
+    @staticmethod
+    def __call(callback, result):
+        try:
+            callback(result)
+        except:
+            print_exc()
+
+    def join(self, callback, stream):
+        with self.lock:
+            if self.done:
+                result = self.result
+            elif stream and self.streamresult:
+                result = self.streamresult
+            else:
+                self.waiters.append((callback, stream))
+                return
+        self.__call(callback, result)
+
+    def streaming(self, result: TTSResult):
+        with self.lock:
+            self.streamresult = result
+            waiters = [_ for _ in self.waiters if _[1]]
+            self.waiters = [_ for _ in self.waiters if not _[1]]
+        for callback, _ in waiters:
+            self.__call(callback, result)
+
+    def finish(self, result: TTSResult):
+        with self.lock:
+            self.done = True
+            self.result = result
+            waiters, self.waiters = self.waiters, []
+        for callback, _ in waiters:
+            self.__call(callback, result)
+
 
 class SpeechParam:
     def __init__(self, speed, pitch):
@@ -60,6 +144,10 @@ class SpeechParam:
     def _tuple_(self):
         return tuple((self.speed, self.pitch))
 
+    def __repr__(self):
+        # 用于磁盘缓存的键
+        return "SpeechParam({}, {})".format(self.speed, self.pitch)
+
 
 class TTSbase(commonbase):
     def init(self): ...
@@ -115,7 +203,13 @@ class TTSbase(commonbase):
         super().__init__(typename)
         self.playaudiofunction = playaudiofunction
         self.uid = uid
-        self.LRUCache = LRUCache(32)
+        self.flights = {}  # type: dict[tuple, ttsflight]
+        self.flightslock = threading.Lock()
+        self.LRUCache = LRUCache(
+            32,
+            maxsize=globalconfig["ttsmemorycache_mb"] * 1024 * 1024,
+            sizeof=TTSResult.sizeof,
+        )
         if privateconfig is None:
             self.privateconfig: dict = globalconfig["reader"][self.typename]
         else:
@@ -140,11 +234,20 @@ class TTSbase(commonbase):
                 return
             self.playaudiofunction(data.data, volume, force, timestamp)
 
-        self.ttscallback(content, functools.partial(_, force, self.volume, timestamp))
+        self.ttscallback(
+            content, functools.partial(_, force, self.volume, timestamp), stream=True
+        )
 
     @threader
-    def ttscallback(self, content, callback):
+    def ttscallback(self, content, callback, stream=False):
+        self.synthesize(content, callback, stream)
+
+    def prefetch(self, content):
+        # 只合成并放入缓存，不播放
+        self.synthesize(content, lambda _: None)
 
+    def synthesize(self, content, callback, stream=False):
+        # stream为True时，如果引擎是流式返回的，收到第一块音频就回调，data为TTSStream
         if len(content) == 0:
             return
         if len(self.voicelist) == 0:
@@ -154,13 +257,23 @@ class TTSbase(commonbase):
             data = self.LRUCache.get(key)
             if data:
                 return callback(data)
-            data = self.multiapikeywrapper(self.speak)(content, self.voice, self.param)
-            if data:
-                data = TTSResult(data)
-                callback(data)
-                self.LRUCache.put(key, data)
-            else:
-                callback(None)
+            with self.flightslock:
+                flight = self.flights.get(key)
+                joined = flight is not None
+                if not joined:
+                    flight = self.flights[key] = ttsflight()
+            flight.join(callback, stream)
+            if joined:
+                return
+            try:
+                data = self.__synthesize(key, content, flight)
+            except Exception as e:
+                print_exc()
+                data = TTSResult(error=stringfyerror(e))
+                print(data.error)
+            with self.flightslock:
+                self.flights.pop(key, None)
+            flight.finish(data)
         except Exception as e:
             print_exc()
             res = TTSResult(error=stringfyerror(e))
@@ -168,8 +281,53 @@ class TTSbase(commonbase):
             callback(res)
             return
 
+    def __synthesize(self, key, content, flight: "ttsflight"):
+        diskcache = getttscache()
+        if diskcache:
+            diskkey = ttsdiskcache.hashkey((self.typename, key))
+            cached = diskcache.get(diskkey)
+            if cached:
+                data = TTSResult(cached[0], type=cached[1])
+                self.LRUCache.put(key, data)
+                return data
+        data = self.multiapikeywrapper(self.speak)(content, self.voice, self.param)
+        if not data:
+            return None
+        data = TTSResult(data)
+        if isinstance(data.data, types.GeneratorType):
+            data = self.__collect(data, flight.streaming)
+        self.LRUCache.put(key, data)
+        if diskcache and isinstance(data.data, (bytes, bytearray)):
+            diskcache.put(diskkey, data.data, data._type)
+        return data
+
+    def __collect(self, result: TTSResult, onfirstchunk) -> TTSResult:
+        buffer = TTSStream()
+        try:
+            for chunk in result.data:
+                if not chunk:
+                    continue
+                buffer.write(chunk)
+                if onfirstchunk:
+                    onfirstchunk(TTSResult(buffer, type=result._type))
+                    onfirstchunk = None
+        finally:
+            buffer.close()
+        return TTSResult(bytes(buffer.buffer), type=result._type)
+
     def ttscachekey(self, content, voice, param):
-        return content, voice, param
+        return content, voice, param, self.ttsconfigkey()
+
+    def ttsconfigkey(self):
+        # URL、端口、模型、自定义参数等都会改变合成结果，需要算进缓存key里
+        # key和列表缓存不影响结果，排除掉，免得换个key之后磁盘缓存全部失效
+        argstype = self.argstype
+        items = {}
+        for k, v in self.rawconfig.items():
+            if argstype.get(k, {}).get("type") in ("textlist", "list_cache"):
+                continue
+            items[k] = v
+        return json.dumps(items, ensure_ascii=False, sort_keys=True)
 
     def createSSML(self, content, voice, param: SpeechParam):
         # https://learn.microsoft.com/en-us/azure/ai-services/speech-service/speech-synthesis-markup-voice
@@ -2,7 +2,7 @@ import pytz
 import websocket
 from datetime import datetime
 import time
-import re
+import threading
 import uuid, hashlib
 from tts.basettsclass import TTSbase, SpeechParam, TTSResult
 
@@ -111,7 +111,10 @@ class TTS(TTSbase):
         return [_["ShortName"] for _ in alllist], [_["FriendlyName"] for _ in alllist]
 
     def speak(self, content, voice, param: SpeechParam):
-        return transferMsTTSData(self.createSSML(content, voice, param), self.proxy)
+        return TTSResult(
+            transferMsTTSData(self.createSSML(content, voice, param), self.proxy),
+            type="audio/mpeg",
+        )
 
 
 # Fix the time to match Americanisms
@@ -194,9 +197,7 @@ def connect_id() -> str:
     return str(uuid.uuid4()).replace("-", "")
 
 
-def transferMsTTSData(ssml, proxy_: "dict[str, str]"):
-
-    proxy = proxy_["https"]
+def connect(proxy):
     if proxy:
         ip, port = proxy.split(":")
     else:
@@ -208,12 +209,11 @@ def transferMsTTSData(ssml, proxy_: "dict[str, str]"):
         header=WSS_HEADERS,
         http_proxy_host=ip,
         http_proxy_port=port,
+        timeout=10,
     )
-
-    date = date_to_string()
-
+    # 同一个连接上的请求使用相同的输出格式，只需要在连接后发送一次
     ws.send(
-        "X-Timestamp:{}\r\n".format(date)
+        "X-Timestamp:{}\r\n".format(date_to_string())
         + "Content-Type:application/json; charset=utf-8\r\n"
         "Path:speech.config\r\n\r\n"
         '{"context":{"synthesis":{"audio":{"metadataoptions":{'
@@ -221,31 +221,85 @@ def transferMsTTSData(ssml, proxy_: "dict[str, str]"):
         '"outputFormat":"audio-24khz-48kbitrate-mono-mp3"'
         "}}}}\r\n"
     )
+    return ws
+
+
+def closequietly(ws):
+    try:
+        ws.close()
+    except:
+        pass
+
+
+class connectionpool:
+    # 复用到服务器的WebSocket，省去每句话的TLS握手。按代理设置分别保存，
+    # 声音和语速等都在每次的ssml里，不影响复用。空闲太久的连接直接丢弃，复用的连接失效时由调用者重连。
+    maxidle = 2
+    idletimeout = 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}  # type: dict[str, list[tuple[websocket.WebSocket, float]]]
 
-    ws.send(ssml_headers_plus_data(connect_id(), date, ssml))
+    def acquire(self, proxy):
+        with self.lock:
+            conns = self.idle.get(proxy, [])
+            while conns:
+                ws, t = conns.pop()
+                if ws.connected and time.time() - t < self.idletimeout:
+                    return ws, True
+                closequietly(ws)
+        return connect(proxy), False
 
-    end_resp_pat = re.compile("Path:turn.end")
-    audio_stream = b""
+    def release(self, proxy, ws):
+        with self.lock:
+            conns = self.idle.setdefault(proxy, [])
+            if len(conns) < self.maxidle:
+                conns.append((ws, time.time()))
+                return
+        closequietly(ws)
+
+
+pool = connectionpool()
+
+
+def receiveaudio(ws: websocket.WebSocket):
+    needle = b"Path:audio\r\n"
     while True:
         response = ws.recv()
+        if isinstance(response, str):
+            # 文本消息是元数据，turn.end表示这句话已经结束
+            if "Path:turn.end" in response:
+                return
+            continue
         if response[:2] == b"\x03\xef":
             raise Exception(response[2:].decode())
-        # print(type(response),"++++++++++++")
-        # Make sure the message isn't telling us to stop
-        if re.search(end_resp_pat, str(response)) == None:
-            # Check if our response is text data or the audio bytes
-            if type(response) == type(bytes()):
-                # Extract binary data
-                try:
-                    needle = b"Path:audio\r\n"
-                    idx = response.find(needle)
-                    if idx == -1:
-                        raise Exception()
-                    start_ind = idx + len(needle)
-                    audio_stream += response[start_ind:]
-                except:
-                    audio_stream += response
-        else:
-            break
-    ws.close()
-    return TTSResult(audio_stream, type="audio/mpeg")
+        idx = response.find(needle)
+        if idx == -1:
+            yield response
+        elif idx + len(needle) < len(response):
+            yield response[idx + len(needle) :]
+
+
+def transferMsTTSData(ssml, proxy_: "dict[str, str]"):
+    # 边接收边yield音频块，第一帧到达时就可以开始播放
+    proxy = proxy_["https"]
+    while True:
+        ws, reused = pool.acquire(proxy)
+        started = done = False
+        try:
+            ws.send(ssml_headers_plus_data(connect_id(), date_to_string(), ssml))
+            for chunk in receiveaudio(ws):
+                started = True
+                yield chunk
+            done = True
+            return
+        except (websocket.WebSocketException, OSError):
+            # 复用的连接可能已经被服务器关闭，还没收到音频时换新连接重试
+            if started or not reused:
+                raise
+        finally:
+            if done:
+                pool.release(proxy, ws)
+            else:
+                closequietly(ws)
@@ -1,16 +1,21 @@
-import json
+import json, marshal, os, re, threading
+import gobject
 
 _DEFAULT_DICT = "files/static/zhcdict.json"
 DICTIONARY = _DEFAULT_DICT
+# 每个locale编译好的转换表缓存在缓存目录的zhconv下，源词典变化时自动重建
+_CACHE_VERSION = 1
+
+_LOCALES = {
+    "zh-cn": ("zh2Hans", "zh2CN"),
+    "zh-tw": ("zh2Hant", "zh2TW"),
+    "zh-hans": ("zh2Hans",),
+    "zh-hant": ("zh2Hant",),
+}
 
 zhcdicts = None
-dict_zhcn = None
-dict_zhsg = None
-dict_zhtw = None
-dict_zhhk = None
-dict_zhhans = None
-dict_zhhant = None
-pfsdict = {}
+converters = {}  # type: dict[str, converter]
+_lock = threading.Lock()
 
 
 def loaddict(filename=DICTIONARY):
@@ -20,84 +25,133 @@ def loaddict(filename=DICTIONARY):
     global zhcdicts
     if zhcdicts:
         return
-    if filename == _DEFAULT_DICT:
-        zhcdicts = json.loads(open(filename, "rb").read().decode("utf-8"))
-    else:
-        with open(filename, "rb") as f:
-            zhcdicts = json.loads(f.read().decode("utf-8"))
+    with open(filename, "rb") as f:
+        zhcdicts = json.loads(f.read().decode("utf-8"))
 
 
 def getdict(locale):
     """
-    Generate or get convertion dict cache for certain locale.
+    Generate convertion dict for certain locale.
     Dictionaries are loaded on demand.
     """
-    global zhcdicts, dict_zhcn, dict_zhsg, dict_zhtw, dict_zhhk, dict_zhhans, dict_zhhant, pfsdict
     if zhcdicts is None:
         loaddict(DICTIONARY)
-    if locale == "zh-cn":
-        if dict_zhcn:
-            got = dict_zhcn
-        else:
-            dict_zhcn = zhcdicts["zh2Hans"].copy()
-            dict_zhcn.update(zhcdicts["zh2CN"])
-            got = dict_zhcn
-    elif locale == "zh-tw":
-        if dict_zhtw:
-            got = dict_zhtw
-        else:
-            dict_zhtw = zhcdicts["zh2Hant"].copy()
-            dict_zhtw.update(zhcdicts["zh2TW"])
-            got = dict_zhtw
-    elif locale == "zh-hans":
-        if dict_zhhans:
-            got = dict_zhhans
-        else:
-            dict_zhhans = zhcdicts["zh2Hans"].copy()
-            got = dict_zhhans
-    elif locale == "zh-hant":
-        if dict_zhhant:
-            got = dict_zhhant
+    got = {}
+    for name in _LOCALES[locale]:
+        got.update(zhcdicts[name])
+    return got
+
+
+class converter:
+    """
+    Longest-match converter for one locale.
+
+    Single characters are mapped by str.translate. Only positions where a
+    multi-character phrase may start (a phrase head followed by a possible
+    second character, found by one precompiled regex) are checked in Python,
+    trying the phrase lengths of that head from long to short.
+    """
+
+    def __init__(self, table):
+        self.multi, self.single, self.lens, heads, seconds = table
+        if self.multi:
+            self.search = re.compile(
+                "[{}](?=[{}])".format(re.escape(heads), re.escape(seconds))
+            ).search
         else:
-            dict_zhhant = zhcdicts["zh2Hant"].copy()
-            got = dict_zhhant
+            self.search = None
 
-    if locale not in pfsdict:
-        pfsdict[locale] = getpfset(got)
-    return got
+    @staticmethod
+    def compile(convdict: dict):
+        """
+        -> (multi, single, lens, heads, seconds), only builtin types so that
+        it can be stored with marshal.
+        """
+        multi = {}
+        single = {}
+        lens = {}
+        for word, target in convdict.items():
+            if len(word) == 1:
+                single[ord(word)] = target
+            elif len(word) > 1:
+                multi[word] = target
+                lens.setdefault(word[0], set()).add(len(word))
+        lens = {c: tuple(sorted(l, reverse=True)) for c, l in lens.items()}
+        heads = "".join(sorted(lens))
+        seconds = "".join(sorted(set(word[1] for word in multi)))
+        return multi, single, lens, heads, seconds
+
+    def convert(self, s: str):
+        if not self.search:
+            return s.translate(self.single)
+        search = self.search
+        get = self.multi.get
+        lens = self.lens
+        single = self.single
+        ch = []
+        last = pos = 0
+        while True:
+            m = search(s, pos)
+            if not m:
+                break
+            i = m.start()
+            for l in lens[s[i]]:
+                target = get(s[i : i + l])
+                if target is not None:
+                    ch.append(s[last:i].translate(single))
+                    ch.append(target)
+                    last = pos = i + l
+                    break
+            else:
+                pos = i + 1
+        ch.append(s[last:].translate(single))
+        return "".join(ch)
+
+
+def _sourcestamp():
+    st = os.stat(DICTIONARY)
+    return (_CACHE_VERSION, st.st_mtime_ns, st.st_size)
 
 
-def getpfset(convdict):
-    pfset = []
-    for word in convdict:
-        for ch in range(len(word)):
-            pfset.append(word[: ch + 1])
-    return frozenset(pfset)
+def _loadcache(locale, stamp):
+    try:
+        fn = gobject.getcachedir("zhconv/{}.bin".format(locale))
+        with open(fn, "rb") as f:
+            cached = marshal.loads(f.read())
+        if cached[0] == stamp:
+            return cached[1]
+    except (OSError, ValueError, EOFError, TypeError, IndexError):
+        pass
+
+
+def _savecache(locale, stamp, table):
+    try:
+        fn = gobject.getcachedir("zhconv/{}.bin".format(locale))
+        with open(fn + ".tmp", "wb") as f:
+            f.write(marshal.dumps((stamp, table)))
+        os.replace(fn + ".tmp", fn)
+    except OSError:
+        pass
+
+
+def getconverter(locale) -> converter:
+    conv = converters.get(locale)
+    if conv:
+        return conv
+    with _lock:
+        conv = converters.get(locale)
+        if conv:
+            return conv
+        if locale not in _LOCALES:
+            raise KeyError(locale)
+        stamp = _sourcestamp()
+        table = _loadcache(locale, stamp)
+        if table is None:
+            table = converter.compile(getdict(locale))
+            _savecache(locale, stamp, table)
+        conv = converters[locale] = converter(table)
+        return conv
 
 
 def convert(s, locale):
-    zhdict = getdict(locale)
-    pfset = pfsdict[locale]
-    newset = set()
-
-    ch = []
-    N = len(s)
-    pos = 0
-    while pos < N:
-        i = pos
-        frag = s[pos]
-        maxword = None
-        maxpos = 0
-        while i < N and (frag in pfset or frag in newset):
-            if frag in zhdict:
-                maxword = zhdict[frag]
-                maxpos = i
-            i += 1
-            frag = s[pos : i + 1]
-        if maxword is None:
-            maxword = s[pos]
-            pos += 1
-        else:
-            pos = maxpos + 1
-        ch.append(maxword)
-    return "".join(ch)
+    return getconverter(locale).convert(s)
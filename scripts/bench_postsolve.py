@@ -0,0 +1,85 @@
+# 测量POSTSOLVE每行的耗时：旧的逐行解析流程 vs 编译后的流程
+# python scripts/bench_postsolve.py [行数]
+import os, sys, time, inspect, types
+
+rootDir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../VTranslator"))
+os.chdir(rootDir)
+sys.path.insert(0, rootDir)
+
+import gobject
+from myutils import post
+from myutils.config import globalconfig, postprocessconfig
+from myutils.utils import checkmd5reloadmodule
+
+gobject.base = types.SimpleNamespace(gameuid=None)
+
+rank = [
+    "_remove_control",
+    "_1",
+    "_4",
+    "_91",
+    "_remove_not_in_ja_bracket",
+    "lines_threshold_1",
+    "_11",
+]
+globalconfig["postprocess_rank"] = rank
+for _ in rank:
+    postprocessconfig.setdefault(_, {})["use"] = True
+    postprocessconfig[_]["isExUse"] = True
+postprocessconfig["lines_threshold_1"].setdefault(
+    "args", {"maxzishu": 10, "cut_reverse": True}
+)
+
+lines = [
+    "{ruby text=かんじ}漢字{/ruby}<color=red>「テスト%dの台詞です」</color>{}" % i
+    for i in range(1000)
+]
+
+
+def legacy(line, isEx=False, isFromHook=False, useAll=False):
+    # 修改前的POSTSOLVE：每行都调用inspect.signature，_11每行都读文件算md5
+    for postitem in globalconfig["postprocess_rank"]:
+        if postitem not in post.processfunctions:
+            continue
+        if postitem not in postprocessconfig:
+            continue
+        if postprocessconfig[postitem]["use"]:
+            if not useAll:
+                if isEx and not (postprocessconfig[postitem].get("isExUse", False)):
+                    continue
+                if (not isFromHook) and (
+                    postprocessconfig[postitem].get("isHookOnly", False)
+                ):
+                    continue
+            _f = post.processfunctions[postitem]
+            if postitem == "_11":
+                _ = checkmd5reloadmodule(gobject.getconfig("mypost.py"), "mypost")
+                if _:
+                    line = _.POSTSOLVE(line)
+            else:
+                np = len(inspect.signature(_f).parameters)
+                if np == 1:
+                    line = _f(line)
+                else:
+                    line = _f(line, postprocessconfig[postitem].get("args", {}))
+    return line
+
+
+def bench(name, func, n):
+    for line in lines[:10]:
+        func(line, isEx=True)
+    t = time.perf_counter()
+    for i in range(n):
+        func(lines[i % len(lines)], isEx=True)
+    cost = (time.perf_counter() - t) / n
+    print("{:<10}{:>10.2f} us/line".format(name, cost * 1e6))
+    return cost
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for line in lines[:100]:
+        assert legacy(line, isEx=True) == post.POSTSOLVE(line, isEx=True)
+    before = bench("before", legacy, n)
+    after = bench("after", post.POSTSOLVE, n)
+    print("speedup   {:>10.2f}x".format(before / after))
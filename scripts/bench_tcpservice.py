@@ -0,0 +1,112 @@
+# 用本地客户端压测network/server/tcpservice：
+# 1. 每个请求新建连接 vs keep-alive复用连接的小请求吞吐
+# 2. 大文件下载的吞吐
+# python scripts/bench_tcpservice.py [并发客户端数] [每个客户端的请求数]
+import os, sys, time, threading, tempfile, http.client
+
+rootDir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../VTranslator"))
+os.chdir(os.path.join(rootDir, ".."))
+sys.path.insert(0, rootDir)
+
+from myutils.config import globalconfig
+from network.server.tcpservice import TCPService, HTTPHandler, FileResponse
+
+# 不打印每个请求的日志
+import network.server.tcpservice as tcpservice
+
+tcpservice.print = lambda *_: None
+
+bigfile = os.path.join(tempfile.gettempdir(), "bench_tcpservice.bin")
+
+
+class Echo(HTTPHandler):
+    path = "/bench/echo"
+
+    def parse(self, info):
+        return {"word": info.query.get("word", "")}
+
+
+class BigFile(HTTPHandler):
+    path = "/bench/file"
+
+    def parse(self, _):
+        return FileResponse(bigfile)
+
+
+def client(port, n, keepalive, errors: list):
+    conn = None
+    for i in range(n):
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+            conn.request(
+                "GET",
+                "/bench/echo?word=%d" % i,
+                headers={} if keepalive else {"Connection": "close"},
+            )
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status != 200:
+                errors.append(resp.status)
+            if not keepalive:
+                conn.close()
+                conn = None
+        except Exception as e:
+            errors.append(e)
+            conn = None
+    if conn:
+        conn.close()
+
+
+def runclients(port, clients, n, keepalive):
+    errors = []
+    threads = [
+        threading.Thread(target=client, args=(port, n, keepalive, errors))
+        for _ in range(clients)
+    ]
+    t = time.perf_counter()
+    for _ in threads:
+        _.start()
+    for _ in threads:
+        _.join()
+    cost = time.perf_counter() - t
+    name = "keep-alive" if keepalive else "close"
+    print(
+        "{:<12}{:>10.0f} req/s  errors {}".format(name, clients * n / cost, len(errors))
+    )
+
+
+def download(port, times):
+    size = 0
+    t = time.perf_counter()
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    for _ in range(times):
+        conn.request("GET", "/bench/file")
+        resp = conn.getresponse()
+        while True:
+            bs = resp.read(0x40000)
+            if not bs:
+                break
+            size += len(bs)
+    conn.close()
+    cost = time.perf_counter() - t
+    print("{:<12}{:>10.1f} MB/s".format("file", size / cost / 1e6))
+
+
+if __name__ == "__main__":
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    globalconfig["network_service_disabled_paths"] = []
+    with open(bigfile, "wb") as ff:
+        ff.write(os.urandom(64 * 1024 * 1024))
+    service = TCPService()
+    service.register(Echo)
+    service.register(BigFile)
+    service.init(0, "127.0.0.1")
+    try:
+        runclients(service.port, clients, n, False)
+        runclients(service.port, clients, n, True)
+        download(service.port, 5)
+    finally:
+        service.stop()
+        os.remove(bigfile)
@@ -0,0 +1,98 @@
+# 测量zhconv.convert的吞吐：旧的逐字符切片+前缀集合 vs 编译后的转换表
+# python scripts/bench_zhconv.py [语料文件] [重复次数]
+# 不指定语料时用词典中的词条混合常用汉字和标点生成约100万字的文本
+import os, sys, time, random
+
+rootDir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../VTranslator"))
+os.chdir(os.path.join(rootDir, ".."))
+sys.path.insert(0, rootDir)
+
+import zhconv
+
+
+def legacy_prepare(locale):
+    zhdict = zhconv.getdict(locale)
+    pfset = []
+    for word in zhdict:
+        for ch in range(len(word)):
+            pfset.append(word[: ch + 1])
+    return zhdict, frozenset(pfset)
+
+
+def legacy(s, zhdict, pfset):
+    # 修改前的convert
+    ch = []
+    N = len(s)
+    pos = 0
+    while pos < N:
+        i = pos
+        frag = s[pos]
+        maxword = None
+        maxpos = 0
+        while i < N and frag in pfset:
+            if frag in zhdict:
+                maxword = zhdict[frag]
+                maxpos = i
+            i += 1
+            frag = s[pos : i + 1]
+        if maxword is None:
+            maxword = s[pos]
+            pos += 1
+        else:
+            pos = maxpos + 1
+        ch.append(maxword)
+    return "".join(ch)
+
+
+def makecorpus(n=1000000):
+    random.seed(0)
+    zhconv.loaddict()
+    words = list(zhconv.zhcdicts["zh2Hant"]) + list(zhconv.zhcdicts["zh2Hans"])
+    common = [chr(_) for _ in range(0x4E00, 0x4E00 + 3000)]
+    punct = "，。、「」『』！？…　\n"
+    parts = []
+    size = 0
+    while size < n:
+        r = random.random()
+        if r < 0.1:
+            _ = random.choice(words)
+        elif r < 0.2:
+            _ = random.choice(punct)
+        else:
+            _ = random.choice(common)
+        parts.append(_)
+        size += len(_)
+    return "".join(parts)
+
+
+def bench(name, func, text, repeat):
+    func(text[:1000])
+    t = time.perf_counter()
+    for _ in range(repeat):
+        func(text)
+    cost = (time.perf_counter() - t) / repeat
+    print("{:<10}{:>10.1f} ms {:>10.2f} Mchar/s".format(name, cost * 1e3, len(text) / cost / 1e6))
+    return cost
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "r", encoding="utf8") as ff:
+            text = ff.read()
+    else:
+        text = makecorpus()
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    print("corpus {} chars".format(len(text)))
+    for locale in ("zh-cn", "zh-tw", "zh-hans", "zh-hant"):
+        print(locale)
+        t = time.perf_counter()
+        zhdict, pfset = legacy_prepare(locale)
+        print("{:<10}{:>10.1f} ms".format("load old", (time.perf_counter() - t) * 1e3))
+        zhconv.converters.pop(locale, None)
+        t = time.perf_counter()
+        zhconv.getconverter(locale)
+        print("{:<10}{:>10.1f} ms".format("load new", (time.perf_counter() - t) * 1e3))
+        assert legacy(text, zhdict, pfset) == zhconv.convert(text, locale)
+        before = bench("before", lambda s: legacy(s, zhdict, pfset), text, repeat)
+        after = bench("after", lambda s: zhconv.convert(s, locale), text, repeat)
+        print("{:<10}{:>10.2f}x".format("speedup", before / after))